@@ -0,0 +1,84 @@
+"""
+Benchmark of the clustering of the mapping information on a synthetic mapping file, along the path of
+map.update_mapping: the mapping file is loaded to the records of the mapping db (db_helper.update_records) and the
+clusters are constructed from the db's multi-entity addresses (helper.get_entity_clusters).
+
+Usage (from the root directory of the repository):
+    python -m benchmarks.bench_get_clusters --lines 2000000
+"""
+import argparse
+import json
+import pathlib
+import random
+import tempfile
+import time
+import tokenomics_decentralization.helper as hlp
+import tokenomics_decentralization.db_helper as db_hlp
+from contextlib import closing
+
+SOURCES = ['https://www.walletexplorer.com', 'multi-input']
+
+
+def write_synthetic_mapping(mapping_dir, ledger, num_lines, num_entities, shared_address_ratio, seed):
+    """
+    Writes a synthetic mapping file, where a fraction of the lines reuse an address of a previous line (under a
+    random entity), s.t. the file contains many multi-entity addresses that form clusters of varying sizes
+    :param mapping_dir: the directory where the mapping information is stored
+    :param ledger: the name of the (synthetic) ledger
+    :param num_lines: the number of lines of the mapping file
+    :param num_entities: the number of distinct entity names
+    :param shared_address_ratio: the fraction of lines whose address is shared with a previous line
+    :param seed: the seed of the random number generator
+    """
+    rng = random.Random(seed)
+    (mapping_dir / 'addresses').mkdir(parents=True)
+    with open(mapping_dir / 'sources.json', 'w') as f:
+        json.dump({keyword: SOURCES for keyword in hlp.get_active_source_keywords()}, f)
+
+    with open(mapping_dir / f'addresses/{ledger}.jsonl', 'w') as f:
+        for idx in range(num_lines):
+            address_idx = rng.randrange(idx) if idx > 0 and rng.random() < shared_address_ratio else idx
+            info = {'address': f'addr{address_idx}', 'name': f'entity{rng.randrange(num_entities)}',
+                    'source': rng.choice(SOURCES)}
+            f.write(json.dumps(info) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the clustering of the mapping information.')
+    parser.add_argument('--lines', type=int, default=2000000, help='The number of lines of the mapping file.')
+    parser.add_argument('--entities', type=int, default=500000, help='The number of distinct entity names.')
+    parser.add_argument('--shared-address-ratio', type=float, default=0.2,
+                        help='The fraction of lines whose address is shared with a previous line.')
+    parser.add_argument('--seed', type=int, default=42, help='The seed of the random number generator.')
+    args = parser.parse_args()
+
+    ledger = 'benchmark'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hlp.MAPPING_INFO_DIR = pathlib.Path(tmp_dir)
+
+        start_time = time.time()
+        write_synthetic_mapping(hlp.MAPPING_INFO_DIR, ledger, args.lines, args.entities, args.shared_address_ratio,
+                                args.seed)
+        print(f'Generated {args.lines} mapping lines in {time.time() - start_time:.1f} sec')
+
+        with closing(db_hlp.get_connector(db_hlp.get_db_filename(ledger))) as conn:
+            db_hlp.set_loader_pragmas(conn)
+            db_hlp.select_sources(conn, hlp.get_source_combination(), hlp.get_active_sources())
+
+            start_time = time.time()
+            db_hlp.update_records(conn, hlp.read_mapping_information(ledger))
+            elapsed_time = time.time() - start_time
+            print(f'Loaded {args.lines} mapping lines in {elapsed_time:.1f} sec '
+                  f'({args.lines / elapsed_time:.0f} lines/sec)')
+
+            start_time = time.time()
+            entity_clusters = hlp.get_entity_clusters(db_hlp.get_multi_entity_address_items(conn))
+            db_hlp.update_clusters(conn, entity_clusters)
+            elapsed_time = time.time() - start_time
+
+    print(f'Clustered {len(entity_clusters)} entities into {len(set(entity_clusters.values()))} clusters '
+          f'in {elapsed_time:.1f} sec')
+
+
+if __name__ == '__main__':
+    main()
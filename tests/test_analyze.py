@@ -1,6 +1,32 @@
-from tokenomics_decentralization.analyze import analyze_snapshot, analyze, get_entries, analyze_ledger_snapshot
+from tokenomics_decentralization.analyze import analyze_snapshot, analyze, get_entries, analyze_ledger_snapshot, \
+    get_worker_resource, plan_jobs, aggregate_entity_balances, get_entity_fingerprints, get_distribution, \
+    get_top_entries, aggregate_snapshot_part, analyze_snapshot_sweep, get_distribution_prefix
+import tokenomics_decentralization.analyze as analyze_module
+import tokenomics_decentralization.spill_helper as spill_hlp
 from unittest.mock import call, Mock
-import pathlib
+from itertools import product
+import numpy as np
+from concurrent.futures import Future
+from tokenomics_decentralization.metrics import compute_hhi, compute_gini, compute_tau_curve
+import pytest
+
+
+def get_call_args_as_lists(mock):
+    """
+    Retrieves the positional arguments of each call to a metric mock, with the entries array converted to a list
+    """
+    return [(args[0].tolist(), ) + args[1:] for args, _ in mock.call_args_list]
+
+
+def mock_compute_metrics(results, calls):
+    """
+    Creates a replacement of compute_prefix_metrics that records the entries (as a list) and tau thresholds of each
+    call and returns the given results
+    """
+    def compute_prefix_metrics(entries, counts, tau_thresholds, prefix_sizes):
+        calls.append((entries.tolist(), tau_thresholds))
+        return [dict(results, tau=[100, 50][:len(tau_thresholds)]) for _ in prefix_sizes]
+    return compute_prefix_metrics
 
 
 def test_analyze_snapshot(mocker):
@@ -13,8 +39,7 @@ def test_analyze_snapshot(mocker):
 
     get_metrics_mock = mocker.patch('tokenomics_decentralization.helper.get_metrics')
 
-    compute_hhi_mock = mocker.patch('tokenomics_decentralization.analyze.compute_hhi')
-    compute_tau_mock = mocker.patch('tokenomics_decentralization.analyze.compute_tau')
+    compute_metrics_mock = mocker.patch('tokenomics_decentralization.analyze.compute_prefix_metrics')
 
     get_clustering_mock.return_value = True
     get_exclude_contracts_mock.return_value = False
@@ -23,21 +48,18 @@ def test_analyze_snapshot(mocker):
     get_top_limit_type_mock.return_value = 'absolute'
     get_top_limit_value_mock.return_value = 0
 
-    get_circulation_mock = mocker.patch('tokenomics_decentralization.helper.get_circulation_from_entries')
     circulation = 5
-    get_circulation_mock.return_value = circulation
-
     get_metrics_mock.return_value = ['hhi']
+    compute_metrics_calls = []
+    compute_metrics_mock.side_effect = mock_compute_metrics({'circulation': circulation, 'hhi': 1}, compute_metrics_calls)
 
-    compute_hhi_mock.return_value = 1
+    entries = [2, 1]
 
-    entries = [1, 2]
-
-    hhi_calls = []
+    metrics_calls = []
 
     output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries, circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
+    metrics_calls.append((entries, []))
+    assert compute_metrics_calls == metrics_calls
     assert output == {'hhi': 1}
 
     get_clustering_mock.return_value = False
@@ -47,49 +69,201 @@ def test_analyze_snapshot(mocker):
     get_top_limit_value_mock.return_value = 1
 
     output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries[:1], circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
+    metrics_calls.append((entries[:1], []))
+    assert compute_metrics_calls == metrics_calls
     assert output == {'top-1_absolute exclude_below_fees exclude_contracts non-clustered hhi': 1}
 
-    compute_hhi_mock.return_value = 2
-    output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries[:1], circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
-    assert output == {'top-1_absolute exclude_below_fees exclude_contracts non-clustered hhi': 2}
-
     get_clustering_mock.return_value = True
-    compute_hhi_mock.return_value = 3
     output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries[:1], circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
-    assert output == {'top-1_absolute exclude_below_fees exclude_contracts hhi': 3}
+    metrics_calls.append((entries[:1], []))
+    assert compute_metrics_calls == metrics_calls
+    assert output == {'top-1_absolute exclude_below_fees exclude_contracts hhi': 1}
 
     get_top_limit_value_mock.return_value = 0
-    compute_hhi_mock.return_value = 4
     output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries, circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
-    assert output == {'exclude_below_fees exclude_contracts hhi': 4}
+    metrics_calls.append((entries, []))
+    assert compute_metrics_calls == metrics_calls
+    assert output == {'exclude_below_fees exclude_contracts hhi': 1}
 
     get_top_limit_type_mock.return_value = 'percentage'
     get_top_limit_value_mock.return_value = 0.5
-    compute_hhi_mock.return_value = 5
     output = analyze_snapshot(entries)
-    hhi_calls.append(call(entries[:int(len(entries)*0.5)], circulation))
-    assert compute_hhi_mock.call_args_list == hhi_calls
-    assert output == {'top-0.5_percentage exclude_below_fees exclude_contracts hhi': 5}
+    metrics_calls.append((entries[:int(len(entries)*0.5)], []))
+    assert compute_metrics_calls == metrics_calls
+    assert output == {'top-0.5_percentage exclude_below_fees exclude_contracts hhi': 1}
+
+    # A metric that is not computed in the single pass is computed by its own function, on the top entries
+    compute_custom_mock = mocker.Mock(return_value=4)
+    mocker.patch.dict(analyze_module.COMPUTE_FUNCTIONS, {'custom': compute_custom_mock})
+    get_metrics_mock.return_value = ['custom', 'hhi']
+    output = analyze_snapshot(entries)
+    assert get_call_args_as_lists(compute_custom_mock) == [(entries[:1], circulation)]
+    assert output == {'top-0.5_percentage exclude_below_fees exclude_contracts custom': 4,
+                      'top-0.5_percentage exclude_below_fees exclude_contracts hhi': 1}
 
     get_top_limit_value_mock.return_value = 0
     get_exclude_below_usd_cent_mock.return_value = True
     get_exclude_below_fees_mock.return_value = False
     get_metrics_mock.return_value = ['tau=0.5']
-    compute_tau_mock.return_value = 100
+    compute_metrics_mock.side_effect = mock_compute_metrics({'circulation': circulation, 'hhi': 1}, compute_metrics_calls)
     output = analyze_snapshot(entries)
-    assert compute_tau_mock.call_args_list == [call(entries, circulation, 0.5)]
+    assert compute_metrics_calls[-1] == (entries, [0.5])
     assert output == {'exclude_below_usd_cent exclude_contracts tau=0.5': 100}
 
+    # All metrics and tau thresholds are computed with a single call
+    get_metrics_mock.return_value = ['tau=0.5', 'hhi', 'tau=0.33']
+    output = analyze_snapshot(entries)
+    assert compute_metrics_calls[-1] == (entries, [0.5, 0.33])
+    assert output['exclude_below_usd_cent exclude_contracts tau=0.5'] == 100
+    assert output['exclude_below_usd_cent exclude_contracts tau=0.33'] == 50
+    assert output['exclude_below_usd_cent exclude_contracts hhi'] == 1
+
+
+def test_analyze_snapshot_run_lengths(mocker):
+    mocker.patch('tokenomics_decentralization.helper.get_clustering_flag', return_value=True)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_contracts_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_fees_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_usd_cent_flag', return_value=False)
+    get_top_limit_type_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_type')
+    get_top_limit_value_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_value')
+    mocker.patch('tokenomics_decentralization.helper.get_tau_thresholds', return_value=[0.5])
+    mocker.patch('tokenomics_decentralization.helper.get_metrics',
+                 return_value=['hhi', 'gini', 'total_entities', 'tau=0.5'])
+
+    # The distribution has few distinct balances, so it is analyzed in run-length form
+    entries = np.array([9, 5, 5, 5, 2, 2, 1, 1, 1, 1])
+    for top_limit_type, top_limit_value in [('absolute', 0), ('absolute', 5), ('absolute', 100),
+                                            ('percentage', 0.3)]:
+        get_top_limit_type_mock.return_value = top_limit_type
+        get_top_limit_value_mock.return_value = top_limit_value
+        output = analyze_snapshot(entries)
+
+        top_entries = entries
+        if top_limit_value > 0:
+            limit = int(len(entries) * top_limit_value) if top_limit_type == 'percentage' else top_limit_value
+            top_entries = entries[:limit]
+        circulation = int(top_entries.sum())
+        prefix = f'top-{top_limit_value}_{top_limit_type} ' if top_limit_value > 0 else ''
+        assert output[prefix + 'hhi'] == pytest.approx(compute_hhi(top_entries, circulation), rel=1e-9)
+        assert output[prefix + 'gini'] == pytest.approx(compute_gini(top_entries, circulation), rel=1e-9)
+        assert output[prefix + 'total_entities'] == len(top_entries)
+        assert output[prefix + 'tau=0.5'] == compute_tau_curve(top_entries, circulation, [0.5])[0]
+
+    # A metric that is computed by its own function is given the expanded top entries
+    mocker.patch.dict(analyze_module.COMPUTE_FUNCTIONS, {'custom': compute_hhi})
+    mocker.patch('tokenomics_decentralization.helper.get_metrics', return_value=['custom'])
+    get_top_limit_type_mock.return_value = 'absolute'
+    get_top_limit_value_mock.return_value = 5
+    output = analyze_snapshot(entries)
+    assert output['top-5_absolute custom'] == pytest.approx(compute_hhi(entries[:5], int(entries[:5].sum())), rel=1e-9)
 
-def test_get_entries(mocker):
+
+def test_analyze_snapshot_unordered(mocker):
+    mocker.patch('tokenomics_decentralization.helper.get_clustering_flag', return_value=True)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_contracts_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_fees_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_usd_cent_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_top_limit_type', return_value='absolute')
+    mocker.patch('tokenomics_decentralization.helper.get_top_limit_value', return_value=100)
+    get_metrics_mock = mocker.patch('tokenomics_decentralization.helper.get_metrics')
+    get_top_entries_spy = mocker.spy(analyze_module, 'get_top_entries')
+
+    entries = np.random.default_rng(3).integers(1, 10 ** 6, size=1000)
+    sorted_entries = np.sort(entries)[::-1]
+    for metrics, ordered in [(['hhi', 'shannon_entropy', 'theil', 'total_entities', 'mpr'], False),
+                             (['hhi', 'gini', 'tau=0.5'], True)]:
+        get_metrics_mock.return_value = metrics
+        mocker.patch('tokenomics_decentralization.helper.get_tau_thresholds', return_value=[0.5] if ordered else [])
+        output = analyze_snapshot(entries)
+        assert get_top_entries_spy.call_args.args[1:] == (100, ordered)
+        expected_output = analyze_snapshot(sorted_entries)
+        assert output.keys() == expected_output.keys()
+        for metric_name, value in output.items():
+            assert value == pytest.approx(expected_output[metric_name], rel=1e-9)
+
+
+def test_analyze_snapshot_sweep(mocker):
+    mocker.patch('tokenomics_decentralization.helper.get_clustering_flag', return_value=True)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_contracts_flag', return_value=False)
+    get_exclude_below_fees_mock = mocker.patch('tokenomics_decentralization.helper.get_exclude_below_fees_flag')
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_usd_cent_flag', return_value=False)
+    get_top_limit_type_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_type')
+    get_top_limit_value_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_value')
+    mocker.patch('tokenomics_decentralization.helper.get_tau_thresholds', return_value=[0.33, 0.5])
+    mocker.patch('tokenomics_decentralization.helper.get_metrics',
+                 return_value=['hhi', 'shannon_entropy', 'gini', 'theil', 'mpr', 'total_entities', 'tau=0.33',
+                               'tau=0.5'])
+
+    # The metrics of all combinations of balance threshold and top limit, computed from the same sorted entries,
+    # agree with the metrics of each combination
+    top_limits = [('absolute', 0), ('absolute', 3), ('absolute', 250), ('absolute', 10000), ('percentage', 0.5),
+                  ('percentage', 0.001)]
+    balance_thresholds = [((False, False, 0), None), ((True, False, 0), 100), ((False, False, 10.0), 50000)]
+    rng = np.random.default_rng(5)
+    for entries in [rng.integers(1, 10 ** 6, size=1000), rng.integers(1, 5, size=1000) ** 3]:
+        outputs = analyze_snapshot_sweep(entries, top_limits, balance_thresholds)
+        assert len(outputs) == len(balance_thresholds) * len(top_limits)
+        for ((balance_threshold, threshold_value), (top_limit_type, top_limit_value)), output in zip(
+                product(balance_thresholds, top_limits), outputs):
+            get_top_limit_type_mock.return_value = top_limit_type
+            get_top_limit_value_mock.return_value = top_limit_value
+            get_exclude_below_fees_mock.return_value = balance_threshold[0]
+            expected_output = analyze_snapshot(entries if threshold_value is None else entries[entries > threshold_value])
+            if balance_threshold[2]:
+                assert all(metric_name.startswith('exclude_below_usd-10.0 ') or
+                           metric_name.startswith(f'top-{top_limit_value}_{top_limit_type} exclude_below_usd-10.0 ')
+                           for metric_name in output)
+            else:
+                assert output.keys() == expected_output.keys()
+            assert list(output.values()) == pytest.approx(list(expected_output.values()), rel=1e-9)
+
+
+def test_get_distribution():
+    entries, counts = get_distribution(np.array([3, 3, 3, 1]))
+    assert entries.tolist() == [3, 1] and counts.tolist() == [3, 1]
+
+    entries, counts = get_distribution(np.array([3, 2, 2, 1]))
+    assert entries.tolist() == [3, 2, 2, 1] and counts is None
+
+
+def test_get_distribution_memory_mapped(tmp_path):
+    # A memory-mapped distribution is kept as is, so that it is never loaded to memory at once
+    np.save(tmp_path / 'entries.npy', np.array([3, 3, 3, 1]))
+    mapped_entries = np.load(tmp_path / 'entries.npy', mmap_mode='r')
+    entries, counts = get_distribution(mapped_entries[:3])
+    assert isinstance(entries, np.memmap) and entries.tolist() == [3, 3, 3] and counts is None
+
+
+def test_get_distribution_prefix():
+    entries, counts = get_distribution_prefix(np.array([3, 2, 1]), None, 2)
+    assert entries.tolist() == [3, 2] and counts is None
+
+    entries, counts = get_distribution_prefix(np.array([3, 2, 1]), None, None)
+    assert entries.tolist() == [3, 2, 1] and counts is None
+
+    for limit, expected_entries, expected_counts in [(0, [], []), (1, [3], [1]), (2, [3], [2]), (3, [3, 2], [2, 1]),
+                                                     (4, [3, 2, 1], [2, 1, 1]), (5, [3, 2, 1], [2, 1, 2]),
+                                                     (10, [3, 2, 1], [2, 1, 2])]:
+        counts = np.array([2, 1, 2])
+        entries, top_counts = get_distribution_prefix(np.array([3, 2, 1]), counts, limit)
+        assert entries.tolist() == expected_entries and top_counts.tolist() == expected_counts
+        assert counts.tolist() == [2, 1, 2]
+
+
+def test_get_top_entries():
+    assert get_top_entries(np.array([3, 2, 1]), 2).tolist() == [3, 2]
+    assert get_top_entries(np.array([3, 2, 1]), None).tolist() == [3, 2, 1]
+
+    # Unordered entries are partially sorted, so that only the top entries are selected (and then sorted, if needed)
+    entries = np.array([1, 5, 3, 2, 4])
+    for limit, expected_entries in [(0, []), (1, [5]), (3, [5, 4, 3]), (5, [5, 4, 3, 2, 1]), (10, [5, 4, 3, 2, 1]),
+                                    (None, [5, 4, 3, 2, 1])]:
+        assert get_top_entries(entries, limit).tolist() == expected_entries
+        assert sorted(get_top_entries(entries, limit, ordered=False).tolist(), reverse=True) == expected_entries
+    assert entries.tolist() == [1, 5, 3, 2, 4]
+
+
+def test_get_entries(mocker, tmp_path):
     get_exclude_below_fees_mock = mocker.patch('tokenomics_decentralization.helper.get_exclude_below_fees_flag')
     get_exclude_below_fees_mock.return_value = False
     get_exclude_below_usd_cent_mock = mocker.patch('tokenomics_decentralization.helper.get_exclude_below_usd_cent_flag')
@@ -110,22 +284,195 @@ def test_get_entries(mocker):
     get_special_addresses_mock.return_value = set(['addr2'])
 
     get_db_filename_mock = mocker.patch('tokenomics_decentralization.db_helper.get_db_filename')
-    get_db_filename_mock.return_value = 'bitcoin_Test.db'
+    get_db_filename_mock.return_value = 'bitcoin.db'
 
-    mocker.patch('builtins.open', mocker.mock_open(read_data='address,balance\naddr1,17\naddr2,26'))
+    get_source_combination_mock = mocker.patch('tokenomics_decentralization.helper.get_source_combination')
+    get_source_combination_mock.return_value = 'Test'
+    get_active_sources_mock = mocker.patch('tokenomics_decentralization.helper.get_active_sources')
+    get_active_sources_mock.return_value = {'test'}
+    select_sources_mock = mocker.patch('tokenomics_decentralization.db_helper.select_sources')
+    load_mapping_index_mock = mocker.patch('tokenomics_decentralization.index_helper.load_mapping_index')
+    load_mapping_index_mock.return_value = None
 
-    get_address_entity_mock = mocker.patch('tokenomics_decentralization.db_helper.get_address_entity')
-    get_address_entity_mock.side_effect = [('entity1', 1), ('entity2', 0)]
+    get_cache_snapshots_mock = mocker.patch('tokenomics_decentralization.helper.get_cache_snapshots_flag')
+    get_cache_snapshots_mock.return_value = False
 
-    entries = get_entries('bitcoin', '2010-01-01', 'test_filename')
-    assert entries == [17]
-    assert get_db_connector_mock.call_args_list == [call('bitcoin_Test.db')]
+    get_out_of_core_memory_budget_mock = mocker.patch('tokenomics_decentralization.helper.get_out_of_core_memory_budget')
+    get_out_of_core_memory_budget_mock.return_value = None
+
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    with open(filename, 'w') as f:
+        f.write('address,balance\naddr1,17\naddr2,26')
+
+    get_clustering_mock = mocker.patch('tokenomics_decentralization.helper.get_clustering_flag')
+    get_clustering_mock.return_value = True
+
+    get_addresses_entities_mock = mocker.patch('tokenomics_decentralization.db_helper.get_addresses_entities')
+    get_addresses_entities_mock.return_value = {'addr1': ('entity1', 1)}
+
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert entries.tolist() == [17]
+    assert get_db_connector_mock.call_args_list == [call('bitcoin.db')]
+    assert select_sources_mock.call_args_list == [call('connector', 'Test', {'test'})]
+    # The special addresses are filtered out before the mapping lookup
+    assert get_addresses_entities_mock.call_args_list == [call('connector', ['addr1'])]
 
-    get_address_entity_mock.side_effect = [('entity1', 1), ('entity2', 0)]
     get_special_addresses_mock.return_value = set()
     get_exclude_contracts_mock.return_value = True
-    entries = get_entries('bitcoin', '2010-01-01', 'test_filename')
-    assert entries == [26]
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert entries.tolist() == [26]
+
+    # The mapping is not consulted at all without clustering and contract exclusion
+    get_clustering_mock.return_value = False
+    get_exclude_contracts_mock.return_value = False
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert sorted(entries.tolist(), reverse=True) == [26, 17]
+    assert get_db_connector_mock.call_args_list == [call('bitcoin.db'), call('bitcoin.db')]
+    assert len(get_addresses_entities_mock.call_args_list) == 2
+
+    # The mapping db is not consulted if the compiled mapping index is available
+    get_clustering_mock.return_value = True
+    index = {'lookup_stats': {'lookups': 0, 'skipped_lookups': 0}}
+    load_mapping_index_mock.return_value = index
+    lookup_addresses_entities_mock = mocker.patch('tokenomics_decentralization.index_helper.lookup_addresses_entities')
+    lookup_addresses_entities_mock.return_value = (np.array([0, 1]), ['entity1', 'entity1'], np.array([False, False]))
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert entries.tolist() == [43]
+    assert load_mapping_index_mock.call_args_list[-1] == call('bitcoin', 'Test')
+    assert lookup_addresses_entities_mock.call_args_list == [call(index, ['addr1', 'addr2'])]
+    assert len(get_db_connector_mock.call_args_list) == 2
+
+    # Contracts that are found in the index are excluded
+    get_exclude_contracts_mock.return_value = True
+    lookup_addresses_entities_mock.return_value = (np.array([1]), ['entity2'], np.array([True]))
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert entries.tolist() == [17]
+    get_exclude_contracts_mock.return_value = False
+
+    # With a balance threshold sweep, the entities are aggregated above the lowest threshold of the sweep
+    get_clustering_mock.return_value = False
+    mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_sweep',
+                 return_value=[(True, False, 0), (False, True, 0)])
+    get_median_tx_fee_mock.return_value = 30
+    get_usd_cent_equivalent_mock.return_value = 20
+    entries = get_entries('bitcoin', '2010-01-01', filename)
+    assert entries.tolist() == [26]
+
+
+def test_get_entries_out_of_core(mocker, tmp_path):
+    for flag in ['get_exclude_below_fees_flag', 'get_exclude_below_usd_cent_flag', 'get_exclude_contracts_flag',
+                 'get_clustering_flag', 'get_cache_snapshots_flag']:
+        mocker.patch(f'tokenomics_decentralization.helper.{flag}').return_value = False
+    mocker.patch('tokenomics_decentralization.helper.get_special_addresses').return_value = set()
+    mocker.patch('tokenomics_decentralization.helper.get_output_directory').return_value = tmp_path
+
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    with open(filename, 'w') as f:
+        f.write('address,balance\naddr1,17\naddr2,26\naddr3,5\n')
+
+    get_out_of_core_memory_budget_mock = mocker.patch('tokenomics_decentralization.helper.get_out_of_core_memory_budget')
+    aggregate_out_of_core_spy = mocker.spy(spill_hlp, 'aggregate_out_of_core')
+
+    # Files that fit in the budget are aggregated in memory
+    get_out_of_core_memory_budget_mock.return_value = 10**6
+    assert sorted(get_entries('bitcoin', '2010-01-01', filename).tolist(), reverse=True) == [26, 17, 5]
+    assert aggregate_out_of_core_spy.call_count == 0
+
+    get_out_of_core_memory_budget_mock.return_value = 10
+    assert sorted(get_entries('bitcoin', '2010-01-01', filename).tolist(), reverse=True) == [26, 17, 5]
+    assert aggregate_out_of_core_spy.call_count == 1
+    # The spill directory is removed after the aggregation
+    assert list(tmp_path.glob('spill-*')) == []
+
+
+def test_get_entries_parallel(mocker, tmp_path):
+    for flag in ['get_exclude_below_fees_flag', 'get_exclude_below_usd_cent_flag', 'get_exclude_contracts_flag',
+                 'get_clustering_flag', 'get_cache_snapshots_flag']:
+        mocker.patch(f'tokenomics_decentralization.helper.{flag}').return_value = False
+    mocker.patch('tokenomics_decentralization.helper.get_special_addresses').return_value = set()
+    mocker.patch('tokenomics_decentralization.helper.get_out_of_core_memory_budget').return_value = None
+    mocker.patch('tokenomics_decentralization.snapshot_helper.MIN_PART_SIZE', 10)
+    get_parse_workers_mock = mocker.patch('tokenomics_decentralization.helper.get_parse_workers')
+
+    # Run the parts synchronously in this process
+    submitted_parts = []
+
+    class Executor:
+        def __init__(self, max_workers, initializer):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def submit(self, function, *args):
+            submitted_parts.append(args[2:4])
+            future = Future()
+            future.set_result(function(*args))
+            return future
+
+    mocker.patch('tokenomics_decentralization.analyze.ProcessPoolExecutor', Executor)
+
+    for shard, content in [('0', 'address,balance\naddr1,17\naddr2,26\naddr3,5\naddr1,3\n'),
+                           ('1', f'address,balance\naddr2,4\naddr4,{2**64}\naddr3,1\n')]:
+        with open(tmp_path / f'bitcoin_2010-01-01_raw_data_{shard}.csv', 'w') as f:
+            f.write(content)
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data_*.csv'
+
+    get_parse_workers_mock.return_value = 1
+    assert sorted(get_entries('bitcoin', '2010-01-01', filename).tolist(), reverse=True) == [2**64, 30, 20, 6]
+    assert submitted_parts == []
+
+    get_parse_workers_mock.return_value = 4
+    assert sorted(get_entries('bitcoin', '2010-01-01', filename).tolist(), reverse=True) == [2**64, 30, 20, 6]
+    assert len(submitted_parts) == 3
+
+
+def test_aggregate_snapshot_part(mocker):
+    get_entity_balances_mock = mocker.patch('tokenomics_decentralization.analyze.get_entity_balances')
+    get_entity_balances_mock.return_value = iter([(['e1', 'e2'], [1, 2]), (['e1', 'e3'], [10, 20])])
+    entities, balances = aggregate_snapshot_part('bitcoin', '2010-01-01', 'f', (0, 2), False)
+    assert sorted(zip(entities, balances)) == [('e1', 11), ('e2', 2), ('e3', 20)]
+    assert get_entity_balances_mock.call_args_list == [call('bitcoin', '2010-01-01', 'f', False, (0, 2))]
+
+    # Sums that exceed the int64 range are exact
+    get_entity_balances_mock.return_value = iter([(['e1', 'e1', 'e2'], [2**63 - 1, 2, 2**64 + 1])])
+    entities, balances = aggregate_snapshot_part('bitcoin', '2010-01-01', 'f', None, False)
+    assert sorted(zip(entities, balances)) == [('e1', 2**63 + 1), ('e2', 2**64 + 1)]
+
+    get_entity_balances_mock.return_value = iter([])
+    assert aggregate_snapshot_part('bitcoin', '2010-01-01', 'f', None, False) == ([], [])
+
+
+def test_get_entity_fingerprints():
+    first_hashes, second_hashes = get_entity_fingerprints(['entity1', 'entity2', 'entity1'])
+    assert first_hashes.dtype == np.int64 and second_hashes.dtype == np.int64
+    assert first_hashes[0] == first_hashes[2] and second_hashes[0] == second_hashes[2]
+    assert (first_hashes[0], second_hashes[0]) != (first_hashes[1], second_hashes[1])
+
+
+def test_aggregate_entity_balances(mocker):
+    entity_balances = [(['entity1', 'entity2', 'entity1'], [10, 5, 3]), ([], []), (['entity3', 'entity2'], [1, 4])]
+    entries = aggregate_entity_balances(iter(entity_balances), 0)
+    assert entries.dtype == np.int64
+    assert sorted(entries.tolist()) == [1, 9, 13]
+    assert sorted(aggregate_entity_balances(iter(entity_balances), 1).tolist()) == [9, 13]
+    assert aggregate_entity_balances(iter([]), 0).tolist() == []
+
+    # Balances whose sum may exceed int64 are aggregated as floats
+    entries = aggregate_entity_balances(iter([(['entity1', 'entity2', 'entity1'], [2**62, 5, 2**62])]), 0)
+    assert entries.dtype == np.float64
+    assert sorted(entries.tolist()) == [5, 2**63]
+
+    # Distinct entities with the same first hash are told apart by the second one
+    fingerprints = {'entity1': (1, 1), 'entity2': (1, 2), 'entity3': (0, 1)}
+    get_entity_fingerprints_mock = mocker.patch('tokenomics_decentralization.analyze.get_entity_fingerprints')
+    get_entity_fingerprints_mock.side_effect = lambda entities: tuple(
+        np.array([fingerprints[entity][idx] for entity in entities], dtype=np.int64) for idx in range(2))
+    entity_balances = [(['entity1', 'entity2', 'entity3', 'entity1', 'entity2'], [1, 10, 100, 1000, 10000])]
+    assert sorted(aggregate_entity_balances(iter(entity_balances), 0).tolist()) == [100, 1001, 10010]
 
 
 def test_analyze(mocker):
@@ -138,46 +485,143 @@ def test_analyze(mocker):
     assert len(write_csv_output_mock.call_args_list) == 1
 
 
-def test_analyze_ledger_snapshot(mocker):
-    get_input_directories_mock = mocker.patch('tokenomics_decentralization.helper.get_input_directories')
-    get_input_directories_mock.return_value = [pathlib.Path('/').resolve()]
+def test_analyze_schedule(mocker):
+    get_concurrency_mock = mocker.patch('tokenomics_decentralization.helper.get_concurrency_per_ledger')
+    get_concurrency_mock.return_value = {'bitcoin': 1, 'ethereum': 1}
+
+    plan_jobs_mock = mocker.patch('tokenomics_decentralization.analyze.plan_jobs')
+    plan_jobs_mock.return_value = ([(30, 'bitcoin', '2011-01-01', 'f1'), (20, 'ethereum', '2010-01-01', 'f2'),
+                                    (10, 'bitcoin', '2010-01-01', 'f3')], [['ethereum', '2009-01-01']])
+
+    # Run the jobs synchronously in this process to record the order of submission
+    submitted_jobs = []
+
+    class Executor:
+        def __init__(self, max_workers, initializer):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def submit(self, function, *args):
+            submitted_jobs.append(args)
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+    mocker.patch('tokenomics_decentralization.analyze.ProcessPoolExecutor', Executor)
+    prefetch_snapshot_mock = mocker.patch('tokenomics_decentralization.snapshot_helper.prefetch_snapshot')
+    analyze_ledger_snapshot_mock = mocker.patch('tokenomics_decentralization.analyze.analyze_ledger_snapshot')
+    analyze_ledger_snapshot_mock.side_effect = lambda ledger, date, input_filename: [[ledger, date]]
+    write_csv_output_mock = mocker.patch('tokenomics_decentralization.helper.write_csv_output')
+
+    analyze(['bitcoin', 'ethereum'], ['2010-01-01', '2011-01-01'])
+    assert submitted_jobs == [('bitcoin', '2011-01-01', 'f1'), ('ethereum', '2010-01-01', 'f2'),
+                              ('bitcoin', '2010-01-01', 'f3')]
+    # The input of the next job is prefetched while the previous one runs
+    assert prefetch_snapshot_mock.call_args_list == [call('f2'), call('f3')]
+    assert write_csv_output_mock.call_args_list == [call([
+        ['bitcoin', '2010-01-01'], ['bitcoin', '2011-01-01'], ['ethereum', '2009-01-01'], ['ethereum', '2010-01-01']
+    ])]
+
+    # A failed job is logged and the rows of the other jobs are still written
+    plan_jobs_mock.return_value = ([(30, 'bitcoin', '2011-01-01', 'f1'), (20, 'ethereum', '2010-01-01', 'f2'),
+                                    (10, 'bitcoin', '2010-01-01', 'f3')], [['ethereum', '2009-01-01']])
+    write_csv_output_mock.reset_mock()
+    logging_error_mock = mocker.patch('logging.error')
+
+    def analyze_ledger_snapshot(ledger, date, input_filename):
+        if input_filename == 'f2':
+            raise ValueError('corrupt snapshot')
+        return [[ledger, date]]
+    analyze_ledger_snapshot_mock.side_effect = analyze_ledger_snapshot
+
+    analyze(['bitcoin', 'ethereum'], ['2010-01-01', '2011-01-01'])
+    assert write_csv_output_mock.call_args_list == [call([
+        ['bitcoin', '2010-01-01'], ['bitcoin', '2011-01-01'], ['ethereum', '2009-01-01']
+    ])]
+    assert 'ethereum on 2010-01-01' in logging_error_mock.call_args.args[0]
+
+    # No ledgers
+    plan_jobs_mock.return_value = ([], [])
+    write_csv_output_mock.reset_mock()
+    analyze([], ['2010-01-01'])
+    assert write_csv_output_mock.call_args_list == [call([])]
+
+
+def test_plan_jobs(mocker):
+    read_csv_output_mock = mocker.patch('tokenomics_decentralization.helper.read_csv_output')
+    read_csv_output_mock.return_value = {
+        ('bitcoin', '2010-01-01'): [['bitcoin', '2010-01-01', 'True', 'False', 'absolute', '0', 'False', 'False', '1']]
+    }
+    get_top_limits_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limits')
+    get_top_limits_mock.return_value = [('absolute', 0)]
+
+    get_input_catalog_mock = mocker.patch('tokenomics_decentralization.helper.get_input_catalog')
+    get_input_catalog_mock.return_value = {
+        ('bitcoin', '2010-01-01'): {'path': 'bitcoin_2010-01-01', 'size': 20},
+        ('bitcoin', '2011-01-01'): {'path': 'bitcoin_2011-01-01', 'size': 10},
+        ('bitcoin', '2012-01-01'): {'path': 'bitcoin_2012-01-01', 'size': 30},
+    }
+
+    jobs, existing_rows = plan_jobs(['bitcoin', 'ethereum'], ['2010-01-01', '2011-01-01', '2012-01-01'])
+    assert jobs == [(30, 'bitcoin', '2012-01-01', 'bitcoin_2012-01-01'),
+                    (10, 'bitcoin', '2011-01-01', 'bitcoin_2011-01-01')]
+    assert existing_rows == [['bitcoin', '2010-01-01', 'True', 'False', 'absolute', '0', 'False', 'False', '1']]
+
+    # A snapshot that has no row for some top limit of the sweep is analyzed again
+    get_top_limits_mock.return_value = [('absolute', 0), ('percentage', 0.5)]
+    jobs, existing_rows = plan_jobs(['bitcoin', 'ethereum'], ['2010-01-01', '2011-01-01', '2012-01-01'])
+    assert jobs == [(30, 'bitcoin', '2012-01-01', 'bitcoin_2012-01-01'),
+                    (20, 'bitcoin', '2010-01-01', 'bitcoin_2010-01-01'),
+                    (10, 'bitcoin', '2011-01-01', 'bitcoin_2011-01-01')]
+    assert existing_rows == []
 
-    is_file_mock = mocker.patch('os.path.isfile')
-    is_file_mock.side_effect = {
-        pathlib.Path('/bitcoin_2010-01-01_raw_data.csv').resolve(): True,
-        pathlib.Path('/ethereum_2010-01-01_raw_data.csv').resolve(): False,
-    }.get
 
+def test_analyze_ledger_snapshot(mocker):
     get_entries_mock = mocker.patch('tokenomics_decentralization.analyze.get_entries')
     entries = [1, 2]
     get_entries_mock.return_value = entries
 
-    analyze_snapshot_mock = mocker.patch('tokenomics_decentralization.analyze.analyze_snapshot')
-    analyze_snapshot_mock.return_value = {'hhi': 1}
+    get_top_limits_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limits')
+    get_top_limits_mock.return_value = [('absolute', 0), ('absolute', 1)]
+    get_balance_thresholds_mock = mocker.patch('tokenomics_decentralization.helper.get_balance_thresholds')
+    get_balance_thresholds_mock.return_value = [(False, False, 0), (False, False, 1.0)]
+    get_balance_threshold_value_mock = mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_value')
+    get_balance_threshold_value_mock.side_effect = lambda ledger, date, balance_threshold: balance_threshold[2] * 100
+
+    analyze_snapshot_mock = mocker.patch('tokenomics_decentralization.analyze.analyze_snapshot_sweep')
+    analyze_snapshot_mock.return_value = [{'hhi': 1}, {'top-1_absolute hhi': 2}, {'exclude_below_usd-1.0 hhi': 3},
+                                          {'top-1_absolute exclude_below_usd-1.0 hhi': 4}]
 
     get_output_row_mock = mocker.patch('tokenomics_decentralization.helper.get_output_row')
-    get_output_row_mock.return_value = 'row'
-
-    sema = Mock()
-
-    get_entries_calls = []
-    analyze_snapshot_calls = []
-    get_row_calls = []
-    sema_release_calls = []
-
-    analyze_ledger_snapshot('bitcoin', '2010-01-01', [], sema)
-    get_entries_calls.append(call('bitcoin', '2010-01-01', pathlib.Path('/bitcoin_2010-01-01_raw_data.csv').resolve()))
-    assert get_entries_mock.call_args_list == get_entries_calls
-    analyze_snapshot_calls.append(call(entries))
-    assert analyze_snapshot_mock.call_args_list == analyze_snapshot_calls
-    get_row_calls.append(call('bitcoin', '2010-01-01', {'hhi': 1}))
-    assert get_output_row_mock.call_args_list == get_row_calls
-    sema_release_calls.append(call())
-    assert sema.release.call_args_list == sema_release_calls
-
-    analyze_ledger_snapshot('ethereum', '2010-01-01', [], sema)
-    assert get_entries_mock.call_args_list == get_entries_calls
-    assert analyze_snapshot_mock.call_args_list == analyze_snapshot_calls
-    assert get_output_row_mock.call_args_list == get_row_calls
-    sema_release_calls.append(call())  # Test that semaphore release is called even if file does not exist
-    assert sema.release.call_args_list == sema_release_calls
+    get_output_row_mock.side_effect = lambda ledger, date, metrics, top_limit, balance_threshold: \
+        f'row {top_limit[1]} {balance_threshold[2]}'
+
+    rows = analyze_ledger_snapshot('bitcoin', '2010-01-01', 'bitcoin_2010-01-01_raw_data.csv')
+    assert rows == ['row 0 0', 'row 1 0', 'row 0 1.0', 'row 1 1.0']
+    assert get_entries_mock.call_args_list == [call('bitcoin', '2010-01-01', 'bitcoin_2010-01-01_raw_data.csv')]
+    assert analyze_snapshot_mock.call_args_list == [call(entries, [('absolute', 0), ('absolute', 1)],
+                                                         [((False, False, 0), 0), ((False, False, 1.0), 100.0)])]
+    assert get_output_row_mock.call_args_list[1] == call('bitcoin', '2010-01-01', {'top-1_absolute hhi': 2},
+                                                         ('absolute', 1), (False, False, 0))
+
+
+def test_get_worker_resource(mocker):
+    create_resource_mock = Mock()
+    create_resource_mock.return_value = 'connector'
+
+    assert get_worker_resource('key', create_resource_mock) == 'connector'
+    assert get_worker_resource('key', create_resource_mock) == 'connector'
+    assert len(create_resource_mock.call_args_list) == 2
+
+    mocker.patch('tokenomics_decentralization.analyze.worker_state', {})
+    assert get_worker_resource('key', create_resource_mock) == 'connector'
+    assert get_worker_resource('key', create_resource_mock) == 'connector'
+    assert len(create_resource_mock.call_args_list) == 3
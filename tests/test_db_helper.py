@@ -21,13 +21,9 @@ def setup_and_cleanup():
     os.remove(db_filename)
 
 
-def test_get_db_filename(mocker):
-    get_active_source_keywords_mock = mocker.patch("tokenomics_decentralization.helper.get_active_source_keywords")
-    get_active_source_keywords_mock.return_value = ['test']
-
-    filename = '_'.join(['bitcoin'] + ['test'])
+def test_get_db_filename():
     db_filename = db_hlp.get_db_filename('bitcoin')
-    assert db_filename == hlp.MAPPING_INFO_DIR / f'addresses/{filename}.db'
+    assert db_filename == hlp.MAPPING_INFO_DIR / 'addresses/bitcoin.db'
 
 
 def test_get_connector(setup_and_cleanup):
@@ -68,3 +64,96 @@ def test_get_address_entity(setup_and_cleanup):
     entity, is_contract = db_hlp.get_address_entity(conn, 'blah')
     assert entity == 'blah'
     assert is_contract == 0
+
+
+def test_get_addresses_entities(setup_and_cleanup):
+    db_filename = db_hlp.get_db_filename('test')
+    conn = db_hlp.get_connector(db_filename)
+    db_hlp.insert_mapping(conn, 'a1', 'e1', True)
+    db_hlp.insert_mapping(conn, 'a2', 'e2', False)
+    db_hlp.commit_database(conn)
+
+    entities = db_hlp.get_addresses_entities(conn, ['a1', 'blah', 'a2'])
+    assert entities == {'a1': ('e1', 1), 'a2': ('e2', 0)}
+
+    entities = db_hlp.get_addresses_entities(conn, ['blah'])
+    assert entities == {}
+
+
+def test_update_records(mocker, setup_and_cleanup):
+    mocker.patch('tokenomics_decentralization.db_helper.MAPPING_BATCH_SIZE', 2)
+
+    db_filename = db_hlp.get_db_filename('test')
+    conn = db_hlp.get_connector(db_filename)
+    db_hlp.set_loader_pragmas(conn)
+    assert conn.execute('PRAGMA synchronous').fetchone() == (0, )
+
+    assert db_hlp.get_record_hash(('a1', 'e1', 's1', True)) == db_hlp.get_record_hash(('a1', 'e1', 's1', 1))
+    assert db_hlp.get_record_hash(('a1', 'e1', 's1', True)) != db_hlp.get_record_hash(('a1', 'e1', 's1', False))
+
+    records = [('a1', 'e1', 's1', True), ('a2', 'e2', 's1', False), ('a3', 'e3', 's2', False)]
+    assert db_hlp.update_records(conn, iter(records)) is None
+    assert conn.execute('SELECT address, entity, source, is_contract FROM records ORDER BY address').fetchall() == [
+        ('a1', 'e1', 's1', 1), ('a2', 'e2', 's1', 0), ('a3', 'e3', 's2', 0)]
+
+    records = [('a1', 'e1', 's1', True), ('a2', 'e4', 's1', False), ('a3', 'e3', 's2', False), ('a2', 'e4', 's1', False)]
+    assert sorted(db_hlp.update_records(conn, iter(records))) == [('a2', 'e2', 's1'), ('a2', 'e4', 's1')]
+    assert conn.execute('SELECT address, entity FROM records ORDER BY address').fetchall() == [
+        ('a1', 'e1'), ('a2', 'e4'), ('a3', 'e3')]
+
+    assert db_hlp.update_records(conn, iter(records)) == []
+
+
+def test_clusters(setup_and_cleanup):
+    db_filename = db_hlp.get_db_filename('test')
+    conn = db_hlp.get_connector(db_filename)
+    db_hlp.update_records(conn, [('a1', 'e1', 's1', False), ('a1', 'e2', 's1', False), ('a2', 'e2', 's1', False),
+                                 ('a3', 'e3', 's1', False), ('a3', 'e4', 's2', False)])
+    db_hlp.select_sources(conn, 'c', ['s1'])
+
+    assert db_hlp.get_multi_entity_address_items(conn) == {'a1': {('e1', 's1'), ('e2', 's1')}, 'a3': {('e3', 's1')}}
+    assert db_hlp.get_multi_entity_address_items(conn, ['a2', 'a3']) == {'a3': {('e3', 's1')}}
+    assert db_hlp.get_items_addresses(conn, [('e2', 's1'), ('e4', 's1')]) == {'a1', 'a2'}
+    assert db_hlp.get_entities_addresses(conn, ['e2', 'e4']) == {'a1', 'a2'}
+
+    db_hlp.update_clusters(conn, {('e1', 's1'): 'c1', ('e2', 's1'): 'c1', ('e3', 's1'): 'c2'})
+    assert db_hlp.get_cluster_members(conn, [('e1', 's1')]) == {('e1', 's1'), ('e2', 's1')}
+    db_hlp.update_clusters(conn, {('e1', 's1'): 'c3'}, [('e1', 's1'), ('e2', 's1')])
+    assert db_hlp.get_cluster_members(conn, [('e1', 's1'), ('e3', 's1')]) == {('e1', 's1'), ('e3', 's1')}
+
+    # The clusters of another combination of sources are kept separately
+    db_hlp.select_sources(conn, 'c_other', ['s1', 's2'])
+    assert db_hlp.get_cluster_members(conn, [('e1', 's1')]) == set()
+    db_hlp.update_clusters(conn, {('e3', 's1'): 'c4', ('e4', 's2'): 'c4'})
+    assert db_hlp.get_cluster_members(conn, [('e3', 's1')]) == {('e3', 's1'), ('e4', 's2')}
+    db_hlp.select_sources(conn, 'c', ['s1'])
+    assert db_hlp.get_cluster_members(conn, [('e3', 's1')]) == {('e3', 's1')}
+
+
+def test_check_mapping_conflicts(setup_and_cleanup):
+    db_filename = db_hlp.get_db_filename('test')
+    conn = db_hlp.get_connector(db_filename)
+    db_hlp.update_records(conn, [('a1', 'e1', 's1', True), ('a1', 'e2', 's1', False), ('a2', 'e2', 's2', False),
+                                 ('a3', 'e3', 's1', False), ('a4', 'e4', 's2', False)])
+    db_hlp.select_sources(conn, 'c', ['s1', 's2'])
+    db_hlp.update_clusters(conn, {('e1', 's1'): 'c1', ('e2', 's1'): 'c1'})
+
+    db_hlp.check_mapping_conflicts(conn)
+    entities = db_hlp.get_addresses_entities(conn, ['a1', 'a2', 'a3', 'a4'])
+    assert entities == {'a1': ('c1', 1), 'a2': ('c1', 0), 'a3': ('e3', 0), 'a4': ('e4', 0)}
+    assert conn.execute('SELECT COUNT(*) FROM mapping').fetchone() == (4, )
+
+    # The mapping of a connection is resolved from the records of its selected sources only
+    db_hlp.select_sources(conn, 'c_s1', ['s1'])
+    entities = db_hlp.get_addresses_entities(conn, ['a1', 'a2', 'a3', 'a4'])
+    assert entities == {'a1': ('e1', 1), 'a3': ('e3', 0)}
+    with pytest.raises(ValueError):
+        db_hlp.check_mapping_conflicts(conn)
+    db_hlp.check_mapping_conflicts(conn, ['a2', 'a3'])
+
+    db_hlp.set_metadata(conn, 'fingerprint', 'test')
+    assert db_hlp.get_metadata(conn, 'fingerprint') == 'test'
+    assert db_hlp.get_metadata(conn, 'blah') is None
+    db_hlp.clear_mapping(conn)
+    assert db_hlp.get_metadata(conn, 'fingerprint') is None
+    assert db_hlp.get_addresses_entities(conn, ['a1']) == {}
@@ -1,9 +1,11 @@
 import tokenomics_decentralization.helper as hlp
 from collections import namedtuple
 import pathlib
+import numpy as np
 import os
 import datetime
 import pytest
+from unittest.mock import call
 
 
 def test_valid_date():
@@ -180,6 +182,9 @@ def test_config_flags(mocker):
     functions_to_test = [
         hlp.get_plot_flag,
         hlp.get_force_map_addresses_flag,
+        hlp.get_incremental_mapping_flag,
+        hlp.get_cache_snapshots_flag,
+        hlp.get_input_fingerprints_flag,
         hlp.get_clustering_flag,
         hlp.get_exclude_contracts_flag,
         hlp.get_exclude_below_fees_flag,
@@ -219,6 +224,13 @@ def test_get_metrics(mocker):
     with pytest.raises(ValueError):
         hlp.get_metrics()
 
+    get_config_mock.return_value = {'metrics': ['hhi', 'tau=0.5', 'tau_curve']}
+    metrics = hlp.get_metrics()
+    assert len(metrics) == 100
+    assert metrics[:3] == ['hhi', 'tau=0.5', 'tau=0.01']
+    assert metrics[-1] == 'tau=0.99'
+    assert hlp.get_tau_thresholds()[:3] == [0.5, 0.01, 0.02]
+
 
 def test_get_granularity(mocker):
     get_config_mock = mocker.patch("tokenomics_decentralization.helper.get_config_data")
@@ -294,11 +306,99 @@ def test_get_top_limit_value(mocker):
         hlp.get_top_limit_value()
 
 
+def test_get_top_limit_sweep(mocker):
+    get_config_mock = mocker.patch("tokenomics_decentralization.helper.get_config_data")
+
+    get_config_mock.return_value = {'analyze_flags': {'top_limit_sweep': None}}
+    assert hlp.get_top_limit_sweep() == []
+
+    get_config_mock.return_value = {'analyze_flags': {'top_limit_sweep': {'absolute': None, 'percentage': []}}}
+    assert hlp.get_top_limit_sweep() == []
+
+    get_config_mock.return_value = {'analyze_flags': {'top_limit_sweep': {'absolute': [0, 1000, 1000],
+                                                                          'percentage': [0.5, 1]}}}
+    assert hlp.get_top_limit_sweep() == [('absolute', 0), ('absolute', 1000), ('percentage', 0.5), ('percentage', 1)]
+
+    for top_limit_sweep in [{'absolute': [-1]}, {'absolute': [0.5]}, {'percentage': [1.5]}, {'relative': [1]}]:
+        get_config_mock.return_value = {'analyze_flags': {'top_limit_sweep': top_limit_sweep}}
+        with pytest.raises(ValueError):
+            hlp.get_top_limit_sweep()
+
+    get_config_mock.return_value = {'analyze_flags': {}}
+    with pytest.raises(ValueError):
+        hlp.get_top_limit_sweep()
+
+
+def test_get_top_limits(mocker):
+    mocker.patch('tokenomics_decentralization.helper.get_top_limit_type', return_value='percentage')
+    mocker.patch('tokenomics_decentralization.helper.get_top_limit_value', return_value=0.5)
+    get_top_limit_sweep_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_sweep')
+
+    get_top_limit_sweep_mock.return_value = []
+    assert hlp.get_top_limits() == [('percentage', 0.5)]
+
+    get_top_limit_sweep_mock.return_value = [('absolute', 0), ('absolute', 10)]
+    assert hlp.get_top_limits() == [('absolute', 0), ('absolute', 10)]
+
+
+def test_get_balance_threshold_sweep(mocker):
+    get_config_mock = mocker.patch("tokenomics_decentralization.helper.get_config_data")
+
+    get_config_mock.return_value = {'analyze_flags': {'balance_threshold_sweep': None}}
+    assert hlp.get_balance_threshold_sweep() == []
+
+    get_config_mock.return_value = {'analyze_flags': {'balance_threshold_sweep': ['none', 'fees', 'usd_cent', 1, 10.5,
+                                                                                  'fees']}}
+    assert hlp.get_balance_threshold_sweep() == [(False, False, 0), (True, False, 0), (False, True, 0),
+                                                 (False, False, 1.0), (False, False, 10.5)]
+
+    for balance_threshold_sweep in [['cents'], [0], [-1], [True]]:
+        get_config_mock.return_value = {'analyze_flags': {'balance_threshold_sweep': balance_threshold_sweep}}
+        with pytest.raises(ValueError):
+            hlp.get_balance_threshold_sweep()
+
+    get_config_mock.return_value = {'analyze_flags': {}}
+    with pytest.raises(ValueError):
+        hlp.get_balance_threshold_sweep()
+
+
+def test_get_balance_thresholds(mocker):
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_fees_flag', return_value=True)
+    mocker.patch('tokenomics_decentralization.helper.get_exclude_below_usd_cent_flag', return_value=False)
+    get_balance_threshold_sweep_mock = mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_sweep')
+
+    get_balance_threshold_sweep_mock.return_value = []
+    assert hlp.get_balance_thresholds() == [(True, False, 0)]
+
+    get_balance_threshold_sweep_mock.return_value = [(False, False, 0), (False, False, 1.0)]
+    assert hlp.get_balance_thresholds() == [(False, False, 0), (False, False, 1.0)]
+
+
+def test_get_balance_threshold_value(mocker):
+    get_median_tx_fee_mock = mocker.patch('tokenomics_decentralization.helper.get_median_tx_fee', return_value=30)
+    get_usd_cent_equivalent_mock = mocker.patch('tokenomics_decentralization.helper.get_usd_cent_equivalent',
+                                                return_value=20)
+
+    assert hlp.get_balance_threshold_value('bitcoin', '2010-01-01', (False, False, 0)) == 0
+    assert get_median_tx_fee_mock.call_count == get_usd_cent_equivalent_mock.call_count == 0
+    assert hlp.get_balance_threshold_value('bitcoin', '2010-01-01', (True, False, 0)) == 30
+    assert hlp.get_balance_threshold_value('bitcoin', '2010-01-01', (False, True, 0)) == 20
+    assert hlp.get_balance_threshold_value('bitcoin', '2010-01-01', (True, True, 0)) == 30
+    assert hlp.get_balance_threshold_value('bitcoin', '2010-01-01', (False, False, 10.0)) == 20000
+
+
 def test_get_circulation_from_entries():
     entries = [10, 11]
     circulation = hlp.get_circulation_from_entries(entries)
     assert circulation == 21
 
+    entries = np.array([2**62, 2**62, 2**62, 7], dtype=np.int64)
+    circulation = hlp.get_circulation_from_entries(entries)
+    assert circulation == 3 * 2**62 + 7
+
+    circulation = hlp.get_circulation_from_entries(np.array([], dtype=np.int64))
+    assert circulation == 0
+
 
 def test_get_special_addresses():
     ethereum_special_addresses = hlp.get_special_addresses('ethereum')
@@ -386,6 +486,17 @@ def test_get_output_row(mocker):
     csv_row = hlp.get_output_row('bitcoin', '2010-01-01', metrics)
     assert csv_row == ['bitcoin', '2010-01-01', False, True, 'absolute', 1, False, True, 1, 0]
 
+    # The top limit of a sweep is given explicitly
+    metrics = {'top-0.5_percentage exclude_below_usd_cent exclude_contracts non-clustered hhi': 1, 'top-0.5_percentage exclude_below_usd_cent exclude_contracts non-clustered gini': 0}
+    csv_row = hlp.get_output_row('bitcoin', '2010-01-01', metrics, ('percentage', 0.5))
+    assert csv_row == ['bitcoin', '2010-01-01', False, True, 'percentage', 0.5, False, True, 1, 0]
+
+    # The balance threshold of a sweep is given explicitly, with its USD amount in an additional column
+    mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_sweep', return_value=[(False, False, 1.0)])
+    metrics = {'exclude_below_usd-1.0 exclude_contracts non-clustered hhi': 1, 'exclude_below_usd-1.0 exclude_contracts non-clustered gini': 0}
+    csv_row = hlp.get_output_row('bitcoin', '2010-01-01', metrics, ('absolute', 0), (False, False, 1.0))
+    assert csv_row == ['bitcoin', '2010-01-01', False, True, 'absolute', 0, False, False, 1.0, 1, 0]
+
 
 def test_get_output_filename(mocker):
     get_output_directory_mock = mocker.patch('tokenomics_decentralization.helper.get_output_directory')
@@ -400,6 +511,10 @@ def test_get_output_filename(mocker):
     get_top_limit_type_mock.return_value = 'absolute'
     get_top_limit_value_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_value')
     get_top_limit_value_mock.return_value = 0
+    get_top_limit_sweep_mock = mocker.patch('tokenomics_decentralization.helper.get_top_limit_sweep')
+    get_top_limit_sweep_mock.return_value = []
+    get_balance_threshold_sweep_mock = mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_sweep')
+    get_balance_threshold_sweep_mock.return_value = []
 
     output_filename = hlp.get_output_filename()
     assert output_filename == pathlib.Path(__file__).resolve().parent / 'output.csv'
@@ -412,6 +527,14 @@ def test_get_output_filename(mocker):
     output_filename = hlp.get_output_filename()
     assert output_filename == pathlib.Path(__file__).resolve().parent / 'output-exclude_contract_addresses-absolute_10-exclude_below_fees-exclude_below_usd_cent.csv'
 
+    get_top_limit_sweep_mock.return_value = [('absolute', 0), ('absolute', 1000), ('percentage', 0.5)]
+    output_filename = hlp.get_output_filename()
+    assert output_filename == pathlib.Path(__file__).resolve().parent / 'output-exclude_contract_addresses-top_limit_sweep-exclude_below_fees-exclude_below_usd_cent.csv'
+
+    get_balance_threshold_sweep_mock.return_value = [(False, False, 0), (True, False, 0)]
+    output_filename = hlp.get_output_filename()
+    assert output_filename == pathlib.Path(__file__).resolve().parent / 'output-exclude_contract_addresses-top_limit_sweep-balance_threshold_sweep.csv'
+
 
 def test_write_csv_output(mocker):
     get_metrics_mock = mocker.patch('tokenomics_decentralization.helper.get_metrics')
@@ -433,6 +556,14 @@ def test_write_csv_output(mocker):
                                      '100']) + '\n'
         assert lines[2] == ','.join(['ethereum', '2010-01-01', 'True', 'False', 'absolute', '0', 'False', 'False',
                                      '200']) + '\n'
+
+    # The output of a balance threshold sweep has a column of the USD amount of each threshold
+    mocker.patch('tokenomics_decentralization.helper.get_balance_threshold_sweep', return_value=[(False, False, 1.0)])
+    hlp.write_csv_output([['bitcoin', '2010-01-01', True, False, 'absolute', 0, False, False, 1.0, 100]])
+    with open(pathlib.Path(__file__).resolve().parent / 'output.csv') as f:
+        assert f.readline() == ','.join(['ledger', 'snapshot_date', 'clustering', 'exclude_contract_addresses',
+                                         'top_limit_type', 'top_limit_value', 'exclude_below_fees',
+                                         'exclude_below_usd_cent', 'exclude_below_usd', 'hhi']) + '\n'
     os.remove(pathlib.Path(__file__).resolve().parent / 'output.csv')
 
 
@@ -455,41 +586,251 @@ def test_get_active_sources(mocker):
     assert active_sources == set(['test1', 'test11'])
 
 
-def test_get_clusters(mocker):
-    mocker.patch('builtins.open', mocker.mock_open(
-        read_data='{"name": "entity1", "address": "addr1", "source": "test"}\n{"name": "entity2", "address": "addr2", "source": "test"}\n{"name": "entity3", "address": "addr2", "source": "test2"}\n{"name": "entity3", "address": "addr1", "source": "test2"}\n{"name": "entity4", "address": "addr4", "source": "test"}\n{"name": "entity5", "address": "addr4", "source": "test2"}\n{"name": "entity6", "address": "addr6", "source": "test"}\n{"name": "entity7", "address": "addr1", "source": "test3"}'
-    ))
-
-    get_active_sources_mock = mocker.patch("tokenomics_decentralization.helper.get_active_sources")
-    get_active_sources_mock.return_value = ['test', 'test2']
-
-    clusters = hlp.get_clusters('bitcoin')
-    assert clusters['entity1'] == clusters['entity2']
-    assert clusters['entity1'] == clusters['entity3']
-    assert clusters['entity4'] == clusters['entity5']
-    assert 'entity7' not in clusters.keys()
+def test_get_entity_clusters():
+    address_entities = {
+        'addr1': {('entity1', 'test'), ('entity3', 'test2')},
+        'addr2': {('entity2', 'test'), ('entity3', 'test2')},
+        'addr4': {('entity4', 'test'), ('entity5', 'test2')},
+        'addr6': {('entity6', 'test')},  # the address's other entities are from inactive sources
+    }
+    entity_clusters = hlp.get_entity_clusters(address_entities)
+    assert entity_clusters[('entity1', 'test')] == entity_clusters[('entity2', 'test')]
+    assert entity_clusters[('entity1', 'test')] == entity_clusters[('entity3', 'test2')]
+    assert entity_clusters[('entity4', 'test')] == entity_clusters[('entity5', 'test2')]
+    assert entity_clusters[('entity1', 'test')] != entity_clusters[('entity4', 'test')]
+    assert ('entity6', 'test') not in entity_clusters.keys()
+
+    # Chains of shared addresses are merged transitively and clusters are named after their smallest item
+    address_entities = {
+        'addr1': {('entity9', 'test'), ('entity8', 'test')},
+        'addr2': {('entity8', 'test'), ('entity1', 'test')},
+        'addr3': {('entity0', 'test'), ('entity5', 'test')},
+    }
+    entity_clusters = hlp.get_entity_clusters(address_entities)
+    cluster_1, cluster_2 = hlp.get_cluster_name(('entity0', 'test')), hlp.get_cluster_name(('entity1', 'test'))
+    assert entity_clusters == {('entity0', 'test'): cluster_1, ('entity5', 'test'): cluster_1,
+                               ('entity1', 'test'): cluster_2, ('entity8', 'test'): cluster_2,
+                               ('entity9', 'test'): cluster_2}
+    assert cluster_1 != cluster_2 and cluster_1.startswith('-++-') and cluster_1.endswith('-++-')
+
+
+def test_union_clusters():
+    parents = {item: item for item in range(6)}
+    hlp.union_clusters(parents, 0, 1)
+    hlp.union_clusters(parents, 2, 3)
+    hlp.union_clusters(parents, 1, 3)
+    hlp.union_clusters(parents, 3, 0)
+
+    roots = [hlp.find_cluster_root(parents, item) for item in range(6)]
+    assert len(set(roots[:4])) == 1
+    assert roots[4] == 4 and roots[5] == 5
+    # Paths are compressed, i.e. every item of the cluster points directly to the root
+    assert all(parents[item] == roots[0] for item in range(4))
 
 
 def test_get_concurrency_per_ledger(mocker):
     psutil_memory_mock = mocker.patch('psutil.virtual_memory')
     psutil_memory_mock.return_value = namedtuple('VM', 'total')(10*10**9)
 
-    get_input_directories_mock = mocker.patch('tokenomics_decentralization.helper.get_input_directories')
-    get_input_directories_mock.return_value = [pathlib.Path('/').resolve()]
+    cpu_count_mock = mocker.patch('os.cpu_count')
+    cpu_count_mock.return_value = 16
+
+    get_out_of_core_memory_budget_mock = mocker.patch('tokenomics_decentralization.helper.get_out_of_core_memory_budget')
+    get_out_of_core_memory_budget_mock.return_value = None
+
+    get_parse_workers_mock = mocker.patch('tokenomics_decentralization.helper.get_parse_workers')
+    get_parse_workers_mock.return_value = 1
 
     get_ledgers_mock = mocker.patch('tokenomics_decentralization.helper.get_ledgers')
     get_ledgers_mock.return_value = ['bitcoin', 'ethereum']
 
-    os_walk_mock = mocker.patch('os.walk')
-    os_walk_mock.return_value = [('/', 'foo', ['bitcoin_2010-01-01_raw_data.csv'])]
+    get_input_catalog_mock = mocker.patch('tokenomics_decentralization.helper.get_input_catalog')
+    get_input_catalog_mock.return_value = {('bitcoin', '2010-01-01'): {'path': 'b1.csv', 'size': 10*10**8},
+                                           ('bitcoin', '2011-01-01'): {'path': 'b2.csv', 'size': 10**8}}
 
-    os_stat_mock = mocker.patch('os.stat')
-    os_stat_mock.return_value = namedtuple('ST', 'st_size')(10*10**8)
+    concurrency = hlp.get_concurrency_per_ledger()
+    assert concurrency == {'bitcoin': 6, 'ethereum': 1}
 
+    cpu_count_mock.return_value = 4
     concurrency = hlp.get_concurrency_per_ledger()
-    assert concurrency == {'bitcoin': 3, 'ethereum': 1}
+    assert concurrency == {'bitcoin': 4, 'ethereum': 1}
 
-    os_stat_mock.return_value = namedtuple('ST', 'st_size')(5*10**9)
+    get_input_catalog_mock.return_value = {('bitcoin', '2010-01-01'): {'path': 'b1.csv', 'size': 10*10**9}}
 
     with pytest.raises(ValueError):
         hlp.get_concurrency_per_ledger()
+
+    # Files that are aggregated out of core need only as much memory as the budget
+    get_out_of_core_memory_budget_mock.return_value = 2 * 10**9
+    concurrency = hlp.get_concurrency_per_ledger()
+    assert concurrency == {'bitcoin': 4, 'ethereum': 1}
+
+    # The CPUs are divided between the parse workers of the processes, whose parts also need memory
+    get_parse_workers_mock.return_value = 2
+    cpu_count_mock.return_value = 16
+    get_input_catalog_mock.return_value = {('bitcoin', '2010-01-01'): {'path': 'b1.csv', 'size': 10**8}}
+    concurrency = hlp.get_concurrency_per_ledger()
+    assert concurrency == {'bitcoin': 8, 'ethereum': 1}
+    get_input_catalog_mock.return_value = {('bitcoin', '2010-01-01'): {'path': 'b1.csv', 'size': 10**9}}
+    concurrency = hlp.get_concurrency_per_ledger()
+    assert concurrency == {'bitcoin': 1, 'ethereum': 1}
+
+
+def test_get_out_of_core_memory_budget(mocker):
+    get_config_mock = mocker.patch('tokenomics_decentralization.helper.get_config_data')
+
+    get_config_mock.return_value = {'execution_flags': {'out_of_core_memory_budget': None}}
+    assert hlp.get_out_of_core_memory_budget() is None
+
+    get_config_mock.return_value = {'execution_flags': {'out_of_core_memory_budget': 1500}}
+    assert hlp.get_out_of_core_memory_budget() == 1500 * 10**6
+
+    get_config_mock.return_value = {'execution_flags': {'out_of_core_memory_budget': 0}}
+    with pytest.raises(ValueError):
+        hlp.get_out_of_core_memory_budget()
+
+    get_config_mock.return_value = {'execution_flags': {}}
+    with pytest.raises(ValueError):
+        hlp.get_out_of_core_memory_budget()
+
+
+def test_get_mapping_filter_false_positive_rate(mocker):
+    get_config_mock = mocker.patch('tokenomics_decentralization.helper.get_config_data')
+
+    get_config_mock.return_value = {'execution_flags': {'mapping_filter_false_positive_rate': None}}
+    assert hlp.get_mapping_filter_false_positive_rate() is None
+
+    get_config_mock.return_value = {'execution_flags': {'mapping_filter_false_positive_rate': 0.01}}
+    assert hlp.get_mapping_filter_false_positive_rate() == 0.01
+
+    for false_positive_rate in [0, 1, -0.5]:
+        get_config_mock.return_value = {'execution_flags': {'mapping_filter_false_positive_rate': false_positive_rate}}
+        with pytest.raises(ValueError):
+            hlp.get_mapping_filter_false_positive_rate()
+
+    get_config_mock.return_value = {'execution_flags': {}}
+    with pytest.raises(ValueError):
+        hlp.get_mapping_filter_false_positive_rate()
+
+
+def test_get_parse_workers(mocker):
+    get_config_mock = mocker.patch('tokenomics_decentralization.helper.get_config_data')
+    mocker.patch('os.cpu_count', return_value=16)
+
+    get_config_mock.return_value = {'execution_flags': {'parse_workers': None}}
+    assert hlp.get_parse_workers() == 1
+
+    get_config_mock.return_value = {'execution_flags': {'parse_workers': 4}}
+    assert hlp.get_parse_workers() == 4
+
+    for parse_workers in [0, -1, 2.5]:
+        get_config_mock.return_value = {'execution_flags': {'parse_workers': parse_workers}}
+        with pytest.raises(ValueError):
+            hlp.get_parse_workers()
+
+    get_config_mock.return_value = {'execution_flags': {}}
+    with pytest.raises(ValueError):
+        hlp.get_parse_workers()
+
+
+def test_read_csv_output(mocker):
+    get_output_filename_mock = mocker.patch('tokenomics_decentralization.helper.get_output_filename')
+    get_output_filename_mock.return_value = pathlib.Path(__file__).resolve().parent / 'output.csv'
+
+    assert hlp.read_csv_output() == {}
+
+    with open(pathlib.Path(__file__).resolve().parent / 'output.csv', 'w') as f:
+        f.write('ledger,snapshot_date,hhi\nbitcoin,2010-01-01,100\nethereum,2010-01-01,200\n')
+    assert hlp.read_csv_output() == {
+        ('bitcoin', '2010-01-01'): [['bitcoin', '2010-01-01', '100']],
+        ('ethereum', '2010-01-01'): [['ethereum', '2010-01-01', '200']],
+    }
+
+    # The output of a top limit sweep has multiple rows per snapshot
+    with open(pathlib.Path(__file__).resolve().parent / 'output.csv', 'w') as f:
+        f.write('ledger,snapshot_date,hhi\nbitcoin,2010-01-01,100\nbitcoin,2010-01-01,300\n')
+    assert hlp.read_csv_output() == {
+        ('bitcoin', '2010-01-01'): [['bitcoin', '2010-01-01', '100'], ['bitcoin', '2010-01-01', '300']],
+    }
+    os.remove(pathlib.Path(__file__).resolve().parent / 'output.csv')
+
+
+def test_get_input_catalog(mocker, tmp_path):
+    mocker.patch('tokenomics_decentralization.helper.input_catalog', None)
+    get_input_directories_mock = mocker.patch('tokenomics_decentralization.helper.get_input_directories')
+    get_input_directories_mock.return_value = [tmp_path / 'a', tmp_path / 'b']
+    get_catalog_filename_mock = mocker.patch('tokenomics_decentralization.helper.get_input_catalog_filename')
+    get_catalog_filename_mock.return_value = tmp_path / 'output' / 'input_catalog.json'
+    get_input_fingerprints_mock = mocker.patch('tokenomics_decentralization.helper.get_input_fingerprints_flag')
+    get_input_fingerprints_mock.return_value = False
+
+    (tmp_path / 'a' / 'sub' / 'cache').mkdir(parents=True)
+    (tmp_path / 'b').mkdir()
+    for filename, content in [('a/bitcoin_2010-01-01_raw_data.csv', 'address,balance\n'),
+                              ('a/sub/bitcoin_cash_2010-01-01_raw_data.csv', 'address,balance\naddr1,1\n'),
+                              ('a/sub/cache/bitcoin_2011-01-01_raw_data.csv', ''),
+                              ('a/notes.txt', ''),
+                              ('b/bitcoin_2010-01-01_raw_data.csv', 'address,balance\naddr1,1\n'),
+                              ('b/ethereum_2010-01-01_raw_data.csv', 'address,balance\naddr1,1\n')]:
+        with open(tmp_path / filename, 'w') as f:
+            f.write(content)
+
+    catalog = hlp.get_input_catalog()
+    assert sorted(catalog.keys()) == [('bitcoin', '2010-01-01'), ('bitcoin_cash', '2010-01-01'),
+                                      ('ethereum', '2010-01-01')]
+    assert catalog[('bitcoin', '2010-01-01')]['path'] == tmp_path / 'a' / 'bitcoin_2010-01-01_raw_data.csv'
+    assert catalog[('bitcoin', '2010-01-01')]['size'] == 16
+    assert catalog[('bitcoin_cash', '2010-01-01')]['fingerprint'] is None
+    assert os.path.isfile(tmp_path / 'output' / 'input_catalog.json')
+
+    # The catalog is loaded once per execution
+    assert hlp.get_input_catalog() is catalog
+
+    # Unchanged folders are served from the stored catalog without listing them
+    mocker.patch('tokenomics_decentralization.helper.input_catalog', None)
+    with open(tmp_path / 'b' / 'bitcoin_2011-01-01_raw_data.csv', 'w') as f:
+        f.write('address,balance\n')
+    os_scandir_spy = mocker.spy(os, 'scandir')
+    catalog = hlp.get_input_catalog()
+    assert os_scandir_spy.call_args_list == [call(str(tmp_path / 'b'))]
+    assert ('bitcoin', '2011-01-01') in catalog
+
+    mocker.patch('tokenomics_decentralization.helper.input_catalog', None)
+    get_input_fingerprints_mock.return_value = True
+    catalog = hlp.get_input_catalog()
+    assert catalog[('ethereum', '2010-01-01')]['fingerprint'] == hlp.get_input_fingerprint(
+        tmp_path / 'b' / 'ethereum_2010-01-01_raw_data.csv', 24)
+    assert catalog[('ethereum', '2010-01-01')]['fingerprint'] != catalog[('bitcoin', '2010-01-01')]['fingerprint']
+
+    assert catalog[('ethereum', '2010-01-01')]['path'] == tmp_path / 'b' / 'ethereum_2010-01-01_raw_data.csv'
+    assert ('ethereum', '2011-01-01') not in catalog
+
+    # The shards of a snapshot are combined to a single entry, unless the snapshot also has an unsharded file
+    mocker.patch('tokenomics_decentralization.helper.input_catalog', None)
+    for filename in ['b/ethereum_2011-01-01_raw_data_000.csv', 'b/ethereum_2011-01-01_raw_data_001.csv',
+                     'b/bitcoin_2011-01-01_raw_data_000.csv']:
+        with open(tmp_path / filename, 'w') as f:
+            f.write('address,balance\naddr1,1\n')
+    catalog = hlp.get_input_catalog()
+    assert catalog[('ethereum', '2011-01-01')]['path'] == tmp_path / 'b' / 'ethereum_2011-01-01_raw_data_*.csv'
+    assert catalog[('ethereum', '2011-01-01')]['size'] == 48
+    assert catalog[('ethereum', '2011-01-01')]['fingerprint'] is not None
+    assert catalog[('bitcoin', '2011-01-01')]['path'] == tmp_path / 'b' / 'bitcoin_2011-01-01_raw_data.csv'
+
+    # Compressed files are catalogued, but an uncompressed file of the same snapshot takes precedence
+    mocker.patch('tokenomics_decentralization.helper.input_catalog', None)
+    for filename in ['b/ethereum_2012-01-01_raw_data.csv.gz', 'b/bitcoin_2010-01-01_raw_data.csv.zst',
+                     'b/tezos_2010-01-01_raw_data_0.csv.xz', 'b/tezos_2010-01-01_raw_data_1.csv.xz']:
+        with open(tmp_path / filename, 'w') as f:
+            f.write('compressed')
+    catalog = hlp.get_input_catalog()
+    assert catalog[('ethereum', '2012-01-01')]['path'] == tmp_path / 'b' / 'ethereum_2012-01-01_raw_data.csv.gz'
+    assert catalog[('tezos', '2010-01-01')]['path'] == tmp_path / 'b' / 'tezos_2010-01-01_raw_data_*.csv.xz'
+    assert catalog[('bitcoin', '2010-01-01')]['path'] == tmp_path / 'a' / 'bitcoin_2010-01-01_raw_data.csv'
+
+
+def test_get_input_data_size():
+    assert hlp.get_input_data_size('bitcoin_2010-01-01_raw_data.csv', 100) == 100
+    assert hlp.get_input_data_size('bitcoin_2010-01-01_raw_data.csv.gz', 100) == 1000
+    assert hlp.get_input_data_size('bitcoin_2010-01-01_raw_data_*.csv.zst', 100) == 1000
+    assert hlp.get_input_data_size('bitcoin_2010-01-01_raw_data_*.csv*', 100) == 100
@@ -0,0 +1,118 @@
+import tokenomics_decentralization.index_helper as idx_hlp
+import tokenomics_decentralization.db_helper as db_hlp
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def mapping_db(mocker, tmp_path):
+    """
+    Sets up a mapping db of the ledger "bitcoin" in a temporary mapping information directory
+    """
+    mocker.patch('tokenomics_decentralization.helper.MAPPING_INFO_DIR', tmp_path)
+    (tmp_path / 'addresses').mkdir()
+    conn = db_hlp.get_connector(db_hlp.get_db_filename('bitcoin'))
+    db_hlp.update_records(conn, [('addr1', 'entity1', 's1', False), ('addr2', 'entity2', 's1', True),
+                                 ('addr3', 'entity1', 's1', False), ('addr4', 'entity3', 's2', False),
+                                 ('addr5', 'ëntity4', 's1', True)])
+    db_hlp.select_sources(conn, 'c', ['s1'])
+    db_hlp.update_clusters(conn, {('entity2', 's1'): 'cluster'})
+    db_hlp.commit_database(conn)
+    yield conn
+    conn.close()
+
+
+def test_get_address_fingerprints():
+    keys, tags = idx_hlp.get_address_fingerprints(['addr1', 'addr2', 'addr1'])
+    assert keys.dtype == np.uint64 and tags.dtype == np.uint32
+    assert keys[0] == keys[2] and tags[0] == tags[2]
+    assert keys[0] != keys[1]
+
+    keys, tags = idx_hlp.get_address_fingerprints([])
+    assert len(keys) == 0 and len(tags) == 0
+
+
+def test_build_mapping_index(mocker, mapping_db):
+    mocker.patch('tokenomics_decentralization.index_helper.INDEX_BATCH_SIZE', 2)
+
+    assert not idx_hlp.is_mapping_index_fresh('bitcoin', 'c')
+    assert idx_hlp.load_mapping_index('bitcoin', 'c') is None
+
+    idx_hlp.build_mapping_index(mapping_db, 'bitcoin', 'c')
+    assert idx_hlp.is_mapping_index_fresh('bitcoin', 'c')
+    index = idx_hlp.load_mapping_index('bitcoin', 'c')
+    assert index['num_hashes'] > 0
+    assert not index['keys'].flags.writeable
+    assert np.all(index['keys'][:-1] <= index['keys'][1:])
+    assert len(index['keys']) == 4
+
+    addresses = ['addr1', 'addr2', 'addr3', 'addr4', 'addr5', 'addr6']
+    expected_entities = db_hlp.get_addresses_entities(mapping_db, addresses)
+    assert expected_entities == {'addr1': ('entity1', 0), 'addr2': ('cluster', 1), 'addr3': ('entity1', 0),
+                                 'addr5': ('ëntity4', 1)}
+    assert idx_hlp.get_addresses_entities(index, addresses) == expected_entities
+    assert idx_hlp.get_addresses_entities(index, []) == {}
+    assert index['lookup_stats']['lookups'] == 6
+    assert index['lookup_stats']['skipped_lookups'] in [1, 2]
+
+    # The index is stale if the false positive rate of the filter changes
+    get_false_positive_rate_mock = mocker.patch('tokenomics_decentralization.helper.get_mapping_filter_false_positive_rate')
+    get_false_positive_rate_mock.return_value = None
+    assert not idx_hlp.is_mapping_index_fresh('bitcoin', 'c')
+    idx_hlp.build_mapping_index(mapping_db, 'bitcoin', 'c')
+    index = idx_hlp.load_mapping_index('bitcoin', 'c')
+    assert index['num_hashes'] == 0
+    assert idx_hlp.get_addresses_entities(index, addresses) == expected_entities
+    assert index['lookup_stats'] == {'lookups': 6, 'skipped_lookups': 0}
+
+    # The index is stale after the db changes
+    db_hlp.insert_mapping(mapping_db, 'addr6', 'entity5', False, 's1')
+    db_hlp.commit_database(mapping_db)
+    assert not idx_hlp.is_mapping_index_fresh('bitcoin', 'c')
+    idx_hlp.build_mapping_index(mapping_db, 'bitcoin', 'c')
+    index = idx_hlp.load_mapping_index('bitcoin', 'c')
+    assert idx_hlp.get_addresses_entities(index, ['addr6']) == {'addr6': ('entity5', 0)}
+    assert [path.name for path in (idx_hlp.get_index_dir('bitcoin', 'c')).parent.iterdir()] == ['bitcoin_c']
+
+
+def test_get_addresses_entities_key_collision(mocker):
+    # Three mapped addresses whose keys collide and an unmapped address with the same key
+    fingerprints = {'addr1': (5, 1), 'addr2': (5, 2), 'addr3': (5, 3), 'addr4': (5, 4), 'addr5': (9, 1)}
+
+    def get_address_fingerprints(addresses):
+        return (np.array([fingerprints[address][0] for address in addresses], dtype=np.uint64),
+                np.array([fingerprints[address][1] for address in addresses], dtype=np.uint32))
+
+    mocker.patch('tokenomics_decentralization.index_helper.get_address_fingerprints', get_address_fingerprints)
+    index = {
+        'keys': np.array([5, 5, 5, 9], dtype=np.uint64),
+        'tags': np.array([1, 2, 3, 1], dtype=np.uint32),
+        'entity_ids': np.array([0, 1, 0, 1], dtype=np.uint32),
+        'contracts': np.packbits([False, True, False, False]),
+        'entity_offsets': np.array([0, 2, 4]),
+        'entity_names': np.frombuffer(b'e1e2', dtype=np.uint8),
+        'filter': np.array([], dtype=np.uint8),
+        'num_hashes': 0,
+        'entity_cache': {},
+        'lookup_stats': {'lookups': 0, 'skipped_lookups': 0},
+    }
+    entities = idx_hlp.get_addresses_entities(index, ['addr4', 'addr3', 'addr2', 'addr5', 'addr1'])
+    assert entities == {'addr1': ('e1', 0), 'addr2': ('e2', 1), 'addr3': ('e1', 0), 'addr5': ('e2', 0)}
+    assert index['lookup_stats'] == {'lookups': 5, 'skipped_lookups': 0}
+
+
+def test_get_filter_parameters():
+    assert idx_hlp.get_filter_parameters(1000, 0.01) == (9592, 7)
+    assert idx_hlp.get_filter_parameters(0, 0.01) == (64, 7)
+
+
+def test_filter():
+    keys, tags = idx_hlp.get_address_fingerprints([f'addr{idx}' for idx in range(20000)])
+    bloom_filter, num_hashes = idx_hlp.build_filter(keys[:10000], tags[:10000], 0.01)
+    assert num_hashes == 7
+    assert bloom_filter.dtype == np.uint8 and len(bloom_filter) * 8 == 95856
+
+    contained = idx_hlp.filter_contains(bloom_filter, num_hashes, keys, tags)
+    # No false negatives and (approximately) the target rate of false positives
+    assert contained[:10000].all()
+    assert 0.005 < contained[10000:].mean() < 0.02
@@ -1,96 +1,241 @@
 from tokenomics_decentralization.map import apply_mapping
-from unittest.mock import call
-
+import tokenomics_decentralization.helper as hlp
+import tokenomics_decentralization.db_helper as db_hlp
+import tokenomics_decentralization.index_helper as idx_hlp
+import json
+import os
+import sqlite3
+import pytest
+
+
+@pytest.fixture
+def mapping_dir(mocker, tmp_path):
+    """
+    Sets up a mapping information directory with a single active source ("test") in a temporary directory
+    """
+    mocker.patch('tokenomics_decentralization.helper.MAPPING_INFO_DIR', tmp_path)
+    (tmp_path / 'addresses').mkdir()
+    get_active_sources_mock = mocker.patch('tokenomics_decentralization.helper.get_active_sources')
+    get_active_sources_mock.return_value = {'test'}
+    get_source_combination_mock = mocker.patch('tokenomics_decentralization.helper.get_source_combination')
+    get_source_combination_mock.return_value = 'Test'
+    return tmp_path
 
-def test_apply_mapping(mocker):
-    get_db_connector_mock = mocker.patch('tokenomics_decentralization.db_helper.get_connector')
-    get_db_connector_mock.return_value = 'connector'
-    commit_database_mock = mocker.patch('tokenomics_decentralization.db_helper.commit_database')
 
-    insert_mapping_mock = mocker.patch('tokenomics_decentralization.db_helper.insert_mapping')
+def write_mapping(mapping_dir, lines):
+    filename = mapping_dir / 'addresses/bitcoin.jsonl'
+    previous_stat = os.stat(filename) if filename.is_file() else None
+    with open(filename, 'w') as f:
+        for line in lines:
+            f.write(json.dumps(line) + '\n')
+    if previous_stat is not None:  # Make sure that the change is visible even on filesystems with coarse timestamps
+        os.utime(filename, ns=(previous_stat.st_atime_ns, previous_stat.st_mtime_ns + 10**9))
 
-    get_clusters_mock = mocker.patch('tokenomics_decentralization.helper.get_clusters')
-    get_clusters_mock.return_value = {'entity2': 'cluster'}
 
-    get_active_sources_mock = mocker.patch('tokenomics_decentralization.helper.get_active_sources')
-    get_active_sources_mock.return_value = ['test']
+def get_mapping(mapping_dir, combination='Test', sources=('test', )):
+    conn = db_hlp.get_connector(mapping_dir / 'addresses/bitcoin.db')
+    db_hlp.select_sources(conn, combination, sources)
+    mapping = {address: (entity, is_contract) for address, entity, is_contract in
+               conn.execute('SELECT address, entity, is_contract FROM mapping').fetchall()}
+    conn.close()
+    return mapping
 
-    get_db_filename_mock = mocker.patch('tokenomics_decentralization.db_helper.get_db_filename')
-    db_filename = 'bitcoin_Test.db'
-    get_db_filename_mock.return_value = db_filename
-
-    os_isfile_mock = mocker.patch('os.path.isfile')
-    os_isfile_mock.side_effect = {
-        db_filename: True
-    }.get
 
+def test_apply_mapping(mocker, mapping_dir):
     get_force_map_addresses_mock = mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag')
-
     get_force_map_addresses_mock.return_value = False
+    get_incremental_mapping_mock = mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag')
+    get_incremental_mapping_mock.return_value = False
 
-    get_db_connector_calls = []
-    insert_mapping_calls = []
-    commit_db_calls = []
+    # Test normal mapping insertion and ignoring non-active source
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity3', 'address': 'addr3', 'source': 'other'}])
+    apply_mapping('bitcoin')
+    assert get_mapping(mapping_dir) == {'addr1': ('entity1', 0)}
 
+    # Test that an existing mapping is not updated without the force map or incremental flag
+    write_mapping(mapping_dir, [{'name': 'entity2', 'address': 'addr1', 'source': 'test'}])
     apply_mapping('bitcoin')
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
+    assert get_mapping(mapping_dir) == {'addr1': ('entity1', 0)}
 
-    os_isfile_mock.side_effect = {
-        db_filename: False
-    }.get
+    # Test force map flag
+    get_force_map_addresses_mock.return_value = True
+    apply_mapping('bitcoin')
+    assert get_mapping(mapping_dir) == {'addr1': ('entity2', 0)}
 
-    # Test normal mapping insertion
-    mocker.patch('builtins.open', mocker.mock_open(read_data='{"name": "entity1", "address": "addr1", "source": "test"}'))
+    # Test cluster
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr1', 'source': 'test', 'is_contract': True},
+                                {'name': 'entity2', 'address': 'addr2', 'source': 'test'},
+                                {'name': 'entity3', 'address': 'addr1', 'source': 'other'}])
+    apply_mapping('bitcoin')
+    cluster_name = hlp.get_cluster_name(('entity1', 'test'))
+    assert get_mapping(mapping_dir) == {'addr1': (cluster_name, 0), 'addr2': (cluster_name, 0)}
 
+    # Test is_contract
+    write_mapping(mapping_dir, [{'name': 'entity2', 'address': 'addr1', 'source': 'test', 'is_contract': True}])
     apply_mapping('bitcoin')
-    get_db_connector_calls.append(call(db_filename))
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
-    insert_mapping_calls.append(call('connector', 'addr1', 'entity1', False))
-    assert insert_mapping_mock.call_args_list == insert_mapping_calls
-    commit_db_calls.append(call('connector'))
-    assert commit_database_mock.call_args_list == commit_db_calls
+    assert get_mapping(mapping_dir) == {'addr1': ('entity2', 1)}
 
-    # Test ignoring non-active source
-    mocker.patch('builtins.open', mocker.mock_open(read_data='{"name": "entity1", "address": "addr1", "source": "other"}'))
 
+def test_apply_mapping_incremental(mocker, mapping_dir):
+    get_force_map_addresses_mock = mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag')
+    get_incremental_mapping_mock = mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag')
+    get_incremental_mapping_mock.return_value = True
+    read_mapping_information_spy = mocker.spy(hlp, 'read_mapping_information')
+
+    mapping_versions = [
+        [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+         {'name': 'entity2', 'address': 'addr2', 'source': 'test'},
+         {'name': 'entity3', 'address': 'addr2', 'source': 'test'},
+         {'name': 'entity3', 'address': 'addr3', 'source': 'test'},
+         {'name': 'entity4', 'address': 'addr4', 'source': 'test'},
+         {'name': 'entity5', 'address': 'addr5', 'source': 'other'}],
+        # Merge two clusters
+        [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+         {'name': 'entity2', 'address': 'addr2', 'source': 'test'},
+         {'name': 'entity3', 'address': 'addr2', 'source': 'test'},
+         {'name': 'entity3', 'address': 'addr3', 'source': 'test'},
+         {'name': 'entity4', 'address': 'addr4', 'source': 'test'},
+         {'name': 'entity5', 'address': 'addr5', 'source': 'other'},
+         {'name': 'entity4', 'address': 'addr3', 'source': 'test'},
+         {'name': 'entity6', 'address': 'addr6', 'source': 'test', 'is_contract': True}],
+        # Split a cluster and remove an address
+        [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+         {'name': 'entity2', 'address': 'addr2', 'source': 'test'},
+         {'name': 'entity3', 'address': 'addr3', 'source': 'test'},
+         {'name': 'entity4', 'address': 'addr3', 'source': 'test'},
+         {'name': 'entity4', 'address': 'addr4', 'source': 'test'}],
+    ]
+    for idx, mapping_version in enumerate(mapping_versions):
+        write_mapping(mapping_dir, mapping_version)
+        get_force_map_addresses_mock.return_value = True
+        apply_mapping('bitcoin')
+        rebuilt_mapping = get_mapping(mapping_dir)
+
+        # Rebuild the previous version and then update the db incrementally, which should give the same mapping
+        if idx > 0:
+            write_mapping(mapping_dir, mapping_versions[idx - 1])
+            apply_mapping('bitcoin')
+            get_force_map_addresses_mock.return_value = False
+            write_mapping(mapping_dir, mapping_version)
+            apply_mapping('bitcoin')
+            assert get_mapping(mapping_dir) == rebuilt_mapping
+
+    cluster_name = hlp.get_cluster_name(('entity3', 'test'))
+    assert rebuilt_mapping == {'addr1': ('entity1', 0), 'addr2': ('entity2', 0), 'addr3': (cluster_name, 0),
+                               'addr4': (cluster_name, 0)}
+
+    # The mapping file is not parsed again if it has not changed
+    read_mapping_information_spy.reset_mock()
     apply_mapping('bitcoin')
-    get_db_connector_calls.append(call(db_filename))
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
-    assert insert_mapping_mock.call_args_list == insert_mapping_calls
-    commit_db_calls.append(call('connector'))
-    assert commit_database_mock.call_args_list == commit_db_calls
+    assert read_mapping_information_spy.call_count == 0
 
-    # Test force map flag
-    os_isfile_mock.side_effect = {
-        db_filename: True
-    }.get
 
+def test_apply_mapping_incremental_empty_file(mocker, mapping_dir):
+    get_force_map_addresses_mock = mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag')
+    mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag', return_value=True)
+
+    # A full rebuild of an empty mapping file
+    write_mapping(mapping_dir, [])
     get_force_map_addresses_mock.return_value = True
+    apply_mapping('bitcoin')
+    rebuilt_mapping = get_mapping(mapping_dir)
+    assert rebuilt_mapping == {}
+
+    # An incremental update from a full build to an empty mapping file removes all records
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr2', 'source': 'test'}])
+    apply_mapping('bitcoin')
+    assert len(get_mapping(mapping_dir)) == 2
+    get_force_map_addresses_mock.return_value = False
+    write_mapping(mapping_dir, [])
+    apply_mapping('bitcoin')
+    assert get_mapping(mapping_dir) == rebuilt_mapping
+
+
+def test_apply_mapping_source_combinations(mocker, mapping_dir):
+    get_force_map_addresses_mock = mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag')
+    get_force_map_addresses_mock.return_value = False
+    get_incremental_mapping_mock = mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag')
+    get_incremental_mapping_mock.return_value = True
+    read_mapping_information_spy = mocker.spy(hlp, 'read_mapping_information')
 
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr1', 'source': 'test2'},
+                                {'name': 'entity2', 'address': 'addr2', 'source': 'test2'}])
     apply_mapping('bitcoin')
-    get_db_connector_calls.append(call(db_filename))
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
-    commit_db_calls.append(call('connector'))
-    assert commit_database_mock.call_args_list == commit_db_calls
 
-    # Test cluster
-    mocker.patch('builtins.open', mocker.mock_open(read_data='{"name": "entity2", "address": "addr1", "source": "test"}'))
+    # Another combination of sources uses the same db, whose records are not loaded again
+    hlp.get_source_combination.return_value = 'Test_Test2'
+    hlp.get_active_sources.return_value = {'test', 'test2'}
+    apply_mapping('bitcoin')
+    assert read_mapping_information_spy.call_count == 1
+    assert [path.name for path in (mapping_dir / 'addresses').glob('*.db')] == ['bitcoin.db']
 
+    cluster_name = hlp.get_cluster_name(('entity1', 'test'))
+    assert get_mapping(mapping_dir) == {'addr1': ('entity1', 0)}
+    combined_mapping = get_mapping(mapping_dir, 'Test_Test2', ['test', 'test2'])
+    assert combined_mapping == {'addr1': (cluster_name, 0), 'addr2': (cluster_name, 0)}
+
+    # An update of the records for one combination makes the other combination recompute its clusters
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr2', 'source': 'test2'}])
+    apply_mapping('bitcoin')
+    hlp.get_source_combination.return_value = 'Test'
+    hlp.get_active_sources.return_value = {'test'}
     apply_mapping('bitcoin')
-    get_db_connector_calls.append(call(db_filename))
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
-    insert_mapping_calls.append(call('connector', 'addr1', 'cluster', False))
-    assert insert_mapping_mock.call_args_list == insert_mapping_calls
-    commit_db_calls.append(call('connector'))
-    assert commit_database_mock.call_args_list == commit_db_calls
+    assert read_mapping_information_spy.call_count == 2
+    assert get_mapping(mapping_dir) == {'addr1': ('entity1', 0)}
+    combined_mapping = get_mapping(mapping_dir, 'Test_Test2', ['test', 'test2'])
+    assert combined_mapping == {'addr1': ('entity1', 0), 'addr2': ('entity2', 0)}
 
-    # Test is_contract
-    mocker.patch('builtins.open', mocker.mock_open(read_data='{"name": "entity2", "address": "addr1", "source": "test", "is_contract": true}'))
 
+def test_apply_mapping_index(mocker, mapping_dir):
+    get_force_map_addresses_mock = mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag')
+    get_force_map_addresses_mock.return_value = False
+    get_incremental_mapping_mock = mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag')
+    get_incremental_mapping_mock.return_value = True
+    build_mapping_index_spy = mocker.spy(idx_hlp, 'build_mapping_index')
+
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'},
+                                {'name': 'entity2', 'address': 'addr1', 'source': 'test', 'is_contract': True},
+                                {'name': 'entity2', 'address': 'addr2', 'source': 'test'},
+                                {'name': 'entity3', 'address': 'addr3', 'source': 'test', 'is_contract': True}])
+    apply_mapping('bitcoin')
+    assert build_mapping_index_spy.call_count == 1
+    index = idx_hlp.load_mapping_index('bitcoin', 'Test')
+    assert idx_hlp.get_addresses_entities(index, ['addr1', 'addr2', 'addr3', 'addr4']) == get_mapping(mapping_dir)
+
+    # The index is not rebuilt if the db has not changed, unless it is missing
+    apply_mapping('bitcoin')
+    assert build_mapping_index_spy.call_count == 1
+    (idx_hlp.get_index_dir('bitcoin', 'Test') / 'meta.json').unlink()
+    apply_mapping('bitcoin')
+    assert build_mapping_index_spy.call_count == 2
+
+    write_mapping(mapping_dir, [{'name': 'entity3', 'address': 'addr3', 'source': 'test'}])
+    apply_mapping('bitcoin')
+    assert build_mapping_index_spy.call_count == 3
+    index = idx_hlp.load_mapping_index('bitcoin', 'Test')
+    assert idx_hlp.get_addresses_entities(index, ['addr1', 'addr2', 'addr3']) == {'addr3': ('entity3', 0)}
+
+
+def test_apply_mapping_conflict_closes_connection(mocker, mapping_dir):
+    mocker.patch('tokenomics_decentralization.helper.get_force_map_addresses_flag', return_value=False)
+    mocker.patch('tokenomics_decentralization.helper.get_incremental_mapping_flag', return_value=True)
+    get_connector_spy = mocker.spy(db_hlp, 'get_connector')
+    check_mapping_conflicts_mock = mocker.patch('tokenomics_decentralization.db_helper.check_mapping_conflicts')
+    check_mapping_conflicts_mock.side_effect = ValueError('Same address addr1 associated with two entities')
+
+    write_mapping(mapping_dir, [{'name': 'entity1', 'address': 'addr1', 'source': 'test'}])
+    with pytest.raises(ValueError):
+        apply_mapping('bitcoin')
+    # The connection is closed, so the db is not left locked by the failed mapping
+    with pytest.raises(sqlite3.ProgrammingError):
+        get_connector_spy.spy_return.execute('SELECT 1')
+
+    check_mapping_conflicts_mock.side_effect = None
     apply_mapping('bitcoin')
-    get_db_connector_calls.append(call(db_filename))
-    assert get_db_connector_mock.call_args_list == get_db_connector_calls
-    insert_mapping_calls.append(call('connector', 'addr1', 'cluster', True))
-    assert insert_mapping_mock.call_args_list == insert_mapping_calls
-    commit_db_calls.append(call('connector'))
-    assert commit_database_mock.call_args_list == commit_db_calls
+    assert get_mapping(mapping_dir) == {'addr1': ('entity1', 0)}
@@ -1,5 +1,10 @@
 from tokenomics_decentralization.metrics import compute_gini, compute_hhi, compute_shannon_entropy, \
-    compute_tau, compute_total_entities, compute_max_power_ratio, compute_theil_index
+    compute_tau, compute_total_entities, compute_max_power_ratio, compute_theil_index, get_balance_array, compute_tau_curve, \
+    get_run_lengths, get_chunks, compute_metrics, compute_prefix_metrics
+from math import log
+import numpy as np
+import tokenomics_decentralization.metrics as metrics_module
+import pytest
 
 
 def test_tau_50():
@@ -168,3 +173,192 @@ def test_compute_theil_index():
     tokens_per_entity = []
     theil_t = compute_theil_index(tokens_per_entity, 432)
     assert theil_t == 0
+
+
+def test_vectorized_metrics_match_elementwise():
+    """
+    Ensure that the vectorized metrics agree (within the documented 1e-9 relative tolerance) with an element-wise
+    evaluation of the same formulas, both for int64 balances and for balances that exceed the int64 range
+    """
+    rng = np.random.default_rng(42)
+    for scale in [1, 2**70]:
+        entries = sorted([int(balance) * scale for balance in rng.integers(1, 10**6, size=5000)], reverse=True)
+        circulation = sum(entries)
+        population = len(entries)
+
+        hhi, entropy, gini, theil = 0, 0, 1, 0
+        for idx, entry in enumerate(entries):
+            market_share = entry / circulation
+            hhi += (market_share * 100)**2
+            entropy -= market_share * log(market_share, 2)
+            gini -= market_share * ((1 / population) + (2 * idx / population))
+            x = entry / (circulation / population)
+            theil += x * log(x) / population
+
+        assert compute_hhi(entries, circulation) == pytest.approx(hhi, rel=1e-9)
+        assert compute_shannon_entropy(entries, circulation) == pytest.approx(entropy, rel=1e-9)
+        assert compute_gini(entries, circulation) == pytest.approx(gini, rel=1e-9)
+        assert compute_theil_index(entries, circulation) == pytest.approx(theil, rel=1e-9)
+        assert compute_tau(np.array(entries, dtype=np.float64), circulation, 0.5) == compute_tau(entries, circulation, 0.5)
+
+
+def test_get_balance_array():
+    balances = get_balance_array([3, 2, 1])
+    assert balances.dtype == np.int64
+    assert get_balance_array(balances) is balances
+
+    balances = get_balance_array([2**64, 1])
+    assert balances.dtype == np.float64
+    assert balances.tolist() == [2.0**64, 1.0]
+
+
+def test_tau_curve():
+    tokens_per_entity = [3, 2, 1, 1, 1, 1]
+    tau_indices = compute_tau_curve(tokens_per_entity, circulation=9, thresholds=[0, 0.33, 0.5, 0.66, 1, 1.1])
+    assert tau_indices == [0, 1, 2, 3, 6, 6]
+
+    tau_indices = compute_tau_curve([], circulation=0, thresholds=[0.5, 0.66])
+    assert tau_indices == [0, 0]
+
+    tokens_per_entity = list(range(100, 0, -1))
+    thresholds = [threshold / 100 for threshold in range(1, 100)]
+    tau_indices = compute_tau_curve(tokens_per_entity, sum(tokens_per_entity), thresholds)
+    assert tau_indices == [compute_tau(tokens_per_entity, sum(tokens_per_entity), t) for t in thresholds]
+
+
+def test_tau_exact_ties():
+    """
+    Ensure that a threshold that is reached exactly at an entry resolves to that entry, in every form of the
+    distribution, since the tau index is resolved on the exact sums of the balances
+    """
+    entries = np.array([5, 4, 4, 4, 1])
+    balances, counts = get_run_lengths(entries)
+    assert compute_tau(entries, 18, 0.5) == 2
+    for chunk_size in [1, 2, 3, 10]:
+        assert compute_metrics(entries, None, [0.5], chunk_size)['tau'] == [2]
+        assert compute_metrics(balances, counts, [0.5], chunk_size)['tau'] == [2]
+
+    # The sums of huge balances (beyond the int64 range) are also exact
+    entries = np.array([2**62, 2**62, 2**62, 2**62], dtype=np.int64)
+    assert compute_tau(entries, 2**64, 0.5) == 2
+    assert compute_metrics(np.array([1], dtype=np.int64), np.array([4]), [0.75])['tau'] == [3]
+
+    # Exact ties against a random distribution, compared to the cut-offs of the exact shares
+    rng = np.random.default_rng(5)
+    for _ in range(200):
+        entries = np.sort(rng.integers(0, 10, size=rng.integers(1, 12)))[::-1]
+        circulation = int(entries.sum())
+        if circulation == 0:
+            continue
+        balances, counts = get_run_lengths(entries)
+        for quarters in [1, 2, 3]:
+            expected = int(np.argmax(np.cumsum(entries) * 4 >= quarters * circulation)) + 1
+            assert compute_metrics(entries, None, [quarters / 4], chunk_size=3)['tau'] == [expected]
+            assert compute_metrics(balances, counts, [quarters / 4], chunk_size=3)['tau'] == [expected]
+
+
+def test_get_run_lengths():
+    balances, counts = get_run_lengths([5, 5, 3, 1, 1, 1])
+    assert balances.tolist() == [5, 3, 1]
+    assert counts.tolist() == [2, 1, 3]
+
+    balances, counts = get_run_lengths([])
+    assert len(balances) == 0 and len(counts) == 0
+
+
+def test_run_length_metrics_match_expanded():
+    """
+    Ensure that the metrics of a distribution in run-length form agree with the metrics of the expanded distribution
+    """
+    rng = np.random.default_rng(42)
+    entries = np.sort(rng.integers(1, 50, size=5000) ** 3)[::-1]
+    circulation = int(entries.sum())
+    balances, counts = get_run_lengths(entries)
+    assert len(balances) < 50 and counts.sum() == len(entries)
+
+    thresholds = [0.1234, 0.3333, 0.5, 0.6667, 0.9876, 1, 1.1]
+    results = compute_metrics(balances, counts, thresholds)
+    for metric_name, compute_metric in [('hhi', compute_hhi), ('shannon_entropy', compute_shannon_entropy),
+                                        ('gini', compute_gini), ('theil', compute_theil_index),
+                                        ('mpr', compute_max_power_ratio)]:
+        assert results[metric_name] == pytest.approx(compute_metric(entries, circulation), rel=1e-9)
+    assert results['total_entities'] == compute_total_entities(entries, circulation)
+    assert results['tau'] == compute_tau_curve(entries, circulation, thresholds)
+
+    # A threshold that is reached exactly within a run
+    balances, counts = np.array([2, 1]), np.array([2, 4])
+    assert compute_metrics(balances, counts, [0.5, 0.75])['tau'] == \
+        compute_tau_curve([2, 2, 1, 1, 1, 1], 8, [0.5, 0.75]) == [2, 4]
+
+
+def test_compute_metrics():
+    """
+    Ensure that the metrics that are computed in a single pass over the chunks of a distribution agree with the
+    individual metrics, regardless of the chunk size and of the form of the distribution
+    """
+    rng = np.random.default_rng(7)
+    thresholds = [0, 0.1234, 0.3333, 0.5, 0.6667, 0.9876, 1, 1.1]
+    dense_entries = np.sort(rng.integers(1, 10 ** 15, size=5000))[::-1]
+    run_length_entries = np.sort(rng.integers(1, 50, size=5000) ** 3)[::-1]
+    for entries in [dense_entries, run_length_entries, np.array([5, 5, 5, 5]), np.array([7])]:
+        circulation = sum(entries.tolist())
+        for balances, counts in [(entries, None), get_run_lengths(entries)]:
+            for chunk_size in [1, 3, 1000, 10000]:
+                results = compute_metrics(balances, counts, thresholds, chunk_size)
+                assert results['circulation'] == pytest.approx(circulation, rel=1e-9)
+                assert results['total_entities'] == len(entries)
+                for metric_name, compute_metric in [('hhi', compute_hhi), ('gini', compute_gini),
+                                                    ('shannon_entropy', compute_shannon_entropy),
+                                                    ('theil', compute_theil_index), ('mpr', compute_max_power_ratio)]:
+                    assert results[metric_name] == pytest.approx(compute_metric(entries, circulation), rel=1e-9,
+                                                                 abs=1e-12)
+                assert results['tau'] == compute_tau_curve(entries, circulation, thresholds)
+
+    # A threshold that is reached exactly at the end of a chunk
+    results = compute_metrics(np.array([2, 2, 1, 1, 1, 1]), None, [0.5, 0.75], chunk_size=2)
+    assert results['tau'] == [2, 4]
+
+    results = compute_metrics(np.array([], dtype=np.int64), None, [0.5])
+    assert results['total_entities'] == 0 and results['tau'] == [0]
+
+
+def test_get_chunks():
+    chunks = list(get_chunks(np.array([5, 4, 3, 2, 1]), chunk_size=2, boundaries=[3, 0, 10]))
+    assert [(entries.tolist(), counts) for entries, counts in chunks] == [([5, 4], None), ([3], None), ([2], None),
+                                                                          ([1], None)]
+
+    # A run that spans a boundary is split at it
+    chunks = list(get_chunks(np.array([5, 4, 1]), np.array([2, 4, 1]), chunk_size=10, boundaries=[3, 4, 6]))
+    assert [(entries.tolist(), counts.tolist()) for entries, counts in chunks] == [
+        ([5], [2]), ([4], [1]), ([4], [1]), ([4], [2]), ([1], [1])]
+
+    assert list(get_chunks(np.array([], dtype=np.int64), boundaries=[1])) == []
+
+
+def test_compute_prefix_metrics(mocker, tmp_path):
+    """
+    Ensure that the metrics of the prefixes of a distribution that are computed in a single pass agree with the
+    metrics of each prefix
+    """
+    rng = np.random.default_rng(11)
+    thresholds = [0.25, 0.5, 0.9]
+    prefix_sizes = [None, 0, 1, 17, 500, 1000, 5000]
+    for entries in [np.sort(rng.integers(1, 10 ** 12, size=1000))[::-1], np.sort(rng.integers(1, 6, size=1000))[::-1]]:
+        for balances, counts in [(entries, None), get_run_lengths(entries)]:
+            all_results = compute_prefix_metrics(balances, counts, thresholds, prefix_sizes, chunk_size=64)
+            for prefix_size, results in zip(prefix_sizes, all_results):
+                expected_results = compute_metrics(entries[:prefix_size], None, thresholds)
+                assert results.keys() == expected_results.keys()
+                for metric_name, value in results.items():
+                    assert value == pytest.approx(expected_results[metric_name], rel=1e-9)
+
+    # The tau indices are resolved by reading again only the chunks that reach the thresholds of a memory-mapped
+    # distribution
+    entries = np.sort(rng.integers(1, 10 ** 12, size=1000))[::-1]
+    np.save(tmp_path / 'entries.npy', entries)
+    expected_results = compute_metrics(entries, None, thresholds, chunk_size=64)
+    resolve_tau_targets_spy = mocker.spy(metrics_module, 'resolve_tau_targets')
+    results = compute_metrics(np.load(tmp_path / 'entries.npy', mmap_mode='r'), None, thresholds, chunk_size=64)
+    assert results == expected_results
+    assert 0 < resolve_tau_targets_spy.call_count <= len(thresholds)
+    assert all(len(args[0]) <= 64 for args, _ in resolve_tau_targets_spy.call_args_list)
@@ -0,0 +1,269 @@
+import tokenomics_decentralization.snapshot_helper as snap_hlp
+import numpy as np
+import bz2
+import gzip
+import lzma
+import os
+import pytest
+
+
+def write_snapshot(filename, content):
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def decode_batches(batches):
+    return [(snap_hlp.decode_addresses(addresses), balances.tolist()) for addresses, balances in batches]
+
+
+def test_get_cache_filenames(tmp_path):
+    addresses_filename, balances_filename, meta_filename = snap_hlp.get_cache_filenames(
+        tmp_path / 'bitcoin_2010-01-01_raw_data.csv')
+    assert addresses_filename == tmp_path / 'cache' / 'bitcoin_2010-01-01_raw_data_addresses.npy'
+    assert balances_filename == tmp_path / 'cache' / 'bitcoin_2010-01-01_raw_data_balances.npy'
+    assert meta_filename == tmp_path / 'cache' / 'bitcoin_2010-01-01_raw_data_meta.json'
+
+
+def test_read_csv_batches(tmp_path):
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,type,balance\naddr1,p2pkh,17\naddr2,p2sh,26\naddr3,p2pkh,5\n')
+
+    batches = decode_batches(snap_hlp.read_csv_batches(filename, 2))
+    assert batches == [(['addr1', 'addr2'], [17, 26]), (['addr3'], [5])]
+
+
+def test_snapshot_cache(tmp_path):
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,balance\naddr1,17\naddr22,26\n')
+
+    assert snap_hlp.load_snapshot_cache(filename) is None
+
+    assert snap_hlp.convert_snapshot_to_cache(filename)
+    addresses, balances = snap_hlp.load_snapshot_cache(filename)
+    assert isinstance(balances, np.memmap)
+    assert addresses.tolist() == [b'addr1', b'addr22']
+    assert balances.tolist() == [17, 26]
+
+    # The cache is stale once the raw file changes
+    write_snapshot(filename, 'address,balance\naddr1,17\naddr22,26\naddr3,1\n')
+    assert snap_hlp.load_snapshot_cache(filename) is None
+
+    write_snapshot(filename, f'address,balance\naddr1,{2**64}\n')
+    assert not snap_hlp.convert_snapshot_to_cache(filename)
+
+
+def test_convert_snapshot_to_cache_batches(tmp_path):
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,balance\na,1\nbb,2\ncccc,3\nd,4\nee,5\n')
+
+    # The batches are written with their own address widths and padded to the longest one
+    assert snap_hlp.convert_snapshot_to_cache(filename, batch_size=2)
+    addresses, balances = snap_hlp.load_snapshot_cache(filename)
+    assert addresses.dtype == np.dtype('S4')
+    assert addresses.tolist() == [b'a', b'bb', b'cccc', b'd', b'ee']
+    assert balances.tolist() == [1, 2, 3, 4, 5]
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['bitcoin_2010-01-01_raw_data_addresses.npy',
+                                                      'bitcoin_2010-01-01_raw_data_balances.npy',
+                                                      'bitcoin_2010-01-01_raw_data_meta.json']
+
+    # An empty snapshot is cached as empty arrays
+    write_snapshot(filename, 'address,balance\n')
+    assert snap_hlp.convert_snapshot_to_cache(filename)
+    addresses, balances = snap_hlp.load_snapshot_cache(filename)
+    assert addresses.tolist() == [] and balances.tolist() == []
+
+
+def test_get_snapshot_batches(tmp_path, mocker):
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,balance\naddr1,17\naddr2,26\naddr3,5\n')
+
+    batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 2, use_cache=False))
+    assert batches == [(['addr1', 'addr2'], [17, 26]), (['addr3'], [5])]
+    assert not os.path.isdir(tmp_path / 'cache')
+
+    batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 2, use_cache=True))
+    assert batches == [(['addr1', 'addr2'], [17, 26]), (['addr3'], [5])]
+    assert snap_hlp.load_snapshot_cache(filename) is not None
+
+    # The second read is served from the cache
+    read_csv_batches_mock = mocker.patch('tokenomics_decentralization.snapshot_helper.read_csv_batches')
+    batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 2, use_cache=True))
+    assert batches == [(['addr1', 'addr2'], [17, 26]), (['addr3'], [5])]
+    assert read_csv_batches_mock.call_args_list == []
+
+
+def test_get_snapshot_files(tmp_path):
+    for shard in ['000', '001', '002']:
+        write_snapshot(tmp_path / f'bitcoin_2010-01-01_raw_data_{shard}.csv', 'address,balance\naddr1,1\n')
+    write_snapshot(tmp_path / 'bitcoin_2010-01-02_raw_data.csv', 'address,balance\n')
+
+    snapshot_files = snap_hlp.get_snapshot_files(tmp_path / 'bitcoin_2010-01-01_raw_data_*.csv')
+    assert snapshot_files == [tmp_path / f'bitcoin_2010-01-01_raw_data_{shard}.csv' for shard in ['000', '001', '002']]
+    assert snap_hlp.get_snapshot_size(tmp_path / 'bitcoin_2010-01-01_raw_data_*.csv') == 3 * 24
+
+    assert snap_hlp.get_snapshot_files(tmp_path / 'bitcoin_2010-01-02_raw_data.csv') == [
+        tmp_path / 'bitcoin_2010-01-02_raw_data.csv']
+
+
+def test_get_snapshot_parts(tmp_path, mocker):
+    mocker.patch('tokenomics_decentralization.snapshot_helper.MIN_PART_SIZE', 10)
+    write_snapshot(tmp_path / 'bitcoin_2010-01-01_raw_data_0.csv', 'a' * 60)
+    write_snapshot(tmp_path / 'bitcoin_2010-01-01_raw_data_1.csv', 'a' * 20)
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data_*.csv'
+
+    assert snap_hlp.get_snapshot_parts(filename, 1) == [(tmp_path / 'bitcoin_2010-01-01_raw_data_0.csv', None),
+                                                        (tmp_path / 'bitcoin_2010-01-01_raw_data_1.csv', None)]
+    # The parts are distributed in proportion to the size of the files
+    parts = snap_hlp.get_snapshot_parts(filename, 4)
+    assert parts == [(tmp_path / 'bitcoin_2010-01-01_raw_data_0.csv', (idx, 3)) for idx in range(3)] + \
+        [(tmp_path / 'bitcoin_2010-01-01_raw_data_1.csv', None)]
+    # Each part is at least MIN_PART_SIZE bytes
+    parts = snap_hlp.get_snapshot_parts(filename, 100)
+    assert len(parts) == 6 + 2
+
+
+def test_read_blocks(tmp_path, mocker):
+    filename = tmp_path / 'lines.csv'
+    lines = ['header', 'addr1,1', 'ädr2,22', '', 'addr3,333', 'a,4']
+    for block_size in [3, 2**22]:
+        mocker.patch('tokenomics_decentralization.snapshot_helper.READ_BLOCK_SIZE', block_size)
+        for content in ['\n'.join(lines), '\n'.join(lines) + '\n']:
+            write_snapshot(filename, content)
+            blocks = [block.tobytes() for block in snap_hlp.read_blocks(filename)]
+            assert b''.join(blocks) == content.encode()
+            assert all(block.endswith(b'\n') for block in blocks[:-1])
+            # Each line is read by exactly one part, regardless of where the byte ranges start
+            for num_parts in range(1, 2 * len(content)):
+                part_blocks = [block.tobytes() for idx in range(num_parts)
+                               for block in snap_hlp.read_blocks(filename, (idx, num_parts))]
+                assert b''.join(part_blocks) == content.encode()
+
+    write_snapshot(filename, '')
+    assert list(snap_hlp.read_blocks(filename)) == []
+
+
+def test_parse_csv_block():
+    def parse(content):
+        addresses, balances = snap_hlp.parse_csv_block(np.frombuffer(content.encode(), dtype=np.uint8))
+        return snap_hlp.decode_addresses(addresses), balances.tolist()
+
+    assert parse('addr1,17\naddr22,26\n') == (['addr1', 'addr22'], [17, 26])
+    assert parse('addr1,p2pkh,17\r\naddr2,,026') == (['addr1', 'addr2'], [17, 26])
+    assert parse(',5\n') == ([''], [5])
+    assert parse('') == ([], [])
+    # Balances that exceed 18 digits or the int64 range
+    assert parse(f'addr1,{2**63 - 1}\naddr2,1\n') == (['addr1', 'addr2'], [2**63 - 1, 1])
+    addresses, balances = snap_hlp.parse_csv_block(np.frombuffer(f'addr1,{2**64}\naddr2,1\n'.encode(), dtype=np.uint8))
+    assert balances.dtype == object and balances.tolist() == [2**64, 1]
+    # Lines that the bulk parser does not handle are parsed with the csv module
+    assert parse('"addr,1",17\nädr2,26\n') == (['addr,1', 'ädr2'], [17, 26])
+    assert parse('addr1, 17\naddr2,+26\n') == (['addr1', 'addr2'], [17, 26])
+    with pytest.raises(ValueError):
+        parse('addr1,17\naddr2\n')
+    with pytest.raises(ValueError):
+        parse('addr1,17.5\n')
+
+
+def test_read_csv_batches_parts(tmp_path):
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,balance\naddr1,17\naddr2,26\naddr3,5\naddr4,8\n')
+
+    batches = decode_batches(batch for idx in range(3) for batch in snap_hlp.read_csv_batches(filename, 10, (idx, 3)))
+    assert sum([addresses for addresses, _ in batches], []) == ['addr1', 'addr2', 'addr3', 'addr4']
+    assert sum([balances for _, balances in batches], []) == [17, 26, 5, 8]
+
+    # The parts of a file are not cached, but they are served from an existing cache
+    batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 10, use_cache=True, part=(1, 2)))
+    assert snap_hlp.load_snapshot_cache(filename) is None
+    assert snap_hlp.convert_snapshot_to_cache(filename)
+    cached_batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 1, use_cache=True, part=(1, 2)))
+    assert cached_batches == [(['addr3'], [5]), (['addr4'], [8])]
+
+
+def test_read_ahead():
+    assert list(snap_hlp.read_ahead(iter(range(100)), 3)) == list(range(100))
+    assert list(snap_hlp.read_ahead([], 3)) == []
+
+    def failing_generator():
+        yield 1
+        raise ValueError('parse error')
+
+    items = snap_hlp.read_ahead(failing_generator(), 3)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+    # The background thread stops when the consumer stops early
+    produced = []
+
+    def generator():
+        for idx in range(1000):
+            produced.append(idx)
+            yield idx
+
+    items = snap_hlp.read_ahead(generator(), 2)
+    assert next(items) == 0
+    items.close()
+    assert len(produced) < 10
+
+
+def test_prefetch_snapshot(tmp_path, mocker):
+    posix_fadvise_mock = mocker.patch('os.posix_fadvise', create=True)
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv'
+    write_snapshot(filename, 'address,balance\naddr1,17\n')
+
+    snap_hlp.prefetch_snapshot(filename)
+    assert posix_fadvise_mock.call_count == 1
+
+    # If the cache is fresh, the cache is prefetched instead of the raw file
+    snap_hlp.convert_snapshot_to_cache(filename)
+    posix_fadvise_mock.reset_mock()
+    snap_hlp.prefetch_snapshot(filename)
+    assert posix_fadvise_mock.call_count == 2
+
+    # Missing files are ignored
+    snap_hlp.prefetch_snapshot(tmp_path / 'ethereum_2010-01-01_raw_data.csv')
+    assert posix_fadvise_mock.call_count == 2
+
+
+def test_read_compressed_snapshots(tmp_path, mocker):
+    content = 'address,balance\naddr1,17\naddr2,26\naddr3,5\n'
+    for suffix, compressed_open in [('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)]:
+        filename = tmp_path / f'bitcoin_2010-01-01_raw_data.csv{suffix}'
+        with compressed_open(filename, 'wt') as f:
+            f.write(content)
+        assert snap_hlp.is_compressed(filename)
+        batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 2, use_cache=False))
+        assert batches == [(['addr1', 'addr2'], [17, 26]), (['addr3'], [5])]
+        # Compressed files are not split into parts
+        assert snap_hlp.get_snapshot_parts(filename, 4) == [(filename, None)]
+        with pytest.raises(ValueError):
+            list(snap_hlp.read_blocks(filename, (0, 2)))
+
+    # The raw data size of compressed files is estimated
+    assert snap_hlp.get_snapshot_size(filename) == os.path.getsize(filename) * 10
+
+    mocker.patch('tokenomics_decentralization.snapshot_helper.zstandard', None)
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv.zst'
+    write_snapshot(filename, '')
+    with pytest.raises(ValueError):
+        list(snap_hlp.get_snapshot_batches(filename, 2, use_cache=False))
+
+
+def test_read_zstd_snapshot(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    filename = tmp_path / 'bitcoin_2010-01-01_raw_data.csv.zst'
+    with open(filename, 'wb') as f:
+        # Two frames, as written by multi-threaded compressors
+        for frame in ['address,balance\naddr1,17\n', 'addr2,26\n']:
+            f.write(zstandard.ZstdCompressor().compress(frame.encode()))
+    batches = decode_batches(snap_hlp.get_snapshot_batches(filename, 2, use_cache=False))
+    assert batches == [(['addr1', 'addr2'], [17, 26])]
+
+
+def test_get_snapshot_files_compressed(tmp_path):
+    for name in ['bitcoin_2010-01-01_raw_data_0.csv', 'bitcoin_2010-01-01_raw_data_0.csv.gz',
+                 'bitcoin_2010-01-01_raw_data_1.csv.gz', 'bitcoin_2010-01-01_raw_data_2.csv.bak']:
+        write_snapshot(tmp_path / name, '')
+    assert snap_hlp.get_snapshot_files(tmp_path / 'bitcoin_2010-01-01_raw_data_*.csv*') == [
+        tmp_path / 'bitcoin_2010-01-01_raw_data_0.csv', tmp_path / 'bitcoin_2010-01-01_raw_data_1.csv.gz']
@@ -0,0 +1,103 @@
+import tokenomics_decentralization.spill_helper as spill_hlp
+from tokenomics_decentralization.analyze import aggregate_entity_balances
+from collections import defaultdict
+import numpy as np
+import csv
+
+
+def test_partition_entity_balances(tmp_path):
+    entity_balances = [(['entity1', 'entity2'], [10, 5]), (['entity1', 'entity3'], [3, 7]), ([], [])]
+    bucket_filenames = spill_hlp.partition_entity_balances(entity_balances, 3, tmp_path / 'bucket')
+    assert len(bucket_filenames) == 3
+
+    entity_buckets = defaultdict(set)
+    rows = []
+    for idx, bucket_filename in enumerate(bucket_filenames):
+        with open(bucket_filename, newline='') as f:
+            for entity, balance in csv.reader(f):
+                entity_buckets[entity].add(idx)
+                rows.append((entity, int(balance)))
+    assert sorted(rows) == [('entity1', 3), ('entity1', 10), ('entity2', 5), ('entity3', 7)]
+    # All balances of an entity are in the same bucket
+    assert all(len(buckets) == 1 for buckets in entity_buckets.values())
+
+
+def test_aggregate_bucket(mocker, tmp_path):
+    bucket_filename = tmp_path / 'bucket_0.csv'
+    with open(bucket_filename, 'w') as f:
+        f.write('entity1,10\nentity2,5\nentity1,3\nentity3,1\n')
+
+    assert spill_hlp.aggregate_bucket(bucket_filename, 0, aggregate_entity_balances).tolist() == [13, 5, 1]
+    assert spill_hlp.aggregate_bucket(bucket_filename, 1, aggregate_entity_balances).tolist() == [13, 5]
+
+    # The bucket is read in batches, so its entries are never all kept as Python objects
+    mocker.patch('tokenomics_decentralization.spill_helper.BUCKET_BATCH_SIZE', 3)
+    assert list(spill_hlp.read_bucket_batches(bucket_filename)) == [(['entity1', 'entity2', 'entity1'], [10, 5, 3]),
+                                                                    (['entity3'], [1])]
+    assert spill_hlp.aggregate_bucket(bucket_filename, 0, aggregate_entity_balances).tolist() == [13, 5, 1]
+
+    with open(bucket_filename, 'w') as f:
+        f.write(f'entity1,{2**63}\nentity2,5\n')
+    entries = spill_hlp.aggregate_bucket(bucket_filename, 0, aggregate_entity_balances)
+    assert entries.dtype == np.float64
+    assert entries.tolist() == [2**63, 5]
+
+
+def test_get_max_open_partitions(mocker):
+    getrlimit_mock = mocker.patch('resource.getrlimit')
+    getrlimit_mock.return_value = (1024, 4096)
+    assert spill_hlp.get_max_open_partitions() == spill_hlp.MAX_OPEN_PARTITIONS
+    getrlimit_mock.return_value = (256, 4096)
+    assert spill_hlp.get_max_open_partitions() == 256 - spill_hlp.RESERVED_OPEN_FILES
+    getrlimit_mock.return_value = (10, 4096)
+    assert spill_hlp.get_max_open_partitions() == 2
+
+
+def test_merge_sorted_runs(mocker, tmp_path):
+    rng = np.random.default_rng(42)
+    runs = [np.sort(rng.integers(0, 100, size=size))[::-1] for size in [0, 1, 5, 8]]
+    run_filenames = []
+    for idx, run in enumerate(runs):
+        run_filenames.append(tmp_path / f'run_{idx}.npy')
+        np.save(run_filenames[-1], run)
+
+    expected = sorted(np.concatenate(runs).tolist(), reverse=True)
+    # The memory budget of 256 bytes allows blocks of 2 entries from each of the 4 runs
+    concatenate_spy = mocker.spy(spill_hlp.np, 'concatenate')
+    merged = spill_hlp.merge_sorted_runs(run_filenames, tmp_path / 'merged.npy', memory_budget=256)
+    assert merged.dtype == np.int64
+    assert merged.tolist() == expected
+    assert all(len(entries) <= 4 * 2 for entries in concatenate_spy.spy_return_list)
+
+    # The blocks of the runs shrink as the memory budget shrinks, but at least one entry is loaded per run
+    assert spill_hlp.merge_sorted_runs(run_filenames, tmp_path / 'merged.npy', memory_budget=1).tolist() == expected
+
+
+def test_aggregate_out_of_core(mocker, tmp_path):
+    rng = np.random.default_rng(7)
+    entities = [f'entity{idx}' for idx in rng.integers(0, 500, size=2000)]
+    balances = rng.integers(1, 10**6, size=2000).tolist()
+    entity_balances = [(entities[idx:idx + 300], balances[idx:idx + 300]) for idx in range(0, 2000, 300)]
+
+    clustered_balances = defaultdict(int)
+    for entity, balance in zip(entities, balances):
+        clustered_balances[entity] += balance
+    expected = sorted([balance for balance in clustered_balances.values() if balance > 10**5], reverse=True)
+
+    entries = spill_hlp.aggregate_out_of_core(entity_balances, 10**5, data_size=1000, memory_budget=100,
+                                              aggregate_entity_balances=aggregate_entity_balances,
+                                              spill_parent_dir=tmp_path)
+    assert entries.tolist() == expected
+    # The spill directory is removed after the aggregation
+    assert list(tmp_path.iterdir()) == []
+
+    # If fewer buckets can be open than needed, the buckets are partitioned again
+    mocker.patch('tokenomics_decentralization.spill_helper.get_max_open_partitions', return_value=3)
+    partition_spy = mocker.spy(spill_hlp, 'partition_entity_balances')
+    entries = spill_hlp.aggregate_out_of_core(entity_balances, 10**5, data_size=1000, memory_budget=100,
+                                              aggregate_entity_balances=aggregate_entity_balances,
+                                              spill_parent_dir=tmp_path)
+    assert entries.tolist() == expected
+    assert all(call.args[1] <= 3 for call in partition_spy.call_args_list)
+    assert {call.args[3] for call in partition_spy.call_args_list} == {0, 1, 2}
+    assert list(tmp_path.iterdir()) == []
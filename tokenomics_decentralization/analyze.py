@@ -1,181 +1,593 @@
-import csv
-import multiprocessing
-import os.path
+import time
+import numpy as np
 import tokenomics_decentralization.helper as hlp
 import tokenomics_decentralization.db_helper as db_hlp
-from collections import defaultdict
-from tokenomics_decentralization.metrics import (compute_hhi, compute_tau, compute_gini, compute_shannon_entropy,
-                                                 compute_total_entities, compute_max_power_ratio, compute_theil_index)
+import tokenomics_decentralization.index_helper as idx_hlp
+import tokenomics_decentralization.snapshot_helper as snap_hlp
+import tokenomics_decentralization.spill_helper as spill_hlp
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from itertools import chain, product
+from tokenomics_decentralization.metrics import (get_balance_array, get_run_lengths, compute_prefix_metrics,
+                                                 METRIC_CHUNK_SIZE)
 import logging
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
+INT64_MAX = np.iinfo(np.int64).max
+RUN_LENGTH_MAX_RATIO = 0.5  # Distributions with at most this many distinct balances per entity are analyzed in run-length form
+ADDRESS_BATCH_SIZE = 100000  # Number of snapshot lines whose addresses are resolved against the mapping db at once
+ORDER_INDEPENDENT_METRICS = ['hhi', 'shannon_entropy', 'theil', 'total_entities', 'mpr']  # Computed on unsorted entries
+READ_AHEAD_BATCHES = 2  # Number of parsed batches that are read ahead of the mapping and aggregation of a snapshot
+# Functions of the metrics that are not computed in the single pass of metrics.compute_prefix_metrics, keyed by the
+# names of the metrics in the config file; each is called with the top entries of a distribution (in descending order)
+# and its circulation
+COMPUTE_FUNCTIONS = {}
+
+worker_state = None  # Per-ledger resources of a long-lived worker process, see init_worker()
+
 
 def analyze_snapshot(entries):
     """
     Applies thresholding based on the config parameters and then applies
     the metrics on the given entries.
-    :param entries: a list of integers in descending order
+    :param entries: a list of integers or a numpy array, in any order
     :returns: a dictionary where the key is the name of the computed metric prefixed with the applied thresholds and the value is a number
     """
-    compute_functions = {
-        'hhi': compute_hhi,
-        'shannon_entropy': compute_shannon_entropy,
-        'gini': compute_gini,
-        'total_entities': compute_total_entities,
-        'mpr': compute_max_power_ratio,
-        'theil': compute_theil_index
-    }
-    for threshold in hlp.get_tau_thresholds():
-        compute_functions[f'tau={threshold}'] = compute_tau
-
-    top_limit_type = hlp.get_top_limit_type()
-    top_limit_value = hlp.get_top_limit_value()
-    if top_limit_value > 0:
-        if top_limit_type == 'percentage':
-            total_entities = compute_functions['total_entities'](entries, -1)
-            top_limit_percentage_value = int(total_entities * top_limit_value)
-            entries = entries[:top_limit_percentage_value]
-        elif top_limit_type == 'absolute':
-            entries = entries[:top_limit_value]
-
-    circulation = hlp.get_circulation_from_entries(entries)
-
-    metrics_results = {}
-    for default_metric_name in hlp.get_metrics():
-        flagged_metric = default_metric_name
-        if not hlp.get_clustering_flag():
-            flagged_metric = 'non-clustered ' + flagged_metric
-        if hlp.get_exclude_contracts_flag():
-            flagged_metric = 'exclude_contracts ' + flagged_metric
-        if hlp.get_exclude_below_fees_flag():
-            flagged_metric = 'exclude_below_fees ' + flagged_metric
-        if hlp.get_exclude_below_usd_cent_flag():
-            flagged_metric = 'exclude_below_usd_cent ' + flagged_metric
+    top_limit = (hlp.get_top_limit_type(), hlp.get_top_limit_value())
+    balance_threshold = (hlp.get_exclude_below_fees_flag(), hlp.get_exclude_below_usd_cent_flag(), 0)
+    return analyze_snapshot_sweep(entries, [top_limit], [(balance_threshold, None)])[0]
+
+
+def analyze_snapshot_sweep(entries, top_limits, balance_thresholds):
+    """
+    Applies the metrics on the given entries for each combination of balance threshold and top limit, i.e. on the
+    top entries of the entries that are above the threshold.
+    If many entities hold equal balances (e.g. the long tail of dust balances), the distribution is compressed to
+    runs of equal balances (see metrics.get_run_lengths) and the metrics are evaluated over the runs.
+    If all combinations keep a limited number of entries, only the top entries are selected (see get_top_entries).
+    The standard metrics are computed together in a single pass over the distribution (see metrics.compute_metrics),
+    in which the metrics of all combinations are derived from the same sorted entries (the entries of each
+    combination are a prefix of them, see metrics.compute_prefix_metrics), while any other metric is computed by its
+    own function in COMPUTE_FUNCTIONS.
+    :param entries: a list of integers or a numpy array, in any order
+    :param top_limits: a list of tuples (top limit type, top limit value) (see helper.get_top_limits)
+    :param balance_thresholds: a list of tuples (balance threshold, value), where balance threshold is a tuple of
+    flags (see helper.get_balance_thresholds) and value is the balance below which (inclusive) entries are excluded
+    (see helper.get_balance_threshold_value), or None if no entry is excluded
+    :returns: a list of dictionaries, one for each combination of balance threshold and top limit (in the order of
+    itertools.product(balance_thresholds, top_limits)), where the key is the name of the computed metric prefixed
+    with the applied thresholds and the value is a number
+    """
+    entries = get_balance_array(entries)  # All metrics are computed on the same array
+
+    # The entries of each combination are the top entries among those above its threshold
+    combinations = []
+    for (balance_threshold, threshold_value), top_limit in product(balance_thresholds, top_limits):
+        top_limit_type, top_limit_value = top_limit
+        kept_entries = len(entries) if threshold_value is None else int(np.count_nonzero(entries > threshold_value))
+        limit = kept_entries
         if top_limit_value > 0:
-            flagged_metric = f'top-{top_limit_value}_{top_limit_type} ' + flagged_metric
+            if top_limit_type == 'percentage':
+                limit = int(kept_entries * top_limit_value)
+            elif top_limit_type == 'absolute':
+                limit = min(int(top_limit_value), kept_entries)
+        combinations.append((balance_threshold, top_limit_type, top_limit_value, limit))
+    limits = [combination[3] for combination in combinations]
+
+    # The entries are only sorted if some metric depends on the ranks of the entities or if multiple combinations
+    # are derived from them
+    ordered = len(set(limits)) > 1 or \
+        any(metric_name not in ORDER_INDEPENDENT_METRICS for metric_name in hlp.get_metrics())
+    if not ordered and limits[0] < len(entries) and balance_thresholds[0][1] is not None:
+        entries = entries[entries > balance_thresholds[0][1]]
+    entries = get_top_entries(entries, max(limits), ordered)
+    entries, counts = get_distribution(entries) if ordered else (entries, None)
+
+    tau_thresholds = hlp.get_tau_thresholds()
+    all_fused_results = compute_prefix_metrics(entries, counts, tau_thresholds, limits)
+
+    all_metrics_results = []
+    for (balance_threshold, top_limit_type, top_limit_value, limit), fused_results in zip(combinations,
+                                                                                          all_fused_results):
+        exclude_below_fees_flag, exclude_below_usd_cent_flag, exclude_below_usd = balance_threshold
+        circulation = fused_results['circulation']
+        tau_indices = dict(zip(tau_thresholds, fused_results['tau']))
+
+        metrics_results = {}
+        for default_metric_name in hlp.get_metrics():
+            flagged_metric = default_metric_name
+            if not hlp.get_clustering_flag():
+                flagged_metric = 'non-clustered ' + flagged_metric
+            if hlp.get_exclude_contracts_flag():
+                flagged_metric = 'exclude_contracts ' + flagged_metric
+            if exclude_below_fees_flag:
+                flagged_metric = 'exclude_below_fees ' + flagged_metric
+            if exclude_below_usd_cent_flag:
+                flagged_metric = 'exclude_below_usd_cent ' + flagged_metric
+            if exclude_below_usd:
+                flagged_metric = f'exclude_below_usd-{exclude_below_usd} ' + flagged_metric
+            if top_limit_value > 0:
+                flagged_metric = f'top-{top_limit_value}_{top_limit_type} ' + flagged_metric
+
+            if 'tau' in default_metric_name:
+                metric_value = tau_indices[hlp.get_tau_threshold_from_parameter(default_metric_name)]
+            elif default_metric_name in COMPUTE_FUNCTIONS:
+                top_entries, top_counts = get_distribution_prefix(entries, counts, limit)
+                if top_counts is not None:
+                    top_entries = np.repeat(top_entries, top_counts)
+                metric_value = COMPUTE_FUNCTIONS[default_metric_name](top_entries, circulation)
+            else:
+                metric_value = fused_results[default_metric_name]
+
+            if any(['tau' in default_metric_name, 'total_entities' in default_metric_name]):
+                metric_value = int(metric_value)
 
-        if 'tau' in default_metric_name:
-            threshold = hlp.get_tau_threshold_from_parameter(default_metric_name)
-            metric_value = compute_functions[default_metric_name](entries, circulation, threshold)
+            metrics_results[flagged_metric] = metric_value
+        all_metrics_results.append(metrics_results)
+
+    return all_metrics_results
+
+
+def get_distribution(entries):
+    """
+    Compresses a distribution of balances to run-length form, if it has sufficiently few distinct balances.
+    Distributions that are memory-mapped from disk (i.e. aggregated out of core) are not compressed, since the
+    compression creates arrays of the size of the distribution in memory, while the metrics read a memory-mapped
+    distribution chunk by chunk (see metrics.get_chunks).
+    :param entries: a numpy array in descending order
+    :returns: a tuple (entries, counts), where counts is a numpy array of the number of entities that hold each of
+    the balances in entries, or None if the distribution is not compressed
+    """
+    if isinstance(entries, np.memmap):
+        return entries, None
+    balances, counts = get_run_lengths(entries)
+    if len(balances) <= RUN_LENGTH_MAX_RATIO * len(entries):
+        return balances, counts
+    return entries, None
+
+
+def get_distribution_prefix(entries, counts, limit):
+    """
+    Keeps the given number of largest entries of a distribution
+    :param entries: a numpy array in descending order
+    :param counts: numpy array of the number of entities that hold each balance (run-length form) or None
+    :param limit: int, the number of entries to keep, or None to keep all entries
+    :returns: a tuple (entries, counts) of the top entries, where the last run is truncated if needed
+    """
+    if limit is None:
+        return entries, counts
+    if counts is None:
+        return entries[:limit], None
+    cumulative_counts = np.cumsum(counts)
+    if len(cumulative_counts) == 0 or limit >= cumulative_counts[-1]:
+        return entries, counts
+    last_run = int(np.searchsorted(cumulative_counts, limit, side='left'))
+    counts = counts[:last_run + 1].copy()
+    counts[-1] -= cumulative_counts[last_run] - limit
+    if counts[-1] == 0:  # limit is 0
+        return entries[:0], counts[:0]
+    return entries[:last_run + 1], counts
+
+
+def get_top_entries(entries, limit, ordered=True):
+    """
+    Keeps the given number of largest entries of a distribution. Unless the entries are already in descending order,
+    the top entries are selected with a partial sort (which takes linear time) and only the selected entries are
+    sorted, so that a small top limit does not pay for sorting all entries.
+    :param entries: a numpy array
+    :param limit: int, the number of entries to keep, or None to keep all entries
+    :param ordered: boolean, whether the top entries are needed in descending order
+    :returns: a numpy array of the top entries, in descending order if ordered is True (otherwise in no particular
+    order)
+    """
+    if is_descending(entries):
+        return entries if limit is None else entries[:limit]
+    if limit is not None and limit < len(entries):
+        entries = np.partition(entries, len(entries) - limit)[len(entries) - limit:] if limit > 0 else entries[:0]
+    return np.sort(entries)[::-1] if ordered else entries
+
+
+def is_descending(entries):
+    """
+    Checks whether an array is sorted in descending order, chunk by chunk, so that an array that is memory-mapped
+    from disk is not loaded to memory at once
+    :param entries: a numpy array
+    :returns: boolean
+    """
+    for start in range(0, max(len(entries) - 1, 0), METRIC_CHUNK_SIZE):
+        chunk = entries[start:start + METRIC_CHUNK_SIZE + 1]
+        if not (chunk[:-1] >= chunk[1:]).all():
+            return False
+    return True
+
+
+def get_entity_balances(ledger, date, filename, exclude_contracts_flag, part=None):
+    """
+    Reads the balance entries of a snapshot and applies the address mapping on them
+    :param ledger: a string of a ledger's name
+    :param date: a string in YYYY-MM-DD format of the snapshot that is retrieved
+    :param filename: the path of a file that stores the snapshot's raw data
+    :param exclude_contracts_flag: boolean that determines whether to exclude contract addresses
+    :param part: a tuple (part index, number of parts) of the part of the file that is read or None for the whole
+    file (see snapshot_helper.get_snapshot_parts)
+    :returns: a generator of batches, where each batch is a tuple (entities, balances) of a list of entity strings
+    and a numpy array of their balances
+    """
+    # The mapping only needs to be consulted if addresses are clustered or contracts are excluded
+    resolve_entities = hlp.get_clustering_flag() or exclude_contracts_flag
+    # The compiled mapping index is shared by all workers; the mapping db is only used if the index is not available
+    mapping_index = get_worker_resource(('mapping_index', ledger), lambda: idx_hlp.load_mapping_index(
+        ledger, hlp.get_source_combination())) if resolve_entities else None
+    conn = get_worker_resource(('db', ledger), lambda: get_mapping_connector(ledger)) \
+        if resolve_entities and mapping_index is None else None
+    # The special addresses are compared to the (utf-8) bytes of the batches' addresses, before these are decoded
+    special_addresses = get_worker_resource(('special_addresses', ledger), lambda: np.array(
+        [address.encode() for address in hlp.get_special_addresses(ledger)], dtype=bytes))
+
+    address_count = 0
+    skipped_lookups = mapping_index['lookup_stats']['skipped_lookups'] if mapping_index is not None else 0
+    start_time = time.time()
+    # The batches are read and parsed in a background thread, while the previous batches are mapped and aggregated
+    snapshot_batches = snap_hlp.read_ahead(snap_hlp.get_snapshot_batches(
+        filename, ADDRESS_BATCH_SIZE, use_cache=hlp.get_cache_snapshots_flag(), part=part), READ_AHEAD_BATCHES)
+    for addresses, balances in snapshot_batches:
+        address_count += len(addresses)
+        if len(special_addresses) > 0:
+            kept = ~np.isin(addresses, special_addresses)
+            addresses, balances = addresses[kept], balances[kept]
+        addresses = snap_hlp.decode_addresses(addresses)
+        if not resolve_entities:
+            yield addresses, balances
+            continue
+
+        if mapping_index is not None:
+            found_indices, found_entities, found_contracts = idx_hlp.lookup_addresses_entities(mapping_index,
+                                                                                               addresses)
         else:
-            metric_value = compute_functions[default_metric_name](entries, circulation)
+            found_indices, found_entities, found_contracts = get_found_addresses_entities(
+                addresses, db_hlp.get_addresses_entities(conn, addresses))
+        # The mapped addresses are replaced by their entities and the contracts are masked out, as whole arrays
+        entities = np.array(addresses, dtype=object)
+        entities[found_indices] = found_entities
+        if exclude_contracts_flag and found_contracts.any():
+            kept = np.ones(len(addresses), dtype=bool)
+            kept[found_indices[found_contracts]] = False
+            entities, balances = entities[kept], balances[kept]
+        yield entities.tolist(), balances
+    elapsed_time = time.time() - start_time
+    if mapping_index is not None:
+        skipped_lookups = mapping_index['lookup_stats']['skipped_lookups'] - skipped_lookups
+    logging.info(f'{ledger} - {date}: processed {address_count} addresses in {elapsed_time:.1f} sec '
+                 f'({address_count / max(elapsed_time, 1e-9):.0f} addresses/sec, {skipped_lookups} mapping lookups '
+                 f'skipped by the filter)')
+
 
-        if any(['tau' in default_metric_name, 'total_entities' in default_metric_name]):
-            metric_value = int(metric_value)
+def get_found_addresses_entities(addresses, address_entities):
+    """
+    Converts the entities of a batch of addresses that are retrieved from the mapping db to the positional form of
+    index_helper.lookup_addresses_entities
+    :param addresses: a list of address strings
+    :param address_entities: a dictionary where the key is an address that is mapped and the value is a tuple
+    (entity, is_contract) (see db_helper.get_addresses_entities)
+    :returns: a tuple (found indices, entities, contracts) (see index_helper.lookup_addresses_entities)
+    """
+    found_indices = [idx for idx, address in enumerate(addresses) if address in address_entities]
+    found_entities = [address_entities[addresses[idx]] for idx in found_indices]
+    return (np.array(found_indices, dtype=np.int64), [entity for entity, _ in found_entities],
+            np.array([bool(is_contract) for _, is_contract in found_entities], dtype=bool))
 
-        metrics_results[flagged_metric] = metric_value
 
-    return metrics_results
+def get_mapping_connector(ledger):
+    """
+    Connects to the mapping database of a ledger and selects the configured combination of sources
+    :param ledger: a string of a ledger's name
+    :returns: a connector to the mapping database
+    """
+    conn = db_hlp.get_connector(db_hlp.get_db_filename(ledger))
+    db_hlp.select_sources(conn, hlp.get_source_combination(), hlp.get_active_sources())
+    return conn
 
 
 def get_entries(ledger, date, filename):
     """
     Collects the balance entries and applies the address mapping on them.
     Also applies filters on them based on the config flags.
-    Finally orders the entries in descending order.
+    If the snapshot is too large to be aggregated within the out-of-core memory budget, the aggregation is
+    spilled to disk (see spill_helper.aggregate_out_of_core).
     :param ledger: a string of a ledger's name
     :param date: a string in YYYY-MM-DD format of the snapshot that is retrieved
-    :param filename: the path of the file that stores the snapshot's raw data
-    :returns: a list of integers in descending order
+    The snapshot's files (or byte ranges of them, see snapshot_helper.get_snapshot_parts) are parsed, mapped and
+    partially aggregated in parallel, if multiple parse workers are configured and the snapshot is large enough.
+    :param filename: the path of the file that stores the snapshot's raw data (or of its shards, see
+    snapshot_helper.get_snapshot_files)
+    :returns: a numpy array of integers in no particular order (in descending order if aggregated out of core)
     """
-    exclude_below_fees_flag = hlp.get_exclude_below_fees_flag()
-    exclude_below_usd_cent_flag = hlp.get_exclude_below_usd_cent_flag()
     exclude_contracts_flag = hlp.get_exclude_contracts_flag()
 
-    median_tx_fee = hlp.get_median_tx_fee(ledger=ledger, date=date) \
-        if exclude_below_fees_flag else 0
-    usd_cent_equivalent = hlp.get_usd_cent_equivalent(ledger=ledger, date=date) \
-        if exclude_below_usd_cent_flag else 0
-    balance_threshold = max(median_tx_fee, usd_cent_equivalent)
+    # If multiple balance thresholds are analyzed, the entities are aggregated once, above the lowest of them
+    balance_threshold = min(hlp.get_balance_threshold_value(ledger, date, balance_threshold)
+                            for balance_threshold in hlp.get_balance_thresholds())
 
-    conn = db_hlp.get_connector(db_hlp.get_db_filename(ledger))
-    special_addresses = hlp.get_special_addresses(ledger)
-
-    with open(filename) as f:
-        csv_reader = csv.reader(f)
-        next(csv_reader)
-        clustered_balances = defaultdict(int)
-        for line in csv_reader:
-            address, balance = line[0], int(line[-1])
-            if address in special_addresses:
-                continue
-            entity, is_contract = db_hlp.get_address_entity(conn, address)
-            if not (exclude_contracts_flag and is_contract):
-                clustered_balances[entity] += balance
+    parse_workers = hlp.get_parse_workers()
+    parts = snap_hlp.get_snapshot_parts(filename, parse_workers)
+    if parse_workers > 1 and len(parts) > 1:
+        logging.info(f'{ledger} - {date}: parsing {len(parts)} parts in parallel')
+        entity_balances = get_parallel_entity_balances(ledger, date, parts, exclude_contracts_flag, parse_workers)
+    else:
+        entity_balances = chain.from_iterable(get_entity_balances(ledger, date, part_filename, exclude_contracts_flag,
+                                                                  part) for part_filename, part in parts)
 
-    entries = []
-    while clustered_balances:
-        item = clustered_balances.popitem()
-        if item[1] > balance_threshold:
-            entries.append(item[1])
-    entries.sort(reverse=True)
+    memory_budget = hlp.get_out_of_core_memory_budget()
+    if memory_budget is not None:
+        data_size = hlp.get_in_memory_size(snap_hlp.get_snapshot_size(filename))
+        if data_size > memory_budget:
+            logging.info(f'{ledger} - {date}: aggregating out of core')
+            output_dir = hlp.get_output_directory()
+            return spill_hlp.aggregate_out_of_core(entity_balances, balance_threshold, data_size, memory_budget,
+                                                   aggregate_entity_balances,
+                                                   spill_parent_dir=output_dir if output_dir.is_dir() else None)
 
-    return entries
+    # The entries are not sorted here, since only the top entries may be needed (see get_top_entries)
+    return aggregate_entity_balances(entity_balances, balance_threshold)
 
 
-def analyze_ledger_snapshot(ledger, date, output_rows, sema):
+def get_entity_fingerprints(entities):
+    """
+    Interns entity names to 128-bit fingerprints, i.e. the built-in hashes of each name and of the reversed name,
+    which are computed in C and are two independent 64-bit hashes (the hash of strings is keyed by a random seed), so
+    distinct entities practically never share a fingerprint. The seed differs between processes, so fingerprints
+    should only be compared within the same process.
+    :param entities: a sequence of entity strings
+    :returns: a tuple of two int64 numpy arrays
+    """
+    return (np.fromiter(map(hash, entities), dtype=np.int64, count=len(entities)),
+            np.fromiter((hash(entity[::-1]) for entity in entities), dtype=np.int64, count=len(entities)))
+
+
+def aggregate_entity_balances(entity_balances, balance_threshold):
+    """
+    Aggregates the balances of each entity. Instead of keying the balances by the entity strings, each entity is
+    interned to a fingerprint (see get_entity_fingerprints), so each (entity, balance) entry is kept as 24 bytes in
+    numpy arrays. The entries are then sorted by fingerprint, s.t. each entity gets a dense ID (the index of its group
+    of entries), and the balances of each group are summed in a single pass.
+    :param entity_balances: an iterable of batches, where each batch is a tuple (entities, balances) of a list of entity
+    strings and their balances (a list or a numpy array)
+    :param balance_threshold: entities with aggregate balance not larger than this threshold are excluded
+    :returns: a numpy array of the entities' aggregate balances (int64, or float64 if they may exceed the int64 range)
+    """
+    first_hash_arrays, second_hash_arrays, balance_arrays = [], [], []
+    for entities, balances in entity_balances:
+        if not entities:
+            continue
+        first_hashes, second_hashes = get_entity_fingerprints(entities)
+        first_hash_arrays.append(first_hashes)
+        second_hash_arrays.append(second_hashes)
+        balance_arrays.append(get_balance_array(balances))
+    if not balance_arrays:
+        return np.array([], dtype=np.int64)
+
+    first_hashes, second_hashes = np.concatenate(first_hash_arrays), np.concatenate(second_hash_arrays)
+    balances = np.concatenate(balance_arrays)
+    del first_hash_arrays, second_hash_arrays, balance_arrays
+    if balances.dtype == np.int64 and balances.sum(dtype=np.float64) >= INT64_MAX:
+        balances = balances.astype(np.float64)  # The sum of an entity's balances might overflow
+
+    order, group_starts = get_entity_groups(first_hashes, second_hashes)
+    del first_hashes, second_hashes
+    balances = balances[order]
+    del order
+    entries = np.add.reduceat(balances, group_starts)
+    return entries[entries > balance_threshold]
+
+
+def get_entity_groups(first_hashes, second_hashes):
+    """
+    Groups the entries of each entity, by sorting the entries by their entities' fingerprints
+    :param first_hashes: int64 numpy array of the first hashes of the entries' fingerprints
+    :param second_hashes: int64 numpy array of the second hashes of the entries' fingerprints
+    :returns: a tuple (order, group_starts) of numpy arrays, where order is the permutation that sorts the entries by
+    fingerprint and group_starts are the positions (in sorted order) where the entries of each entity start
+    """
+    # Sorting by the first hash suffices, unless distinct entities share their first hash (which is extremely rare)
+    order = np.argsort(first_hashes)
+    first_hashes, second_hashes = first_hashes[order], second_hashes[order]
+    same_first_hash = first_hashes[1:] == first_hashes[:-1]
+    if np.any(same_first_hash & (second_hashes[1:] != second_hashes[:-1])):
+        suborder = np.lexsort((second_hashes, first_hashes))
+        order, first_hashes, second_hashes = order[suborder], first_hashes[suborder], second_hashes[suborder]
+        same_first_hash = first_hashes[1:] == first_hashes[:-1]
+    group_starts = np.flatnonzero(np.concatenate(([True], ~same_first_hash | (second_hashes[1:] != second_hashes[:-1]))))
+    return order, group_starts
+
+
+def aggregate_snapshot_part(ledger, date, filename, part, exclude_contracts_flag):
+    """
+    Parses, maps and aggregates a part of a snapshot, in a worker process of get_parallel_entity_balances. The sums
+    are exact (i.e. kept as Python ints if they may exceed the int64 range), so the partial sums of the parts can
+    be merged like any other entity balances.
+    :param ledger: a string of a ledger's name
+    :param date: a string in YYYY-MM-DD format of the snapshot that is retrieved
+    :param filename: the path of a file that stores the snapshot's raw data
+    :param part: a tuple (part index, number of parts) of the part of the file or None for the whole file
+    :param exclude_contracts_flag: boolean that determines whether to exclude contract addresses
+    :returns: a tuple (entities, balances) of two lists with the aggregate balance of each entity in the part
+    """
+    entities, balance_arrays = [], []
+    for batch_entities, batch_balances in get_entity_balances(ledger, date, filename, exclude_contracts_flag, part):
+        entities.extend(batch_entities)
+        balance_arrays.append(np.asarray(batch_balances))
+    if not entities:
+        return [], []
+
+    balance_array = np.concatenate(balance_arrays)
+    del balance_arrays
+    if balance_array.dtype != np.int64 or balance_array.sum(dtype=np.float64) >= INT64_MAX:
+        balance_array = balance_array.astype(object)
+    order, group_starts = get_entity_groups(*get_entity_fingerprints(entities))
+    entity_sums = np.add.reduceat(balance_array[order], group_starts)
+    return np.array(entities, dtype=object)[order[group_starts]].tolist(), entity_sums.tolist()
+
+
+def get_parallel_entity_balances(ledger, date, parts, exclude_contracts_flag, max_workers):
+    """
+    Parses, maps and partially aggregates the parts of a snapshot in parallel processes
+    :param ledger: a string of a ledger's name
+    :param date: a string in YYYY-MM-DD format of the snapshot that is retrieved
+    :param parts: a list of tuples (file, part), as returned by snapshot_helper.get_snapshot_parts
+    :param exclude_contracts_flag: boolean that determines whether to exclude contract addresses
+    :param max_workers: the max number of parallel processes
+    :returns: a generator of batches, where each batch is a tuple (entities, balances) with the partial aggregate
+    balances of the entities of a part
+    """
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(parts)), initializer=init_worker) as executor:
+        futures = {executor.submit(aggregate_snapshot_part, ledger, date, part_filename, part, exclude_contracts_flag)
+                   for part_filename, part in parts}
+        for future in as_completed(futures):
+            futures.remove(future)  # The result of each part is released once it has been aggregated
+            yield future.result()
+
+
+def init_worker():
+    """
+    Initializes a long-lived worker process of the analysis pool, s.t. per-ledger resources are kept across its jobs
+    """
+    global worker_state
+    worker_state = {}
+
+
+def get_worker_resource(key, create_resource):
+    """
+    Retrieves a resource (e.g. a db connector) that is kept warm across the jobs of a worker process.
+    Outside worker processes the resource is created on every call.
+    :param key: a hashable that identifies the resource
+    :param create_resource: a function that creates the resource
+    :returns: the resource
+    """
+    if worker_state is None:
+        return create_resource()
+    if key not in worker_state:
+        worker_state[key] = create_resource()
+    return worker_state[key]
+
+
+def analyze_ledger_snapshot(ledger, date, input_filename):
     """
     Executes the analysis of a given ledgers and snapshot date.
     :param ledger: a ledger name
     :param date: a string in YYYY-MM-DD format
-    :param output_rows: a list of strings in the form of csv output rows
-    :param sema: a multiprocessing semaphore
+    :param input_filename: the path of the file that stores the snapshot's raw data
+    :returns: a list of the csv output rows of the snapshot, one for each combination of balance threshold and top
+    limit (see helper.get_balance_thresholds and helper.get_top_limits)
     """
-    row = None
+    logging.info(f'[*] {ledger} - {date}')
 
-    try:
-        with open(hlp.get_output_filename()) as f:
-            csv_reader = csv.reader(f)
-            for line in csv_reader:
-                if line[0] == ledger and line[1] == date:
-                    row = line
-                    break
-    except FileNotFoundError:
-        pass
+    entries = get_entries(ledger, date, input_filename)
+    top_limits = hlp.get_top_limits()
+    balance_thresholds = hlp.get_balance_thresholds()
+    threshold_values = [hlp.get_balance_threshold_value(ledger, date, balance_threshold)
+                        for balance_threshold in balance_thresholds]
+    metrics_values = analyze_snapshot_sweep(entries, top_limits, list(zip(balance_thresholds, threshold_values)))
+    del entries
+
+    return [hlp.get_output_row(ledger, date, combination_metrics_values, top_limit, balance_threshold)
+            for (balance_threshold, top_limit), combination_metrics_values in zip(product(balance_thresholds,
+                                                                                          top_limits),
+                                                                                  metrics_values)]
 
-    if not row:
-        input_filename = None
-        input_paths = [input_dir / f'{ledger}_{date}_raw_data.csv' for input_dir in hlp.get_input_directories()]
-        for filename in input_paths:
-            if os.path.isfile(filename):
-                input_filename = filename
-                break
-        if input_filename:
-            logging.info(f'[*] {ledger} - {date}')
 
-            entries = get_entries(ledger, date, filename)
-            metrics_values = analyze_snapshot(entries)
-            del entries
+def plan_jobs(ledgers, snapshot_dates):
+    """
+    Determines the snapshots that need to be analyzed, i.e. those that have raw data in the input directories but
+    no row in the existing output file for some top limit or balance threshold, and logs a summary of the plan.
+    :param ledgers: a list of ledger names
+    :param snapshot_dates: a list of strings in YYYY-MM-DD format
+    :returns: a tuple (jobs, existing_rows), where jobs is a list of tuples (input data size, ledger, date,
+    input filename) sorted by descending data size (see helper.get_input_data_size) and existing_rows is a list of the output rows that have already
+    been computed for the given ledgers and dates
+    """
+    output_rows_index = hlp.read_csv_output()
+    input_catalog = hlp.get_input_catalog()
+    sweep_columns = {tuple(str(column) for column in hlp.get_sweep_columns(top_limit, balance_threshold))
+                     for balance_threshold, top_limit in product(hlp.get_balance_thresholds(), hlp.get_top_limits())}
 
-            row = hlp.get_output_row(ledger, date, metrics_values)
+    jobs, existing_rows = [], []
+    computed_snapshots, missing_inputs = 0, 0
+    for ledger in ledgers:
+        for date in snapshot_dates:
+            # A snapshot is analyzed again if the output file has no row for some top limit or balance threshold
+            # (e.g. one that was added to a sweep)
+            rows = output_rows_index.get((ledger, date), [])
+            if sweep_columns <= {tuple(row[4:4 + len(columns)]) for row in rows for columns in sweep_columns}:
+                existing_rows.extend(rows)
+                computed_snapshots += 1
+                continue
+            input_info = input_catalog.get((ledger, date))
+            if input_info is None:
+                missing_inputs += 1
+                continue
+            jobs.append((hlp.get_input_data_size(input_info['path'], input_info['size']), ledger, date,
+                         input_info['path']))
+    jobs.sort(reverse=True)
 
-    if row:
-        output_rows.append(row)
+    logging.info(f'Analysis plan: {len(jobs)} jobs to run, {computed_snapshots + missing_inputs} jobs skipped '
+                 f'({computed_snapshots} already computed, {missing_inputs} without input data), '
+                 f'{sum(job[0] for job in jobs) / 10**9:.2f} GB of raw data to read')
 
-    sema.release()  # Release the semaphore s.t. the loop in analyze() can continue
+    return jobs, existing_rows
 
 
 def analyze(ledgers, snapshot_dates):
     """
     Executes the analysis of the given ledgers for the snapshot dates and writes the output
     to csv files.
+    Only the snapshots that have raw data and have not already been analyzed are run (see plan_jobs).
+    The snapshots of all ledgers are analyzed by a pool of long-lived worker processes. Jobs are submitted
+    largest input file first, as long as the estimated memory of the running jobs fits in the system's memory;
+    when the next largest job does not fit, smaller jobs are submitted in its place. The input of the next pending
+    job is prefetched to the page cache while the running jobs compute.
+    If a job fails, its error is logged and the remaining jobs continue, s.t. the rows of all other snapshots are
+    still written to the output.
     :param ledgers: a list of ledger names
     :param snapshot_dates: a list of strings in YYYY-MM-DD format
     """
-    manager = multiprocessing.Manager()
-    output_rows = manager.list()  # output_rows is a shared list across all parallel processes
+    jobs, output_rows = plan_jobs(ledgers, snapshot_dates)
 
     concurrency = hlp.get_concurrency_per_ledger()
-    for ledger in ledgers:
-        sema = multiprocessing.Semaphore(concurrency[ledger])
-        jobs = []
-        for date in snapshot_dates:
-            sema.acquire()  # Loop blocks here while the active processes are as many as the semaphore's limit
-            p = multiprocessing.Process(target=analyze_ledger_snapshot, args=(ledger, date, output_rows, sema))
-            jobs.append(p)
-            p.start()
-        for proc in jobs:
-            proc.join()
+    max_workers = max((concurrency[ledger] for ledger in ledgers), default=1)
+    memory_budget = hlp.get_memory_budget()
+
+    running_jobs = {}  # Maps the future of each running job to a tuple (estimated memory, ledger, date)
+    prefetched_jobs = set()
+    failed_snapshots = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        while jobs or running_jobs:
+            reserved_memory = sum(running_job[0] for running_job in running_jobs.values())
+            for job in list(jobs):
+                if len(running_jobs) >= max_workers:
+                    break
+                file_size, ledger, date, input_filename = job
+                memory_estimate = hlp.get_memory_estimate(file_size)
+                if running_jobs and reserved_memory + memory_estimate > memory_budget:
+                    continue
+                future = executor.submit(analyze_ledger_snapshot, ledger, date, input_filename)
+                running_jobs[future] = (memory_estimate, ledger, date)
+                reserved_memory += memory_estimate
+                jobs.remove(job)
+            if jobs and jobs[0] not in prefetched_jobs:
+                # The input of the next job is loaded in the background, while the running jobs compute
+                snap_hlp.prefetch_snapshot(jobs[0][3])
+                prefetched_jobs.add(jobs[0])
+
+            done, _ = wait(running_jobs, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, ledger, date = running_jobs.pop(future)
+                try:
+                    output_rows.extend(future.result())
+                except Exception:
+                    logging.exception(f'Analysis of {ledger} on {date} failed')
+                    failed_snapshots.append((ledger, date))
 
     hlp.write_csv_output(sorted(output_rows, key=lambda x: (x[0], x[1])))  # Csv rows ordered by ledger and date
+    if failed_snapshots:
+        logging.error(f'Analysis failed for {len(failed_snapshots)} snapshots: '
+                      f'{", ".join(f"{ledger} on {date}" for ledger, date in sorted(failed_snapshots))}')
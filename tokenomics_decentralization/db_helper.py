@@ -1,24 +1,79 @@
 import sqlite3
+import hashlib
+from itertools import islice
+import numpy as np
 import tokenomics_decentralization.helper as hlp
 
+MAPPING_BATCH_SIZE = 100000  # Number of mapping lines that are inserted in (or compared to) the records table at once
+
+# Pragmas of the connections that (bulk-)load the mapping; the db is rebuilt from the mapping information if the load
+# fails, so durability is traded for speed. The cache size is given in KiB (negative value).
+LOADER_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -512000,
+    'temp.cache_size': -512000,
+}
+
+
+# The mapping of an address is resolved at query time from its active records: an entity that is part of a cluster (of
+# the selected combination) is mapped to the cluster (if the entity name is part of multiple clusters, the cluster with
+# the largest name is chosen) and repeated records of an address keep the value of is_contract of the first one.
+# In an aggregate query with MIN, SQLite takes the bare columns from the row that has the minimum value.
+MAPPING_COLUMNS = ('records.address AS address, '
+                   'COALESCE((SELECT MAX(cluster) FROM clusters WHERE clusters.combination = '
+                   '(SELECT combination FROM active_combination) AND clusters.entity = records.entity), '
+                   'records.entity) AS entity, '
+                   'records.is_contract AS is_contract, MIN(records.rowid) AS record_id')
+ACTIVE_RECORDS_FILTER = ('(NOT EXISTS (SELECT 1 FROM active_combination) OR '
+                         'records.source IN (SELECT source FROM active_sources))')
+
 
 def create_tables(conn):
     c = conn.cursor()
 
-    create_mapping = '''
-    CREATE TABLE IF NOT EXISTS mapping (
-        id INTEGER PRIMARY KEY,
-        address TEXT NOT NULL UNIQUE,
+    # The lines of the mapping file (of all sources), which the mapping and the clusters are derived from
+    create_records = '''
+    CREATE TABLE IF NOT EXISTS records (
+        address TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        source TEXT NOT NULL,
+        is_contract BIT DEFAULT 0,
+        record_hash INTEGER NOT NULL
+    );
+    '''
+    c.execute(create_records)
+
+    # The clusters of each combination of clustering sources
+    create_clusters = '''
+    CREATE TABLE IF NOT EXISTS clusters (
+        combination TEXT NOT NULL,
         entity TEXT NOT NULL,
-        is_contract BIT DEFAULT 0
+        source TEXT NOT NULL,
+        cluster TEXT NOT NULL,
+        PRIMARY KEY (combination, entity, source)
+    );
+    '''
+    c.execute(create_clusters)
+    c.execute('CREATE INDEX IF NOT EXISTS clusters_cluster ON clusters(combination, cluster)')
+
+    create_metadata = '''
+    CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
     );
     '''
-    c.execute(create_mapping)
+    c.execute(create_metadata)
+
+    # The selected combination of sources of the connection; if no sources are selected, all records are active
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS active_combination (combination TEXT NOT NULL)')
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS active_sources (source TEXT PRIMARY KEY)')
+    c.execute(f'CREATE TEMP VIEW IF NOT EXISTS mapping AS SELECT address, entity, is_contract FROM '
+              f'(SELECT {MAPPING_COLUMNS} FROM records WHERE {ACTIVE_RECORDS_FILTER} GROUP BY records.address)')
 
 
 def get_db_filename(ledger):
-    db_filename = '_'.join([ledger] + sorted(hlp.get_active_source_keywords()))
-    return hlp.MAPPING_INFO_DIR / f'addresses/{db_filename}.db'
+    return hlp.MAPPING_INFO_DIR / f'addresses/{ledger}.db'
 
 
 def get_connector(db_filename):
@@ -33,24 +88,297 @@ def commit_database(conn):
     conn.commit()
 
 
-def insert_mapping(conn, address, entity, is_contract):
+def clear_mapping(conn):
+    """
+    Deletes all entries of the mapping database, s.t. the mapping can be rebuilt from scratch
+    :param conn: a connector to the mapping database
+    """
     c = conn.cursor()
-    try:
-        c.execute('INSERT INTO mapping(address, entity, is_contract) VALUES (?, ?, ?)', (address, entity, is_contract))
-    except sqlite3.IntegrityError as e:
-        if 'UNIQUE constraint failed' in str(e):
-            existing_entity = get_address_entity(conn, address)[0]
-            if existing_entity == entity:
-                pass
-            else:
-                raise ValueError(f'Same address {address} associated with two entities: {entity} and {existing_entity}')
-        else:
-            raise e
+    for table_name in ['records', 'clusters', 'metadata']:
+        c.execute(f'DELETE FROM {table_name}')
+
+
+def insert_mapping(conn, address, entity, is_contract, source=''):
+    """
+    Inserts the mapping of an address as a record of the given source, unless the address is already mapped
+    :param conn: a connector to the mapping database
+    :param address: an address string
+    :param entity: the entity that the address is associated with
+    :param is_contract: boolean that determines whether the address is a contract
+    :param source: the source of the mapping
+    :raises ValueError: if the address is already mapped to another entity
+    """
+    existing_entity = get_addresses_entities(conn, [address]).get(address)
+    if existing_entity is None:
+        insert_records(conn, [(address, entity, source, is_contract)])
+    elif existing_entity[0] != entity:
+        raise ValueError(f'Same address {address} associated with two entities: {entity} and {existing_entity[0]}')
 
 
 def get_address_entity(conn, address):
+    return get_addresses_entities(conn, [address]).get(address, (address, 0))
+
+
+def get_addresses_entities(conn, addresses):
+    """
+    Retrieves the entities of a batch of addresses with a single join against the records of the selected sources.
+    The addresses are loaded in a temporary table, so the whole batch is resolved within one statement.
+    :param conn: a connector to the mapping database
+    :param addresses: an iterable of address strings
+    :returns: a dictionary where the key is an address that is mapped and the value is a tuple
+    (entity, is_contract); addresses that are not mapped are omitted
+    """
+    c = conn.cursor()
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS address_batch (address TEXT NOT NULL)')
+    c.execute('DELETE FROM address_batch')
+    c.executemany('INSERT INTO address_batch(address) VALUES (?)', ((address, ) for address in addresses))
+    entries = c.execute(f'SELECT {MAPPING_COLUMNS} FROM address_batch JOIN records ON records.address = address_batch.address '
+                        f'WHERE {ACTIVE_RECORDS_FILTER} GROUP BY records.address').fetchall()
+    return {address: (entity, is_contract) for address, entity, is_contract, _ in entries}
+
+
+def select_sources(conn, combination, sources):
+    """
+    Selects the combination of sources whose records (and clusters) form the mapping, for the queries of the given
+    connection
+    :param conn: a connector to the mapping database
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    :param sources: an iterable of the combination's source strings
+    """
+    c = conn.cursor()
+    c.execute('DELETE FROM active_combination')
+    c.execute('INSERT INTO active_combination(combination) VALUES (?)', (combination, ))
+    c.execute('DELETE FROM active_sources')
+    c.executemany('INSERT OR IGNORE INTO active_sources(source) VALUES (?)', ((source, ) for source in sources))
+
+
+def set_loader_pragmas(conn):
+    """
+    Applies the pragmas of the bulk-load profile (see LOADER_PRAGMAS) on a connection. Should be called outside
+    of a transaction, since the journal mode cannot change within one.
+    :param conn: a connector to the mapping database
+    """
+    c = conn.cursor()
+    for pragma, value in LOADER_PRAGMAS.items():
+        c.execute(f'PRAGMA {pragma} = {value}')
+
+
+def get_record_hash(record):
+    """
+    Computes a (persistent) 64-bit hash of a line of the mapping file, which identifies the line when the records of
+    the database are compared to the mapping file
+    :param record: a tuple (address, entity, source, is_contract)
+    :returns: a signed 64-bit integer
+    """
+    address, entity, source, is_contract = record
+    digest = hashlib.blake2b(f'{address}\x1f{entity}\x1f{source}\x1f{int(is_contract)}'.encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def insert_records(conn, records):
+    """
+    Inserts lines of the mapping file in the records table in batches
+    :param conn: a connector to the mapping database
+    :param records: an iterable of tuples (address, entity, source, is_contract)
+    """
+    c = conn.cursor()
+    records = iter(records)
+    while True:
+        batch = [record + (get_record_hash(record), ) for record in islice(records, MAPPING_BATCH_SIZE)]
+        if not batch:
+            break
+        c.executemany('INSERT INTO records(address, entity, source, is_contract, record_hash) VALUES (?, ?, ?, ?, ?)',
+                      batch)
+
+
+def update_records(conn, records):
+    """
+    Updates the records table with the lines of the mapping file. If the table is empty, all lines are inserted and
+    the table's indexes are built after the load. Otherwise, only the differences are applied: the hash of each line
+    is looked up in the (sorted) hashes of the existing records, the lines that are not found are inserted and the
+    records whose hash is not found in the file are removed.
+    :param conn: a connector to the mapping database
+    :param records: an iterable of tuples (address, entity, source, is_contract)
+    :returns: None if the table was empty, otherwise a list of (address, entity, source) tuples of the records that
+    were added or removed
+    """
+    c = conn.cursor()
+    # The hashes of the existing records are streamed in an array, since the table may have hundreds of millions of rows
+    existing_records = np.fromiter(c.execute('SELECT record_hash, rowid FROM records'),
+                                   dtype=[('record_hash', np.int64), ('rowid', np.int64)])
+    if len(existing_records) == 0:
+        insert_records(conn, records)
+        c.execute('CREATE INDEX IF NOT EXISTS records_address ON records(address)')
+        c.execute('CREATE INDEX IF NOT EXISTS records_entity ON records(entity, source)')
+        return None
+
+    existing_records.sort(order='record_hash')
+    existing_hashes, existing_rowids = existing_records['record_hash'], existing_records['rowid']
+
+    found_hashes, added_records = [], {}
+    records = iter(records)
+    while True:
+        batch = list(islice(records, MAPPING_BATCH_SIZE))
+        if not batch:
+            break
+        batch_hashes = np.array([get_record_hash(record) for record in batch], dtype=np.int64)
+        indices = np.minimum(np.searchsorted(existing_hashes, batch_hashes), len(existing_hashes) - 1)
+        found = existing_hashes[indices] == batch_hashes
+        found_hashes.append(batch_hashes[found])
+        for idx in np.flatnonzero(~found):
+            added_records.setdefault(int(batch_hashes[idx]), batch[idx])
+
+    # If the mapping file is empty, no record is found, so all existing records are removed
+    found_hashes = np.concatenate(found_hashes) if found_hashes else np.array([], dtype=np.int64)
+    removed_rowids = existing_rowids[~np.isin(existing_hashes, found_hashes)]
+    load_temp_table(conn, 'lookup_rowids', ['record_id'], ((int(rowid), ) for rowid in removed_rowids))
+    removed_records = c.execute('SELECT address, entity, source FROM records '
+                                'WHERE rowid IN (SELECT record_id FROM lookup_rowids)').fetchall()
+    c.execute('DELETE FROM records WHERE rowid IN (SELECT record_id FROM lookup_rowids)')
+    insert_records(conn, added_records.values())
+
+    return list(set(removed_records) | {(address, entity, source) for address, entity, source, _ in
+                                        added_records.values()})
+
+
+def load_temp_table(conn, table_name, columns, rows):
+    """
+    (Re)creates a temporary table and loads the given rows in it. Temporary tables are used to pass a set of
+    values (e.g. a batch of addresses) to a query.
+    :param conn: a connector to the mapping database
+    :param table_name: the name of the temporary table
+    :param columns: a list of the table's column names
+    :param rows: an iterable of tuples with a value for each column
+    """
+    c = conn.cursor()
+    c.execute(f'DROP TABLE IF EXISTS temp.{table_name}')
+    c.execute(f'CREATE TEMP TABLE {table_name} ({", ".join(columns)}, PRIMARY KEY ({", ".join(columns)}))')
+    c.executemany(f'INSERT OR IGNORE INTO {table_name} VALUES ({", ".join("?" * len(columns))})', rows)
+
+
+def get_multi_entity_address_items(conn, addresses=None):
+    """
+    Retrieves the entities of the addresses that are associated with more than one entities (in distinct records of
+    all sources), i.e. the addresses that form clusters
+    :param conn: a connector to the mapping database
+    :param addresses: an iterable of addresses to look up or None to look up all addresses
+    :returns: a dictionary that maps each multi-entity address to the set of its (entity, source) tuples from active
+    sources
+    """
+    c = conn.cursor()
+    address_filter = ''
+    if addresses is not None:
+        load_temp_table(conn, 'lookup_addresses', ['address'], ((address, ) for address in addresses))
+        address_filter = 'WHERE address IN (SELECT address FROM lookup_addresses)'
+    entries = c.execute(f'SELECT address, entity, source FROM records WHERE address IN '
+                        f'(SELECT address FROM records {address_filter} GROUP BY address HAVING COUNT(DISTINCT record_hash) > 1) '
+                        f'AND {ACTIVE_RECORDS_FILTER}')
+    address_items = {}
+    for address, entity, source in entries:
+        address_items.setdefault(address, set()).add((entity, source))
+    return address_items
+
+
+def get_items_addresses(conn, items):
+    """
+    Retrieves the addresses that are associated with the given entities
+    :param conn: a connector to the mapping database
+    :param items: an iterable of (entity, source) tuples
+    :returns: a set of addresses
+    """
+    load_temp_table(conn, 'lookup_items', ['entity', 'source'], items)
+    entries = conn.cursor().execute('SELECT records.address FROM lookup_items JOIN records USING (entity, source)')
+    return {address for address, in entries}
+
+
+def get_cluster_members(conn, items):
+    """
+    Retrieves all members of the (stored) clusters of the selected combination that the given entities belong to
+    :param conn: a connector to the mapping database
+    :param items: an iterable of (entity, source) tuples
+    :returns: a set of (entity, source) tuples
+    """
+    load_temp_table(conn, 'lookup_items', ['entity', 'source'], items)
+    entries = conn.cursor().execute('SELECT entity, source FROM clusters '
+                                    'WHERE combination = (SELECT combination FROM active_combination) AND cluster IN '
+                                    '(SELECT clusters.cluster FROM lookup_items JOIN clusters USING (entity, source) '
+                                    'WHERE clusters.combination = (SELECT combination FROM active_combination))')
+    return set(entries)
+
+
+def update_clusters(conn, entity_clusters, items=None):
+    """
+    Replaces the stored clusters of the given entities for the selected combination of sources
+    :param conn: a connector to the mapping database
+    :param entity_clusters: a dictionary that maps (entity, source) tuples to their (new) cluster
+    :param items: an iterable of the (entity, source) tuples whose clusters are replaced or None to replace all
+    clusters of the combination; items that are not in entity_clusters are no longer part of a cluster
+    """
+    c = conn.cursor()
+    combination = c.execute('SELECT combination FROM active_combination').fetchone()[0]
+    if items is None:
+        c.execute('DELETE FROM clusters WHERE combination = ?', (combination, ))
+    else:
+        load_temp_table(conn, 'lookup_items', ['entity', 'source'], items)
+        c.execute('DELETE FROM clusters WHERE combination = ? AND (entity, source) IN '
+                  '(SELECT entity, source FROM lookup_items)', (combination, ))
+    c.executemany('INSERT INTO clusters(combination, entity, source, cluster) VALUES (?, ?, ?, ?)',
+                  ((combination, entity, source, cluster) for (entity, source), cluster in entity_clusters.items()))
+
+
+def get_entities_addresses(conn, entities):
+    """
+    Retrieves the addresses that are associated with the given entity names (under any active source)
+    :param conn: a connector to the mapping database
+    :param entities: an iterable of entity names
+    :returns: a set of addresses
+    """
+    load_temp_table(conn, 'lookup_entities', ['entity'], ((entity, ) for entity in entities))
+    entries = conn.cursor().execute(f'SELECT records.address FROM lookup_entities JOIN records USING (entity) '
+                                    f'WHERE {ACTIVE_RECORDS_FILTER}')
+    return {address for address, in entries}
+
+
+def check_mapping_conflicts(conn, addresses=None):
+    """
+    Checks that no address is associated with two entities in the mapping of the selected sources. All conflicts are
+    detected with a single grouping pass.
+    :param conn: a connector to the mapping database
+    :param addresses: an iterable of the addresses that are checked or None to check all addresses
+    :raises ValueError: if the same address is associated with two entities
+    """
     c = conn.cursor()
-    entry = c.execute('SELECT entity, is_contract FROM mapping WHERE address=?', (address, )).fetchone()
-    if entry is not None:
-        return entry
-    return (address, 0)
+    address_filter = ''
+    if addresses is not None:
+        load_temp_table(conn, 'lookup_addresses', ['address'], ((address, ) for address in addresses))
+        address_filter = 'AND records.address IN (SELECT address FROM lookup_addresses)'
+    conflict = c.execute(f'SELECT address, MIN(entity), MAX(entity) FROM '
+                         f'(SELECT records.address AS address, COALESCE((SELECT MAX(cluster) FROM clusters '
+                         f'WHERE clusters.combination = (SELECT combination FROM active_combination) '
+                         f'AND clusters.entity = records.entity), records.entity) AS entity '
+                         f'FROM records WHERE {ACTIVE_RECORDS_FILTER} {address_filter}) '
+                         f'GROUP BY address HAVING MIN(entity) != MAX(entity) LIMIT 1').fetchone()
+    if conflict is not None:
+        address, entity, existing_entity = conflict
+        raise ValueError(f'Same address {address} associated with two entities: {entity} and {existing_entity}')
+
+
+def get_metadata(conn, key):
+    """
+    Retrieves a value of the database's metadata
+    :param conn: a connector to the mapping database
+    :param key: the key of the metadata value
+    :returns: the value (a string) or None if the key does not exist
+    """
+    entry = conn.cursor().execute('SELECT value FROM metadata WHERE key = ?', (key, )).fetchone()
+    return entry[0] if entry is not None else None
+
+
+def set_metadata(conn, key, value):
+    """
+    Sets a value of the database's metadata
+    :param conn: a connector to the mapping database
+    :param key: the key of the metadata value
+    :param value: a string
+    """
+    conn.cursor().execute('INSERT OR REPLACE INTO metadata(key, value) VALUES (?, ?)', (key, value))
@@ -7,16 +7,31 @@ import os
 import datetime
 import calendar
 import psutil
+import numpy as np
 import json
+import re
+import hashlib
 from collections import defaultdict
 import logging
 from yaml import safe_load
 from dateutil.rrule import rrule, MONTHLY, WEEKLY, YEARLY, DAILY
+try:
+    from orjson import loads as json_loads  # Optional faster decoder for the (multi-GB) mapping files
+except ImportError:
+    json_loads = json.loads
 
 ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
 MAPPING_INFO_DIR = ROOT_DIR / 'mapping_information'
 TX_FEES_DIR = ROOT_DIR / 'tx_fees'
 PRICE_DATA_DIR = ROOT_DIR / 'price_data'
+SNAPSHOT_CACHE_DIR_NAME = 'cache'
+# Raw data files, with an optional shard number and an optional compression suffix
+INPUT_FILENAME_PATTERN = re.compile(r'^(.+)_(\d{4}-\d{2}-\d{2})_raw_data(_\d+)?\.csv(?:\.gz|\.bz2|\.xz|\.zst)?$')
+COMPRESSED_INPUT_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst']
+COMPRESSION_RATIO_ESTIMATE = 10  # The (conservatively high) ratio of the raw data size to the size of a compressed file
+PARSE_PART_MEMORY_RATIO = 4  # The ratio of the memory of the entities of a part that a parse worker aggregates to the size of the part
+
+input_catalog = None  # The catalog of input files, loaded once per execution (see get_input_catalog)
 
 with open(ROOT_DIR / "config.yaml") as f:
     config = safe_load(f)
@@ -167,8 +182,16 @@ def get_tau_thresholds():
     Reads the config file and retrieves the thresholds of tau decentralization
     :returns: a list of floating point thresholds to be used to compute tau decentralization
     """
-    config = get_config_data()
-    return [float(name.split('=')[1].strip()) for name in config['metrics'] if 'tau' in name]
+    return [get_tau_threshold_from_parameter(name) for name in get_metrics() if 'tau' in name]
+
+
+def get_tau_curve_metrics():
+    """
+    Retrieves the metrics that form the tau curve, i.e. tau decentralization for all thresholds from 0.01 to 0.99
+    with a step of 0.01
+    :returns: a list of strings of the form 'tau=<threshold>'
+    """
+    return [f'tau={round(threshold / 100, 2)}' for threshold in range(1, 100)]
 
 
 def get_tau_threshold_from_parameter(parameter):
@@ -206,6 +229,102 @@ def get_force_map_addresses_flag():
         raise ValueError('Flag "force_map_addresses" not in config file')
 
 
+def get_incremental_mapping_flag():
+    """
+    Gets the flag that determines whether to update the mapping databases incrementally, i.e. whether to apply the
+    changes of the mapping information on an existing database (instead of using it as is)
+    :returns: boolean
+    :raises ValueError: if the flag is not set in the config file
+    """
+    config = get_config_data()
+    try:
+        return config['execution_flags']['incremental_mapping']
+    except KeyError:
+        raise ValueError('Flag "incremental_mapping" not in config file')
+
+
+def get_cache_snapshots_flag():
+    """
+    Gets the flag that determines whether to store the raw snapshots in a columnar binary cache
+    :returns: boolean
+    :raises ValueError: if the flag is not set in the config file
+    """
+    config = get_config_data()
+    try:
+        return config['execution_flags']['cache_snapshots']
+    except KeyError:
+        raise ValueError('Flag "cache_snapshots" not in config file')
+
+
+def get_input_fingerprints_flag():
+    """
+    Gets the flag that determines whether to compute content fingerprints of the input files in the input catalog
+    :returns: boolean
+    :raises ValueError: if the flag is not set in the config file
+    """
+    config = get_config_data()
+    try:
+        return config['execution_flags']['input_fingerprints']
+    except KeyError:
+        raise ValueError('Flag "input_fingerprints" not in config file')
+
+
+def get_out_of_core_memory_budget():
+    """
+    Retrieves the memory budget of the out-of-core aggregation, i.e. the max memory that the aggregation of a
+    snapshot can use before it is spilled to disk
+    :returns: the budget in bytes or None if out-of-core aggregation is disabled
+    :raises ValueError: if the budget is not set in the config file or if it is not a positive number
+    """
+    config = get_config_data()
+    try:
+        memory_budget = config['execution_flags']['out_of_core_memory_budget']
+    except KeyError:
+        raise ValueError('Flag "out_of_core_memory_budget" not in config file')
+    if memory_budget is None:
+        return None
+    if memory_budget <= 0:
+        raise ValueError('Malformed "out_of_core_memory_budget" in config; should be a positive number of MB or empty')
+    return int(memory_budget * 10**6)
+
+
+def get_parse_workers():
+    """
+    Retrieves the number of processes that parse (and map) the raw data of a single snapshot in parallel
+    :returns: a positive integer, which defaults to 1 (i.e. no parallel parsing)
+    :raises ValueError: if the flag is not set in the config file or if it is not a positive integer
+    """
+    config = get_config_data()
+    try:
+        parse_workers = config['execution_flags']['parse_workers']
+    except KeyError:
+        raise ValueError('Flag "parse_workers" not in config file')
+    if parse_workers is None:
+        return 1
+    if not isinstance(parse_workers, int) or parse_workers <= 0:
+        raise ValueError('Malformed "parse_workers" in config; should be a positive integer or empty')
+    return parse_workers
+
+
+def get_mapping_filter_false_positive_rate():
+    """
+    Retrieves the false positive rate of the Bloom filter of the mapped addresses, which is stored in the mapping
+    index of each ledger and skips the index lookup of (most) unmapped addresses
+    :returns: a float in (0, 1) or None if the filter is disabled
+    :raises ValueError: if the rate is not set in the config file or if it is not in (0, 1)
+    """
+    config = get_config_data()
+    try:
+        false_positive_rate = config['execution_flags']['mapping_filter_false_positive_rate']
+    except KeyError:
+        raise ValueError('Flag "mapping_filter_false_positive_rate" not in config file')
+    if false_positive_rate is None:
+        return None
+    if not 0 < false_positive_rate < 1:
+        raise ValueError('Malformed "mapping_filter_false_positive_rate" in config; should be in (0, 1) or empty')
+    return float(false_positive_rate)
+
+
 def get_clustering_flag():
     """
     Gets a flag that determines whether to cluster addresses into entities
@@ -219,15 +338,23 @@ def get_clustering_flag():
 
 def get_metrics():
     """
-    Retrieves the metrics to be analyzed
+    Retrieves the metrics to be analyzed. The special metric 'tau_curve' is expanded to the tau decentralization
+    metrics of all thresholds of the tau curve.
     :returns: list of strings of the metric names to be used
     :raises ValueError: if the metrics are not set in the config file
     """
     try:
-        return get_config_data()['metrics']
+        config_metrics = get_config_data()['metrics']
     except KeyError:
         raise ValueError('"metrics" not set in config file')
 
+    metrics = []
+    for metric in config_metrics:
+        for metric_name in (get_tau_curve_metrics() if metric == 'tau_curve' else [metric]):
+            if metric_name not in metrics:
+                metrics.append(metric_name)
+    return metrics
+
 
 def get_granularity():
     """
@@ -292,13 +419,116 @@ def get_top_limit_value():
         raise ValueError('Flag "top_limit_value" not in config file')
 
 
+def get_top_limit_sweep():
+    """
+    Retrieves the top limits that are all analyzed in a single run, i.e. whose metrics are computed from the same
+    sorted balances of each snapshot (instead of the single top limit of top_limit_type and top_limit_value)
+    :returns: a list of tuples (top limit type, top limit value) in the order of the config file, which is empty if
+    no sweep is configured
+    :raises ValueError: if the top limit sweep is not set in the config file or if some top limit is malformed
+    """
+    config = get_config_data()
+    try:
+        top_limit_sweep = config['analyze_flags']['top_limit_sweep']
+    except KeyError:
+        raise ValueError('Flag "top_limit_sweep" not in config file')
+
+    top_limits = []
+    for top_limit_type, top_limit_values in (top_limit_sweep or {}).items():
+        if top_limit_type not in ['absolute', 'percentage']:
+            raise ValueError('Malformed "top_limit_sweep" in config; keys should be "absolute" or "percentage"')
+        for top_limit_value in top_limit_values or []:
+            if top_limit_type == 'absolute' and (not isinstance(top_limit_value, int) or top_limit_value < 0):
+                raise ValueError('Malformed "top_limit_sweep" in config; absolute values should be non-negative integers')
+            if top_limit_type == 'percentage' and not 0 <= top_limit_value <= 1:
+                raise ValueError('Malformed "top_limit_sweep" in config; percentage values should be in [0, 1]')
+            if (top_limit_type, top_limit_value) not in top_limits:
+                top_limits.append((top_limit_type, top_limit_value))
+    return top_limits
+
+
+def get_top_limits():
+    """
+    Retrieves the top limits for which the metrics of each snapshot are computed
+    :returns: a list of tuples (top limit type, top limit value), i.e. the top limit sweep if it is configured and
+    otherwise the single top limit of top_limit_type and top_limit_value
+    """
+    return get_top_limit_sweep() or [(get_top_limit_type(), get_top_limit_value())]
+
+
+def get_balance_threshold_sweep():
+    """
+    Retrieves the balance thresholds that are all analyzed in a single run, i.e. whose metrics are computed from the
+    same aggregated balances of each snapshot (instead of the single threshold of exclude_below_fees and
+    exclude_below_usd_cent)
+    :returns: a list of balance thresholds (see get_balance_thresholds) in the order of the config file, which is
+    empty if no sweep is configured
+    :raises ValueError: if the balance threshold sweep is not set in the config file or if some threshold is malformed
+    """
+    config = get_config_data()
+    try:
+        balance_threshold_sweep = config['analyze_flags']['balance_threshold_sweep']
+    except KeyError:
+        raise ValueError('Flag "balance_threshold_sweep" not in config file')
+
+    balance_thresholds = []
+    for threshold in balance_threshold_sweep or []:
+        if threshold == 'none':
+            balance_threshold = (False, False, 0)
+        elif threshold == 'fees':
+            balance_threshold = (True, False, 0)
+        elif threshold == 'usd_cent':
+            balance_threshold = (False, True, 0)
+        elif isinstance(threshold, (int, float)) and not isinstance(threshold, bool) and threshold > 0:
+            balance_threshold = (False, False, float(threshold))
+        else:
+            raise ValueError('Malformed "balance_threshold_sweep" in config; thresholds should be "none", "fees", '
+                             '"usd_cent" or positive USD amounts')
+        if balance_threshold not in balance_thresholds:
+            balance_thresholds.append(balance_threshold)
+    return balance_thresholds
+
+
+def get_balance_thresholds():
+    """
+    Retrieves the balance thresholds below which entities are excluded from the analysis
+    :returns: a list of tuples (exclude_below_fees, exclude_below_usd_cent, exclude_below_usd), i.e. whether the
+    threshold is the median transaction fee and/or the USD cent equivalent and the USD amount of the threshold (0 for
+    none); the list is the balance threshold sweep if it is configured and otherwise the single threshold of the
+    exclude_below_fees and exclude_below_usd_cent flags
+    """
+    return get_balance_threshold_sweep() or [(get_exclude_below_fees_flag(), get_exclude_below_usd_cent_flag(), 0)]
+
+
+def get_balance_threshold_value(ledger, date, balance_threshold):
+    """
+    Computes the balance below which (inclusive) entities are excluded from the analysis of a snapshot
+    :param ledger: string that represents the ledger (e.g. bitcoin)
+    :param date: string that represents the date of the snapshot in YYYY-MM-DD format
+    :param balance_threshold: a tuple (exclude_below_fees, exclude_below_usd_cent, exclude_below_usd) (see
+    get_balance_thresholds)
+    :returns: a number in the smallest unit of the ledger's currency
+    """
+    exclude_below_fees, exclude_below_usd_cent, exclude_below_usd = balance_threshold
+    median_tx_fee = get_median_tx_fee(ledger=ledger, date=date) if exclude_below_fees else 0
+    usd_cent_equivalent = get_usd_cent_equivalent(ledger=ledger, date=date) \
+        if exclude_below_usd_cent or exclude_below_usd else 0
+    return max(median_tx_fee, usd_cent_equivalent if exclude_below_usd_cent else 0,
+               100 * exclude_below_usd * usd_cent_equivalent)
+
+
 def get_circulation_from_entries(entries):
     """
     Computes the aggregate value of a list of db entries.
-    Uses a greedy execution, instead of an one-liner that sums a list, to avoid memory consumption.
-    :param entries: a list of integers
+    For int64 arrays, the sum is computed separately over the high and low 32 bits of the entries, so that it is
+    exact and cannot overflow even if the total exceeds the int64 range.
+    :param entries: a list of integers or a numpy array
     :returns: integer
     """
+    if isinstance(entries, np.ndarray):
+        if entries.dtype.kind == 'i':
+            return (int(np.sum(entries >> 32)) << 32) + int(np.sum(entries & 0xFFFFFFFF))
+        return float(np.sum(entries))
     return sum(entries)
 
 
@@ -445,23 +675,28 @@ def get_usd_cent_equivalent(ledger, date):
         return 0
 
 
-def get_output_row(ledger, date, metrics):
+def get_output_row(ledger, date, metrics, top_limit=None, balance_threshold=None):
     """
     Constructs a line of the csv output.
     :param ledger: a string with the ledger's name
     :param date: a snapshot date in YYYY-MM-DD format
     :param metrics: a dictionary where the key is the name of the computed metric prefixed with the applied thresholds and the value is a number
+    :param top_limit: a tuple (top limit type, top limit value) of the metrics (see get_top_limits) or None for the
+    top limit of the config file
+    :param balance_threshold: a tuple (exclude_below_fees, exclude_below_usd_cent, exclude_below_usd) of the metrics
+    (see get_balance_thresholds) or None for the balance threshold of the config file
     :returns: a list of strings which comprises a single line of the csv output
     """
     clustering = get_clustering_flag()
     exclude_contract_addresses_flag = get_exclude_contracts_flag()
-    exclude_below_fees_flag = get_exclude_below_fees_flag()
-    exclude_below_usd_cent_flag = get_exclude_below_usd_cent_flag()
-    top_limit_type = get_top_limit_type()
-    top_limit_value = get_top_limit_value()
+    top_limit = top_limit if top_limit is not None else (get_top_limit_type(), get_top_limit_value())
+    balance_threshold = balance_threshold if balance_threshold is not None \
+        else (get_exclude_below_fees_flag(), get_exclude_below_usd_cent_flag(), 0)
+    top_limit_type, top_limit_value = top_limit
+    exclude_below_fees_flag, exclude_below_usd_cent_flag, exclude_below_usd = balance_threshold
 
-    csv_row = [ledger, date, clustering, exclude_contract_addresses_flag, top_limit_type, top_limit_value,
-               exclude_below_fees_flag, exclude_below_usd_cent_flag]
+    csv_row = [ledger, date, clustering, exclude_contract_addresses_flag]
+    csv_row += get_sweep_columns(top_limit, balance_threshold)
 
     for metric_name in get_metrics():
         val = metric_name
@@ -473,12 +708,29 @@ def get_output_row(ledger, date, metrics):
             val = 'exclude_below_fees ' + val
         if exclude_below_usd_cent_flag:
             val = 'exclude_below_usd_cent ' + val
+        if exclude_below_usd:
+            val = f'exclude_below_usd-{exclude_below_usd} ' + val
         if top_limit_value > 0:
             val = f'top-{top_limit_value}_{top_limit_type} ' + val
         csv_row.append(metrics[val])
     return csv_row
 
 
+def get_sweep_columns(top_limit, balance_threshold):
+    """
+    Constructs the columns of a line of the csv output that identify its top limit and balance threshold (the
+    column of the USD amount of the balance threshold only exists if a balance threshold sweep is configured)
+    :param top_limit: a tuple (top limit type, top limit value) (see get_top_limits)
+    :param balance_threshold: a tuple (exclude_below_fees, exclude_below_usd_cent, exclude_below_usd) (see
+    get_balance_thresholds)
+    :returns: a list of the values of the columns
+    """
+    columns = list(top_limit) + list(balance_threshold[:2])
+    if get_balance_threshold_sweep():
+        columns.append(balance_threshold[2])
+    return columns
+
+
 def get_output_filename():
     """
     Produces the name (full path) of the output file.
@@ -492,12 +744,17 @@ def get_output_filename():
     output_filename = 'output'
     if exclude_contract_addresses_flag:
         output_filename += '-exclude_contract_addresses'
-    if top_limit_value:
+    if get_top_limit_sweep():
+        output_filename += '-top_limit_sweep'
+    elif top_limit_value:
         output_filename += f'-{top_limit_type}_{top_limit_value}'
-    if exclude_below_fees_flag:
-        output_filename += '-exclude_below_fees'
-    if exclude_below_usd_cent_flag:
-        output_filename += '-exclude_below_usd_cent'
+    if get_balance_threshold_sweep():
+        output_filename += '-balance_threshold_sweep'
+    else:
+        if exclude_below_fees_flag:
+            output_filename += '-exclude_below_fees'
+        if exclude_below_usd_cent_flag:
+            output_filename += '-exclude_below_usd_cent'
     output_filename += '.csv'
     return get_output_directory() / output_filename
 
@@ -509,6 +766,8 @@ def write_csv_output(output_rows):
     """
     header = ['ledger', 'snapshot_date', 'clustering', 'exclude_contract_addresses', 'top_limit_type',
               'top_limit_value', 'exclude_below_fees', 'exclude_below_usd_cent']
+    if get_balance_threshold_sweep():
+        header.append('exclude_below_usd')
     header += get_metrics()
 
     with open(get_output_filename(), 'w') as f:
@@ -517,6 +776,25 @@ def write_csv_output(output_rows):
         csv_writer.writerows(output_rows)
 
 
+def read_csv_output():
+    """
+    Reads the rows of the existing output csv file
+    :returns: a dictionary where the key is a tuple (ledger, snapshot date) and the value is the list of the
+    corresponding rows of the output file (lists of strings), i.e. one row per top limit and balance threshold (see
+    get_top_limits and get_balance_thresholds); the dictionary is empty if no output file exists
+    """
+    output_rows = defaultdict(list)
+    try:
+        with open(get_output_filename()) as f:
+            csv_reader = csv.reader(f)
+            next(csv_reader, None)  # Skip the header
+            for line in csv_reader:
+                output_rows[(line[0], line[1])].append(line)
+    except FileNotFoundError:
+        pass
+    return dict(output_rows)
+
+
 def get_active_source_keywords():
     """
     Returns the keywords of the sources that should be used in the analysis based on the config parameters.
@@ -544,94 +822,329 @@ def get_active_sources():
     return active_sources
 
 
-def get_clusters(ledger):
+def read_mapping_information(ledger):
     """
-    Retrieves the clusters of addresses that form from the mapping information.
-    First identifies the addresses that are associated (in the mapping
-    information) with more than one entities.
-    Then it retrieves the set of all entities that each such address is
-    associated with and constructs the clusters by finding overlapping entities in these sets.
-    Finally it constructs a dictionary that maps entities to their cluster.
+    Parses the mapping information of a ledger in a single pass
     :param ledger: a string of the ledger's name
-    :returns: a dictionary where the key is an entity and the value is the cluster to which it belongs
+    :returns: a generator of tuples (address, entity, source, is_contract), one for each line of the mapping file
     """
-    # Find addresses that are associated with more than one entities.
-    # Note: If the mapping file is very large, loading the whole dictionary can result to running out of memory. Using this step consumes less memory but requires one extra pass of the file.
-    addresses = set()
-    multi_entity_addresses = set()
-    with open(MAPPING_INFO_DIR / f'addresses/{ledger}.jsonl') as f:
-        for line in f:
-            info = json.loads(line)
-            address = info['address']
-            if address in addresses:
-                multi_entity_addresses.add(address)
-            addresses.add(address)
-    del addresses
-
-    # Get the entities associated with the multi-entity addresses.
-    address_entities = defaultdict(set)
-    with open(MAPPING_INFO_DIR / f'addresses/{ledger}.jsonl') as f:
+    with open(MAPPING_INFO_DIR / f'addresses/{ledger}.jsonl', 'rb') as f:
         for line in f:
-            info = json.loads(line)
-            address = info['address']
-            if address in multi_entity_addresses:
-                source = info['source']
-                entity_name = info['name']
-                if source not in get_active_sources():
-                    continue
-                address_entities[address].add((entity_name, source))
-    del multi_entity_addresses
-
-    clusters = list(address_entities.values())
-    del address_entities
-
-    # If an entity is present in two entries, then these are merged.
-    # If an entry cannot be merged with any other entry, then it is finalized.
-    finalized_counter = 0
-    cluster_mapping = {}
-    while clusters:
-        cluster = clusters.pop()
-        merged_flag = False
-        for idx, new_item in enumerate(clusters):
-            if new_item.intersection(cluster):
-                merged_flag = True
-                clusters[idx] = new_item.union(cluster)
-                break
-        if not merged_flag:
-            finalized_counter += 1
-            cluster_name = f'-++-{finalized_counter}-++-'
-            for item in cluster:  # item = (entity, source)
-                cluster_mapping[item[0]] = cluster_name
-
-    return cluster_mapping
+            info = json_loads(line)
+            yield info['address'], info['name'], info['source'], bool(info.get('is_contract', False))
+
+
+def get_entity_clusters(address_entities):
+    """
+    Constructs the clusters of entities that are associated with the same addresses, using a disjoint-set forest,
+    s.t. the clustering scales linearly with the number of addresses.
+    :param address_entities: a dictionary that maps each multi-entity address to the set of its (entity, source)
+    tuples from active sources
+    :returns: a dictionary where the key is an (entity, source) tuple and the value is the cluster to which it belongs
+    """
+    # Entities that share an address are merged into the same cluster (transitively)
+    parents = {}
+    for entities in address_entities.values():
+        if len(entities) < 2:  # e.g. an address whose other entities are from inactive sources
+            continue
+        entities = iter(entities)
+        first_entity = next(entities)
+        parents.setdefault(first_entity, first_entity)
+        for entity in entities:
+            parents.setdefault(entity, entity)
+            union_clusters(parents, first_entity, entity)
+
+    clusters = defaultdict(list)
+    for item in parents:
+        clusters[find_cluster_root(parents, item)].append(item)
+    del parents
+
+    entity_clusters = {}
+    for cluster in clusters.values():
+        cluster_name = get_cluster_name(min(cluster))
+        for item in cluster:  # item = (entity, source)
+            entity_clusters[item] = cluster_name
+
+    return entity_clusters
+
+
+def get_cluster_name(item):
+    """
+    Determines the name of a cluster from its smallest (entity, source) item. The name depends only on the cluster's
+    contents, so it is deterministic and it does not change when unrelated clusters are updated.
+    :param item: the smallest (entity, source) tuple of the cluster
+    :returns: a string of the cluster's name
+    """
+    digest = hashlib.blake2b('\n'.join(item).encode(), digest_size=8).hexdigest()
+    return f'-++-{digest}-++-'
+
+
+def get_source_combination():
+    """
+    Determines the combination of clustering sources of the current configuration, which identifies the clusters of
+    the combination in the (shared) mapping database of a ledger
+    :returns: a string of the sorted source keywords joined with "_"
+    """
+    return '_'.join(sorted(get_active_source_keywords()))
+
+
+def get_mapping_fingerprint(ledger):
+    """
+    Computes the fingerprint of the information that the mapping database of a ledger is built from, i.e. the
+    mapping file and the active sources
+    :param ledger: a string of the ledger's name
+    :returns: a dictionary with the size and modification time (in ns) of the mapping file and the (sorted) list
+    of active sources
+    """
+    stat = os.stat(MAPPING_INFO_DIR / f'addresses/{ledger}.jsonl')
+    return {
+        'mapping_file': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns},
+        'sources': sorted(get_active_sources())
+    }
+
+
+def find_cluster_root(parents, item):
+    """
+    Finds the root of the cluster that an item belongs to in a disjoint-set forest and compresses the path from
+    the item to the root, s.t. subsequent lookups of the path's items are constant-time
+    :param parents: a dictionary that maps each item to its parent in the forest (roots are their own parents)
+    :param item: an item of the forest
+    :returns: the root item of the item's cluster
+    """
+    root = item
+    while parents[root] != root:
+        root = parents[root]
+    while parents[item] != root:
+        parents[item], item = root, parents[item]
+    return root
+
+
+def union_clusters(parents, item_1, item_2):
+    """
+    Merges the clusters of two items in a disjoint-set forest
+    :param parents: a dictionary that maps each item to its parent in the forest (roots are their own parents)
+    :param item_1: an item of the forest
+    :param item_2: an item of the forest
+    """
+    root_1 = find_cluster_root(parents, item_1)
+    root_2 = find_cluster_root(parents, item_2)
+    if root_1 != root_2:
+        parents[root_2] = root_1
+
+
+def get_memory_budget():
+    """
+    Computes the memory that is available to the analysis processes
+    :returns: the number of bytes of the system's memory, minus 1GB that is left to be used by other processes
+    """
+    return psutil.virtual_memory().total - 10**9
+
+
+def get_in_memory_size(file_size):
+    """
+    Estimates the memory that the aggregated entries of an input file consume
+    :param file_size: the size of the input file in bytes
+    :returns: the estimated number of bytes
+    """
+    # The entities are interned to fingerprints during the aggregation (see analyze.aggregate_entity_balances), whose
+    # peak was measured at approx. 1.2 times the size of the file; the estimate leaves some headroom on top of that.
+    return 1.5 * file_size
+
+
+def get_input_data_size(filename, file_size):
+    """
+    Estimates the size of the raw data of an input file. The uncompressed size of a compressed file cannot be
+    determined without decompressing it, so it is estimated (conservatively) from the size of the file.
+    :param filename: the path of the input file
+    :param file_size: the size of the input file in bytes
+    :returns: the estimated number of bytes of the raw data
+    """
+    if pathlib.Path(filename).suffix in COMPRESSED_INPUT_SUFFIXES:
+        return file_size * COMPRESSION_RATIO_ESTIMATE
+    return file_size
+
+
+def get_memory_estimate(file_size):
+    """
+    Estimates the memory that is needed to analyze an input file. Files that do not fit in the out-of-core memory
+    budget (if set) are aggregated on disk, so they need only as much memory as the budget. If snapshots are parsed
+    in parallel, the parse workers also hold the partial aggregates of the parts of the file as Python objects (see
+    analyze.aggregate_snapshot_part), which are not bounded by the budget.
+    :param file_size: the size of the input file in bytes
+    :returns: the estimated number of bytes that the analysis of the file consumes
+    """
+    memory_estimate = get_in_memory_size(file_size)
+    memory_budget = get_out_of_core_memory_budget()
+    if memory_budget is not None:
+        memory_estimate = min(memory_estimate, memory_budget)
+    if get_parse_workers() > 1:
+        memory_estimate += PARSE_PART_MEMORY_RATIO * file_size
+    return memory_estimate
+
+
+def get_input_catalog_filename():
+    """
+    Retrieves the file that stores the catalog of the raw input files
+    :returns: a pathlib path in the first output directory
+    """
+    return pathlib.Path(get_config_data()['output_directories'][0]).resolve() / 'input_catalog.json'
+
+
+def get_input_fingerprint(filename, size):
+    """
+    Computes a content fingerprint of an input file. To avoid reading whole (possibly huge) files, the fingerprint
+    is a hash of the file's size and of its first and last MB.
+    :param filename: the path of the file
+    :param size: the size of the file in bytes
+    :returns: a hex string
+    """
+    sample_size = 10**6
+    file_hash = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, 'rb') as f:
+        file_hash.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            file_hash.update(f.read(sample_size))
+    return file_hash.hexdigest()
+
+
+def scan_input_folder(folder, cached_folders, scanned_folders, compute_fingerprints):
+    """
+    Scans a folder (recursively) for raw input files. If the folder's modification time is the same as in the
+    cached catalog, no files have been added or removed since the last scan, so its cached entries are reused
+    without listing the folder or accessing its files.
+    :param folder: the path (string) of the folder
+    :param cached_folders: a dictionary of the folders of the cached catalog
+    :param scanned_folders: a dictionary where the scanned folders are stored
+    :param compute_fingerprints: boolean that determines whether to compute content fingerprints of new files
+    """
+    try:
+        folder_mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return
+    cached_folder = cached_folders.get(folder)
+    if cached_folder is not None and cached_folder['mtime_ns'] == folder_mtime and \
+            (not compute_fingerprints or all(info['fingerprint'] for info in cached_folder['files'].values())):
+        scanned_folder = cached_folder
+    else:
+        cached_files = cached_folder['files'] if cached_folder else {}
+        scanned_folder = {'mtime_ns': folder_mtime, 'subfolders': [], 'files': {}}
+        for entry in os.scandir(folder):
+            if entry.is_dir():
+                if entry.name != SNAPSHOT_CACHE_DIR_NAME:
+                    scanned_folder['subfolders'].append(entry.name)
+            elif INPUT_FILENAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                info = cached_files.get(entry.name)
+                if info is None or info['size'] != stat.st_size or info['mtime_ns'] != stat.st_mtime_ns:
+                    info = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': None}
+                if compute_fingerprints and info['fingerprint'] is None:
+                    info['fingerprint'] = get_input_fingerprint(entry.path, stat.st_size)
+                scanned_folder['files'][entry.name] = info
+    scanned_folders[folder] = scanned_folder
+    for subfolder in scanned_folder['subfolders']:
+        scan_input_folder(os.path.join(folder, subfolder), cached_folders, scanned_folders, compute_fingerprints)
+
+
+def get_input_catalog():
+    """
+    Retrieves the catalog of the raw input files in the input directories. The catalog is cached in a json file
+    and refreshed incrementally (see scan_input_folder) the first time it is requested in each execution.
+    Note that a file that is modified in place (i.e. without changing its folder) is not detected by the refresh.
+    :returns: a dictionary where the key is a tuple (ledger, date) and the value is a dictionary with the path, size,
+    modification time (in ns) and content fingerprint (None unless enabled in the config) of the snapshot's file
+    (or of its shards, see get_sharded_input_info); if a snapshot exists in multiple input directories, the first
+    directory takes precedence
+    """
+    global input_catalog
+    if input_catalog is not None:
+        return input_catalog
+
+    catalog_filename = get_input_catalog_filename()
+    try:
+        with open(catalog_filename) as f:
+            cached_folders = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cached_folders = {}
+
+    scanned_folders = {}
+    compute_fingerprints = get_input_fingerprints_flag()
+    for input_dir in get_input_directories():
+        scan_input_folder(str(input_dir), cached_folders, scanned_folders, compute_fingerprints)
+
+    if scanned_folders != cached_folders:
+        try:
+            catalog_filename.parent.mkdir(parents=True, exist_ok=True)
+            with open(catalog_filename, 'w') as f:
+                json.dump(scanned_folders, f)
+        except OSError as e:
+            logging.warning(f'Could not store the input catalog: {e}')
+
+    input_catalog = {}
+    for folder, scanned_folder in scanned_folders.items():
+        folder_inputs, folder_shards = {}, defaultdict(dict)
+        for name, info in sorted(scanned_folder['files'].items()):  # An uncompressed file sorts before compressed ones
+            ledger, date, shard = INPUT_FILENAME_PATTERN.match(name).groups()
+            if shard is None:
+                folder_inputs.setdefault((ledger, date), dict(info, path=pathlib.Path(folder) / name))
+            else:
+                folder_shards[(ledger, date)][name] = info
+        for (ledger, date), shards in folder_shards.items():
+            if (ledger, date) not in folder_inputs:  # An unsharded file takes precedence over shards of the same snapshot
+                folder_inputs[(ledger, date)] = get_sharded_input_info(folder, ledger, date, shards)
+        for key, info in folder_inputs.items():
+            if key not in input_catalog:
+                input_catalog[key] = info
+    return input_catalog
+
+
+def get_sharded_input_info(folder, ledger, date, shards):
+    """
+    Combines the catalog entries of the shards of a snapshot (e.g. a BigQuery export of the form
+    <ledger>_<date>_raw_data_<shard>.csv) to the catalog entry of the snapshot
+    :param folder: the path (string) of the folder of the shards
+    :param ledger: a ledger name
+    :param date: a string in YYYY-MM-DD format
+    :param shards: a dictionary where the key is the name of a shard file and the value its catalog entry
+    :returns: a dictionary with the path (with a "*" wildcard in place of the shard number and, if the shards are
+    compressed differently, of the compression suffix), total size, latest modification time and combined
+    fingerprint of the shards
+    """
+    fingerprints = [shards[name]['fingerprint'] for name in sorted(shards)]
+    extensions = set(name[name.rindex('.csv'):] for name in shards)
+    extension = extensions.pop() if len(extensions) == 1 else '.csv*'  # The shards are usually compressed alike
+    return {
+        'size': sum(info['size'] for info in shards.values()),
+        'mtime_ns': max(info['mtime_ns'] for info in shards.values()),
+        'fingerprint': hashlib.blake2b(''.join(fingerprints).encode(), digest_size=16).hexdigest()
+        if all(fingerprints) else None,
+        'path': pathlib.Path(folder) / f'{ledger}_{date}_raw_data_*{extension}'
+    }
 
 
 def get_concurrency_per_ledger():
     """
     Computes the maximum number of parallel processes that can run per ledger,
-    based on the system's available memory.
+    based on the system's available memory. Each process may start its own parse workers (see get_parse_workers),
+    so the CPUs of the system are divided between them.
     :returns: a dictionary where the keys are ledger names and values are integers
     """
-    system_memory_total = psutil.virtual_memory().total  # Get the system's total memory
-    system_memory_total -= 10**9  # Leave 1GB of memory to be used by other processes
+    system_memory_total = get_memory_budget()
+    max_processes = max(1, os.cpu_count() // get_parse_workers())
+
+    max_file_sizes = defaultdict(int)  # The (raw data) size of the largest input file per ledger
+    for (ledger, _), info in get_input_catalog().items():
+        max_file_sizes[ledger] = max(max_file_sizes[ledger], get_input_data_size(info['path'], info['size']))
 
     concurrency = {}
     too_large_ledgers = set()
-    input_dirs = get_input_directories()
     for ledger in get_ledgers():
-        # Find the size of the largest input file per ledger
-        max_file_size = 0
-        for input_dir in input_dirs:
-            for folder, _, files in os.walk(input_dir):
-                for file in files:
-                    if file.startswith(ledger):
-                        max_file_size = max(max_file_size, os.stat(os.path.join(folder, file)).st_size)
+        max_file_size = max_file_sizes[ledger]
         # Compute the max number of processes that can open the largest ledger file
         # and run in parallel without exhausting the system's memory.
         if max_file_size > 0:
-            # When loaded in (a dict in) memory, each file consumes approx. 2.5x space compared to storage.
             # Limit processes to CPU count to avoid OS process management overhead.
-            concurrency[ledger] = min(os.cpu_count(), int(system_memory_total / (2.5 * max_file_size)))
+            concurrency[ledger] = min(max_processes, int(system_memory_total / get_memory_estimate(max_file_size)))
             # Find if some ledger files are too large to fit in the system's available memory.
             if concurrency[ledger] == 0:
                 too_large_ledgers.add(ledger)
@@ -639,7 +1152,8 @@ def get_concurrency_per_ledger():
             concurrency[ledger] = 1
 
     if too_large_ledgers:
-        raise ValueError('The max input files of the following ledgers are too'
-                         'large to load in memory' + ','.join(too_large_ledgers))
+        raise ValueError('The max input files of the following ledgers are too '
+                         'large to load in memory (consider setting "out_of_core_memory_budget"): ' +
+                         ','.join(too_large_ledgers))
 
     return concurrency
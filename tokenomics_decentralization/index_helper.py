@@ -0,0 +1,278 @@
+"""
+Module with helper functions for the compiled mapping index, i.e. a read-only, memory-mapped copy of the mapping of a
+ledger (for a combination of clustering sources), which is shared by all worker processes of the analysis
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+import logging
+import numpy as np
+import tokenomics_decentralization.helper as hlp
+import tokenomics_decentralization.db_helper as db_hlp
+import tokenomics_decentralization.snapshot_helper as snap_hlp
+
+INDEX_BATCH_SIZE = 1000000  # Number of mapping entries that are fetched from the mapping db at once
+FINGERPRINT_DTYPE = np.dtype([('key', '<u8'), ('tag', '<u4')])
+INDEX_ARRAYS = ['keys', 'tags', 'entity_ids', 'contracts', 'entity_offsets', 'entity_names', 'filter']
+
+
+def get_index_dir(ledger, combination):
+    """
+    Determines the directory of the mapping index of a ledger for a combination of sources
+    :param ledger: the name of a ledger
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    :returns: a path
+    """
+    return hlp.MAPPING_INFO_DIR / f'addresses/index/{ledger}_{combination}'
+
+
+def get_address_fingerprints(addresses):
+    """
+    Computes the fingerprints of addresses, i.e. a 64-bit key, which the index is sorted by, and a 32-bit tag, which
+    verifies a match of the key, s.t. an unmapped address is practically never mistaken for a mapped one
+    :param addresses: an iterable of address strings
+    :returns: a tuple (keys, tags) of a uint64 and a uint32 numpy array
+    """
+    digests = b''.join([hashlib.blake2b(address.encode(), digest_size=12).digest() for address in addresses])
+    fingerprints = np.frombuffer(digests, dtype=FINGERPRINT_DTYPE)
+    return fingerprints['key'], fingerprints['tag']
+
+
+def get_filter_parameters(num_items, false_positive_rate):
+    """
+    Determines the optimal size and number of hash functions of a Bloom filter
+    :param num_items: the number of items that are added to the filter
+    :param false_positive_rate: the target false positive rate of the filter
+    :returns: a tuple (number of bits, which is a multiple of 8, number of hash functions)
+    """
+    num_bits = max(64, math.ceil(-num_items * math.log(false_positive_rate) / math.log(2) ** 2))
+    num_bits += -num_bits % 8
+    num_hashes = max(1, round(-math.log2(false_positive_rate)))
+    return num_bits, num_hashes
+
+
+def get_filter_positions(keys, tags, num_bits, num_hashes):
+    """
+    Computes the bit positions of addresses in a Bloom filter, by combining the two parts of their fingerprints
+    (double hashing), s.t. no additional hashes of the addresses are needed
+    :param keys: a uint64 numpy array of address keys
+    :param tags: a uint32 numpy array of address tags
+    :param num_bits: the number of bits of the filter
+    :param num_hashes: the number of hash functions of the filter
+    :returns: a generator of uint64 numpy arrays, one per hash function
+    """
+    step = (tags.astype(np.uint64) << np.uint64(32)) | (keys >> np.uint64(32)) | np.uint64(1)
+    for idx in range(num_hashes):
+        yield (keys + np.uint64(idx) * step) % np.uint64(num_bits)  # Overflows wrap around
+
+
+def build_filter(keys, tags, false_positive_rate):
+    """
+    Builds a Bloom filter of addresses
+    :param keys: a uint64 numpy array of address keys
+    :param tags: a uint32 numpy array of address tags
+    :param false_positive_rate: the target false positive rate of the filter
+    :returns: a tuple (filter, number of hash functions), where the filter is a uint8 numpy array of bits
+    """
+    num_bits, num_hashes = get_filter_parameters(len(keys), false_positive_rate)
+    bloom_filter = np.zeros(num_bits // 8, dtype=np.uint8)
+    for start in range(0, len(keys), INDEX_BATCH_SIZE):
+        for positions in get_filter_positions(keys[start:start + INDEX_BATCH_SIZE], tags[start:start + INDEX_BATCH_SIZE],
+                                              num_bits, num_hashes):
+            np.bitwise_or.at(bloom_filter, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+    return bloom_filter, num_hashes
+
+
+def filter_contains(bloom_filter, num_hashes, keys, tags):
+    """
+    Checks which addresses may be in a Bloom filter; addresses that are not are certainly not in it
+    :param bloom_filter: a uint8 numpy array of bits (see build_filter)
+    :param num_hashes: the number of hash functions of the filter
+    :param keys: a uint64 numpy array of address keys
+    :param tags: a uint32 numpy array of address tags
+    :returns: a boolean numpy array
+    """
+    contained = np.ones(len(keys), dtype=bool)
+    for positions in get_filter_positions(keys, tags, len(bloom_filter) * 8, num_hashes):
+        contained &= (bloom_filter[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+    return contained
+
+
+def build_mapping_index(conn, ledger, combination):
+    """
+    Compiles the mapping of the selected sources of the mapping db to an index of .npy files: the address
+    fingerprints (sorted), the ID of each address's entity, a bitmap of the contract addresses and the entity names
+    (a byte string and the offsets of each name in it), as well as a Bloom filter of the addresses, if enabled
+    (see helper.get_mapping_filter_false_positive_rate). The index is first written in a temporary directory, which
+    then replaces the previous index, and it is marked with the signature of the mapping db it was built from.
+    Should be called after the changes of the mapping db are committed.
+    :param conn: a connector to the mapping database, with the combination's sources selected
+    :param ledger: the name of a ledger
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    """
+    c = conn.cursor()
+    c.execute('SELECT address, entity, is_contract FROM mapping')
+    entity_ids = {}
+    key_arrays, tag_arrays, entity_id_arrays, contract_arrays = [], [], [], []
+    while True:
+        batch = c.fetchmany(INDEX_BATCH_SIZE)
+        if not batch:
+            break
+        addresses, entities, contracts = zip(*batch)
+        keys, tags = get_address_fingerprints(addresses)
+        key_arrays.append(keys)
+        tag_arrays.append(tags)
+        entity_id_arrays.append(np.array([entity_ids.setdefault(entity, len(entity_ids)) for entity in entities],
+                                         dtype=np.uint32))
+        contract_arrays.append(np.array(contracts, dtype=bool))
+
+    keys = np.concatenate(key_arrays) if key_arrays else np.array([], dtype=np.uint64)
+    tags = np.concatenate(tag_arrays) if tag_arrays else np.array([], dtype=np.uint32)
+    order = np.lexsort((tags, keys))
+    entity_names = [entity.encode() for entity in entity_ids]
+    del entity_ids
+    index = {
+        'keys': keys[order],
+        'tags': tags[order],
+        'entity_ids': np.concatenate(entity_id_arrays)[order] if entity_id_arrays else np.array([], dtype=np.uint32),
+        'contracts': np.packbits(np.concatenate(contract_arrays)[order] if contract_arrays else np.array([], dtype=bool)),
+        'entity_offsets': np.cumsum([0] + [len(name) for name in entity_names], dtype=np.int64),
+        'entity_names': np.frombuffer(b''.join(entity_names), dtype=np.uint8),
+    }
+    del key_arrays, tag_arrays, entity_id_arrays, contract_arrays, entity_names
+    false_positive_rate = hlp.get_mapping_filter_false_positive_rate()
+    num_hashes = 0
+    if false_positive_rate is None:
+        index['filter'] = np.array([], dtype=np.uint8)
+    else:
+        index['filter'], num_hashes = build_filter(index['keys'], index['tags'], false_positive_rate)
+
+    index_dir = get_index_dir(ledger, combination)
+    tmp_dir = index_dir.with_name(f'{index_dir.name}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name in INDEX_ARRAYS:
+        np.save(tmp_dir / f'{name}.npy', index[name])
+    with open(tmp_dir / 'meta.json', 'w') as f:
+        json.dump({'db': snap_hlp.get_file_signature(db_hlp.get_db_filename(ledger)),
+                   'filter': {'false_positive_rate': false_positive_rate, 'num_hashes': num_hashes}}, f)
+    # Workers that have already mapped the previous index keep reading the (unlinked) files until they close them
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    logging.info(f'Compiled the {ledger} mapping index ({len(keys)} addresses)')
+
+
+def is_mapping_index_fresh(ledger, combination):
+    """
+    Checks whether the mapping index of a ledger exists and was built from the current state of the mapping db (and
+    with the configured false positive rate of the filter)
+    :param ledger: the name of a ledger
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    :returns: boolean
+    """
+    try:
+        with open(get_index_dir(ledger, combination) / 'meta.json') as f:
+            meta = json.load(f)
+        return meta['db'] == snap_hlp.get_file_signature(db_hlp.get_db_filename(ledger)) and \
+            meta['filter']['false_positive_rate'] == hlp.get_mapping_filter_false_positive_rate()
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def load_mapping_index(ledger, combination):
+    """
+    Loads the mapping index of a ledger as read-only memory-mapped arrays, s.t. the pages of the index are shared by
+    all processes that load it
+    :param ledger: the name of a ledger
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    :returns: a dictionary of the index's arrays (and the number of hash functions of the filter, a cache of the
+    decoded entity names and the counters of the index's lookups) or None if no fresh index exists
+    """
+    if not is_mapping_index_fresh(ledger, combination):
+        return None
+    index_dir = get_index_dir(ledger, combination)
+    try:
+        with open(index_dir / 'meta.json') as f:
+            num_hashes = json.load(f)['filter']['num_hashes']
+        # The memory-mapped arrays are viewed as plain arrays, which are much cheaper to slice
+        index = {name: np.asarray(np.load(index_dir / f'{name}.npy', mmap_mode='r')) for name in INDEX_ARRAYS}
+    except (OSError, ValueError, KeyError):
+        return None
+    index['num_hashes'] = num_hashes
+    index['entity_cache'] = {}
+    index['lookup_stats'] = {'lookups': 0, 'skipped_lookups': 0}
+    return index
+
+
+def decode_entity_names(index, entity_ids):
+    """
+    Decodes the names of entities of the mapping index and caches them (in the index's entity cache)
+    :param index: a mapping index (see load_mapping_index)
+    :param entity_ids: a numpy array of entity IDs
+    """
+    entity_cache = index['entity_cache']
+    missing_ids = np.array([entity_id for entity_id in np.unique(entity_ids).tolist() if entity_id not in entity_cache],
+                           dtype=np.int64)
+    entity_names = index['entity_names']
+    starts, ends = index['entity_offsets'][missing_ids].tolist(), index['entity_offsets'][missing_ids + 1].tolist()
+    for entity_id, start, end in zip(missing_ids.tolist(), starts, ends):
+        entity_cache[entity_id] = entity_names[start:end].tobytes().decode()
+
+
+def get_addresses_entities(index, addresses):
+    """
+    Retrieves the entities of a batch of addresses from the mapping index (see lookup_addresses_entities)
+    :param index: a mapping index (see load_mapping_index)
+    :param addresses: a list of address strings
+    :returns: a dictionary where the key is an address that is mapped and the value is a tuple
+    (entity, is_contract); addresses that are not mapped are omitted
+    """
+    found_indices, entities, contracts = lookup_addresses_entities(index, addresses)
+    return {addresses[idx]: (entity, is_contract)
+            for idx, entity, is_contract in zip(found_indices.tolist(), entities, contracts.astype(int).tolist())}
+
+
+def lookup_addresses_entities(index, addresses):
+    """
+    Retrieves the entities of a batch of addresses from the mapping index, using a vectorized binary search of the
+    addresses' fingerprints. Addresses that the filter of the index proves unmapped are not searched (and counted in
+    the index's lookup stats). The results are positional, s.t. they can be applied on the batch with array operations.
+    :param index: a mapping index (see load_mapping_index)
+    :param addresses: a list of address strings
+    :returns: a tuple (found indices, entities, contracts), where found indices is an int64 numpy array of the
+    positions of the mapped addresses in the batch, entities is a list of their entity names and contracts is a
+    boolean numpy array of whether each of them is a contract
+    """
+    index_keys, index_tags = index['keys'], index['tags']
+    index['lookup_stats']['lookups'] += len(addresses)
+    if len(index_keys) == 0 or len(addresses) == 0:
+        index['lookup_stats']['skipped_lookups'] += len(addresses)
+        return np.array([], dtype=np.int64), [], np.array([], dtype=bool)
+    keys, tags = get_address_fingerprints(addresses)
+    candidates = np.arange(len(addresses))
+    if index['num_hashes'] > 0:
+        candidates = np.flatnonzero(filter_contains(index['filter'], index['num_hashes'], keys, tags))
+        keys, tags = keys[candidates], tags[candidates]
+        index['lookup_stats']['skipped_lookups'] += len(addresses) - len(candidates)
+    positions = np.minimum(np.searchsorted(index_keys, keys), len(index_keys) - 1)
+    key_found = index_keys[positions] == keys
+    found = key_found & (index_tags[positions] == tags)
+    # Mapped addresses whose keys collide are stored next to each other (sorted by tag)
+    for idx in np.flatnonzero(key_found & ~found):
+        position = positions[idx] + 1
+        while position < len(index_keys) and index_keys[position] == keys[idx]:
+            if index_tags[position] == tags[idx]:
+                positions[idx], found[idx] = position, True
+                break
+            position += 1
+
+    found_positions = positions[found]
+    found_indices = candidates[found]
+    entity_ids = index['entity_ids'][found_positions]
+    decode_entity_names(index, entity_ids)
+    entity_cache = index['entity_cache']
+    contracts = ((index['contracts'][found_positions >> 3] >> (7 - (found_positions & 7))) & 1).astype(bool)
+    return found_indices.astype(np.int64), [entity_cache[entity_id] for entity_id in entity_ids.tolist()], contracts
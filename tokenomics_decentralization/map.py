@@ -1,32 +1,119 @@
 import tokenomics_decentralization.helper as hlp
 import tokenomics_decentralization.db_helper as db_hlp
-import os
+import tokenomics_decentralization.index_helper as idx_hlp
 import json
 import logging
+from contextlib import closing
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
 
 def apply_mapping(ledger):
+    """
+    Builds the mapping of a ledger for the configured combination of clustering sources, if it does not exist or if a
+    remapping is forced, or updates it, if incremental mapping is enabled and the mapping information has changed
+    since the last update.
+    All combinations of sources share the same database per ledger, which keeps the lines of the mapping file of all
+    sources (records), the clusters of entities of each combination and the fingerprint of the mapping information
+    that the records and each combination's clusters were computed from. The mapping of each address is resolved at
+    query time from the records of the selected sources and the clusters of the selected combination.
+    An update applies only the records that were added or removed and, if the combination's clusters were up to date
+    before the update, recomputes only the clusters that these records affect.
+    Finally, the mapping of the combination is compiled to a memory-mapped index (see index_helper), unless the
+    existing index was built from the current state of the db.
+    :param ledger: the name of a ledger
+    """
     force_map_addresses = hlp.get_force_map_addresses_flag()
     db_filename = db_hlp.get_db_filename(ledger)
-    if not os.path.isfile(db_filename) or force_map_addresses:
-        logging.info(f'Mapping {ledger} addresses')
+    # The connection is closed even if the mapping fails (e.g. on a mapping conflict), which discards the
+    # uncommitted changes and releases the db's lock
+    with closing(db_hlp.get_connector(db_filename)) as conn:
+        combination = hlp.get_source_combination()
+        previous_fingerprint = db_hlp.get_metadata(conn, f'fingerprint:{combination}')
+        previous_fingerprint = json.loads(previous_fingerprint) if previous_fingerprint is not None else None
+        if previous_fingerprint is None or force_map_addresses or hlp.get_incremental_mapping_flag():
+            fingerprint = hlp.get_mapping_fingerprint(ledger)
+            if previous_fingerprint == fingerprint and not force_map_addresses:
+                logging.info(f'{ledger} mapping is up to date')
+            else:
+                update_mapping(conn, ledger, combination, fingerprint, previous_fingerprint, force_map_addresses)
 
-        conn = db_hlp.get_connector(db_filename)
-        clusters = hlp.get_clusters(ledger)
+        # The workers of the analysis read the mapping from the compiled index, which is rebuilt whenever the db
+        # changes
+        if not idx_hlp.is_mapping_index_fresh(ledger, combination):
+            db_hlp.select_sources(conn, combination, hlp.get_active_sources())
+            idx_hlp.build_mapping_index(conn, ledger, combination)
+
+
+def update_mapping(conn, ledger, combination, fingerprint, previous_fingerprint, force_map_addresses):
+    """
+    Updates the mapping db of a ledger for a combination of sources (see apply_mapping)
+    :param conn: a connector to the mapping database
+    :param ledger: the name of a ledger
+    :param combination: a string that identifies the combination of sources (see helper.get_source_combination)
+    :param fingerprint: the fingerprint of the current mapping information (see helper.get_mapping_fingerprint)
+    :param previous_fingerprint: the fingerprint that the combination's clusters were computed from or None
+    :param force_map_addresses: boolean that determines whether the mapping is rebuilt from scratch
+    """
+    logging.info(f'Mapping {ledger} addresses')
+    db_hlp.set_loader_pragmas(conn)
+    if force_map_addresses:
+        db_hlp.clear_mapping(conn)
+    db_hlp.select_sources(conn, combination, fingerprint['sources'])
+
+    # The mapping file is parsed once and only if it has changed since the records were last updated (possibly for
+    # another combination of sources)
+    records_fingerprint = db_hlp.get_metadata(conn, 'fingerprint:records')
+    records_fingerprint = json.loads(records_fingerprint) if records_fingerprint is not None else None
+    changed_records = None
+    if records_fingerprint != fingerprint['mapping_file']:
+        changed_records = db_hlp.update_records(conn, hlp.read_mapping_information(ledger))
+        db_hlp.set_metadata(conn, 'fingerprint:records', json.dumps(fingerprint['mapping_file']))
+
+    clusters_up_to_date = previous_fingerprint == {'mapping_file': records_fingerprint, 'sources': fingerprint['sources']}
+    if clusters_up_to_date and changed_records is not None:
+        logging.info(f'Applying {len(changed_records)} changed {ledger} records')
+        affected_addresses = update_affected_clusters(conn, changed_records, set(fingerprint['sources']))
+        db_hlp.check_mapping_conflicts(conn, affected_addresses)
+    else:
+        entity_clusters = hlp.get_entity_clusters(db_hlp.get_multi_entity_address_items(conn))
+        db_hlp.update_clusters(conn, entity_clusters)
         logging.info(f'Collected {ledger} clusters')
-        with open(hlp.MAPPING_INFO_DIR / f'addresses/{ledger}.jsonl') as f:
-            for line in f:
-                info = json.loads(line)
-                source = info['source']
-                if source in hlp.get_active_sources():
-                    address = info['address']
-                    entity = info['name']
-                    if entity in clusters.keys():
-                        entity = clusters[entity]
-                    is_contract = 'is_contract' in info.keys() and info['is_contract']
-                    db_hlp.insert_mapping(conn, address, entity, is_contract)
-        db_hlp.commit_database(conn)
-
-        logging.info('Finished mapping db')
+        db_hlp.check_mapping_conflicts(conn)
+
+    db_hlp.set_metadata(conn, f'fingerprint:{combination}', json.dumps(fingerprint))
+    db_hlp.commit_database(conn)
+
+    logging.info('Finished mapping db')
+
+
+def update_affected_clusters(conn, changed_records, active_sources):
+    """
+    Recomputes the clusters of the selected combination of sources that are affected by changed records, i.e. the
+    clusters that are connected (through multi-entity addresses or through their previous clusters) to the entities
+    of the changed records
+    :param conn: a connector to the mapping database
+    :param changed_records: a list of (address, entity, source) tuples of the records that were added or removed
+    :param active_sources: the set of active sources
+    :returns: the set of addresses whose mapping may have changed
+    """
+    items, addresses = set(), set()
+    pending_items = {(entity, source) for _, entity, source in changed_records if source in active_sources}
+    pending_addresses = {address for address, _, _ in changed_records}
+    address_entities = {}
+    while pending_items or pending_addresses:
+        items |= pending_items
+        addresses |= pending_addresses
+        next_items = db_hlp.get_cluster_members(conn, pending_items)
+        next_addresses = db_hlp.get_items_addresses(conn, pending_items)
+        for address, address_items in db_hlp.get_multi_entity_address_items(conn, pending_addresses).items():
+            address_entities[address] = address_items
+            next_items |= address_items
+        pending_items = next_items - items
+        pending_addresses = next_addresses - addresses
+
+    db_hlp.update_clusters(conn, hlp.get_entity_clusters(address_entities), items)
+    logging.info(f'Recomputed the clusters of {len(items)} entities')
+
+    # The mapping of all addresses of an entity depends on the entity's cluster
+    return addresses | db_hlp.get_entities_addresses(conn, {entity for entity, _ in items})
@@ -1,4 +1,171 @@
-from math import log
+"""
+Module with the metrics that are computed on a distribution of balances.
+All metrics are vectorized over numpy arrays, so the entries can be given either as a list or as a numpy array.
+Shares are computed in float64 and reductions use numpy's pairwise summation, so the results agree with an
+element-wise evaluation of the same formulas within a relative tolerance of 1e-9. The tau index is the exception,
+since it is a count: it is resolved on the exact (integer) sums of the balances, so that a threshold that is reached
+exactly at an entry is not shifted to a neighbouring entry by rounding errors.
+The standard metrics can also be computed together in a single pass over the chunks of a distribution (see
+compute_metrics), instead of one pass per metric, and the metrics of multiple prefixes of a distribution (i.e. of
+multiple top limits) can be computed in the same pass (see compute_prefix_metrics).
+The single pass also accepts a distribution in run-length form (see get_run_lengths), i.e. its distinct balances and
+the number of entities that hold each of them (counts), in which case the metrics are evaluated in closed form over
+the runs, so their cost depends on the number of distinct balances instead of the number of entities.
+"""
+from bisect import bisect_left
+from fractions import Fraction
+from itertools import accumulate
+from math import ceil
+import numpy as np
+
+METRIC_CHUNK_SIZE = 2 ** 16  # Number of balances per chunk of the single-pass evaluation, so that a chunk fits in the CPU cache
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def get_balance_array(entries):
+    """
+    Converts a collection of balances to a numpy array. Balances are stored as int64 unless some balance
+    exceeds the int64 range, in which case float64 is used (the metrics only depend on the balances' shares,
+    so the loss of precision in the least significant digits of huge balances is immaterial).
+    :param entries: list of integers or numpy array (an object array of Python ints is converted like a list)
+    :returns: numpy array of int64 or float64
+    """
+    if isinstance(entries, np.ndarray) and entries.dtype != object:
+        return entries
+    try:
+        return np.array(entries, dtype=np.int64)
+    except OverflowError:
+        return np.array([float(entry) for entry in entries], dtype=np.float64)
+
+
+def get_run_lengths(entries):
+    """
+    Compresses a sorted distribution of balances to runs of equal balances
+    :param entries: list of integers or numpy array, sorted in descending order
+    :returns: a tuple (balances, counts) of numpy arrays, where balances are the distinct balances in descending order
+    and counts are the number of entries that hold each balance
+    """
+    entries = get_balance_array(entries)
+    run_starts = np.flatnonzero(np.concatenate(([True], entries[1:] != entries[:-1]))) if len(entries) > 0 \
+        else np.array([], dtype=np.int64)
+    counts = np.diff(np.append(run_starts, len(entries)))
+    return entries[run_starts], counts
+
+
+def get_richer_counts(counts):
+    """
+    Computes the number of entries that are richer than (i.e. precede) each run of a run-length distribution
+    :param counts: numpy array of the number of entries of each run
+    :returns: numpy array of int64
+    """
+    return np.cumsum(counts) - counts
+
+
+def get_shares(entries, circulation):
+    """
+    Computes the market share of each entry
+    :param entries: list of integers or numpy array
+    :param circulation: int, the total amount of tokens in circulation
+    :returns: numpy array of float64 shares
+    """
+    return get_balance_array(entries) / float(circulation)
+
+
+def get_exact_sum(entries, counts=None):
+    """
+    Computes the sum of a distribution of balances exactly, i.e. as a Python int. The sum is computed in int64 if it
+    is guaranteed to fit in its range, or else over Python ints (balances stored as float64 are summed as the
+    integers they hold).
+    :param entries: list of integers or numpy array
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :returns: int
+    """
+    cumulative_sums = get_exact_cumulative_sums(entries, counts, prefix=False)
+    return int(cumulative_sums[-1]) if len(cumulative_sums) > 0 else 0
+
+
+def get_exact_cumulative_sums(entries, counts=None, prefix=True):
+    """
+    Computes the prefix sums of a distribution of balances exactly, so that the cut-offs of the tau index are not
+    shifted by rounding errors. The sums are int64 if the total is guaranteed to fit in its range, or else Python
+    ints (in an object array).
+    :param entries: list of integers or numpy array
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :param prefix: boolean, whether all prefix sums are needed; if False, only the last element of the returned
+    array (the total) is meaningful
+    :returns: numpy array of int64 or object
+    """
+    entries = get_balance_array(entries)
+    if len(entries) == 0:
+        return np.array([], dtype=np.int64)
+    population = len(entries) if counts is None else int(np.sum(counts))
+    if entries.dtype.kind in 'iu' and int(np.max(np.abs(entries))) * population <= INT64_MAX:
+        weighted = entries if counts is None else entries * np.asarray(counts, dtype=np.int64)
+        return np.cumsum(weighted, dtype=np.int64) if prefix else np.array([np.sum(weighted, dtype=np.int64)])
+    weighted = [int(entry) for entry in entries.tolist()]
+    if counts is not None:
+        weighted = [entry * int(count) for entry, count in zip(weighted, np.asarray(counts).tolist())]
+    return np.array(list(accumulate(weighted)), dtype=object)
+
+
+def get_tau_target(threshold, circulation):
+    """
+    Computes the smallest (integer) amount of tokens that reaches a threshold of the circulation, using the exact
+    values of the threshold and of the circulation
+    :param threshold: float, the parameter of the tau index
+    :param circulation: int, the total amount of tokens in circulation
+    :returns: int
+    """
+    return ceil(Fraction(threshold) * Fraction(circulation))
+
+
+def resolve_tau_targets(entries, targets, counts=None):
+    """
+    Resolves the tau index of amounts of tokens, i.e. the number of the largest entries whose balances sum to at
+    least each amount, on the exact prefix sums of the balances
+    :param entries: list of integers sorted in descending order
+    :param targets: list of ints, the amounts of tokens (see get_tau_target)
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :returns: a list of integers, the tau index for each of the given amounts (all entries if an amount is never
+    reached)
+    """
+    entries = get_balance_array(entries)
+    cumulative_sums = get_exact_cumulative_sums(entries, counts)
+    population = len(entries) if counts is None else int(np.sum(counts))
+    if counts is not None:
+        counts = np.asarray(counts, dtype=np.int64)
+        richer_counts = get_richer_counts(counts)
+    tau_indices = []
+    for target in targets:
+        if len(cumulative_sums) == 0 or target > cumulative_sums[-1]:
+            tau_indices.append(population)
+            continue
+        run = int(np.searchsorted(cumulative_sums, target, side='left'))
+        if counts is None:
+            tau_indices.append(run + 1)
+            continue
+        # The target is reached within the run, after as many of the run's entries as are needed to cover the
+        # amount that is missing at the start of the run
+        missing = target - (int(cumulative_sums[run - 1]) if run > 0 else 0)
+        run_entries = min(max(-(-missing // int(entries[run])), 1), int(counts[run])) if missing > 0 else 1
+        tau_indices.append(int(richer_counts[run]) + run_entries)
+    return tau_indices
+
+
+def compute_tau_curve(entries, circulation, thresholds):
+    """
+    Calculates the tau index of a distribution of balances for multiple thresholds. The prefix sums of the balances
+    are computed once (exactly, see get_exact_cumulative_sums) and each threshold is then resolved with a binary
+    search on them.
+    :param entries: list of integers sorted in descending order
+    :param circulation: int, the total amount of tokens in circulation
+    :param thresholds: list of floats, the parameters of the tau index
+    :returns: a list of integers, the tau index for each of the given thresholds
+    """
+    if len(entries) == 0:
+        return [0] * len(thresholds)
+    tau_indices = resolve_tau_targets(entries, [get_tau_target(threshold, circulation) for threshold in thresholds])
+    return [tau_index if threshold > 0 else 0 for threshold, tau_index in zip(thresholds, tau_indices)]
 
 
 def compute_tau(entries, circulation, threshold):
@@ -10,15 +177,7 @@ def compute_tau(entries, circulation, threshold):
     that is captured by the index
     :returns: an integer of the tau index
     """
-    count, share = 0, 0
-    for entry in entries:
-        market_share = entry / circulation
-        if share >= threshold:
-            break
-        count += 1
-        share += market_share
-
-    return count
+    return compute_tau_curve(entries, circulation, [threshold])[0]
 
 
 def compute_gini(entries, circulation):
@@ -28,16 +187,13 @@ def compute_gini(entries, circulation):
     :param circulation: int, the total amount of tokens in circulation
     :returns: float between 0 and 1 that represents the Gini coefficient of the given distribution
     """
-    parsed_entries = 0
     population = len(entries)
-    gini = 1
-    for entry in entries:
-        richer_population_percentage = parsed_entries / population
-        market_share = entry / circulation
-        gini -= market_share * ((1 / population) + (2 * richer_population_percentage))
-        parsed_entries += 1
-
-    return gini
+    if population == 0:
+        return 1
+    shares = get_shares(entries, circulation)
+    # Each entry is weighted by the percentage of the population that is richer than it
+    richer_population = np.arange(population, dtype=np.float64)
+    return float(1 - (np.sum(shares) + 2 * np.dot(shares, richer_population)) / population)
 
 
 def compute_hhi(entries, circulation):
@@ -47,12 +203,8 @@ def compute_hhi(entries, circulation):
     :param circulation: int, the total amount of tokens in circulation
     :returns: float between 0 and 10,000 that represents the HHI of the given distribution
     """
-    hhi = 0
-    for entry in entries:
-        market_share = entry / circulation * 100
-        hhi += market_share**2
-
-    return hhi
+    market_shares = get_shares(entries, circulation) * 100
+    return float(np.dot(market_shares, market_shares))
 
 
 def compute_shannon_entropy(entries, circulation):
@@ -62,13 +214,9 @@ def compute_shannon_entropy(entries, circulation):
     :param circulation: int, the total amount of tokens in circulation
     :returns: float between 0 and 1 that represents the Shannon entropy of the given distribution
     """
-    entropy = 0
-    for entry in entries:
-        market_share = entry / circulation
-        if market_share > 0:
-            entropy -= market_share * log(market_share, 2)
-
-    return entropy
+    shares = get_shares(entries, circulation)
+    shares = shares[shares > 0]
+    return float(-np.sum(shares * np.log2(shares)))
 
 
 def compute_total_entities(entries, circulation):
@@ -89,7 +237,7 @@ def compute_max_power_ratio(entries, circulation):
     :returns: float that represents the maximum power ratio among all token holders
     """
     max_balance = entries[0]
-    return max_balance / circulation if circulation > 0 else 0
+    return float(max_balance) / circulation if circulation > 0 else 0
 
 
 def compute_theil_index(entries, circulation):
@@ -102,11 +250,180 @@ def compute_theil_index(entries, circulation):
     N = len(entries)
     if N == 0:
         return 0
-    mu = circulation / N
-    theil = 0
-    for entry in entries:
-        x = entry / mu
-        if x > 0:
-            theil += x * log(x)
-    theil /= N
-    return theil
+    # x / mu, where mu = circulation / N, equals the entry's share multiplied by N
+    x = get_shares(entries, circulation) * N
+    x = x[x > 0]
+    return float(np.sum(x * np.log(x)) / N)
+
+
+def get_chunks(entries, counts=None, chunk_size=METRIC_CHUNK_SIZE, boundaries=()):
+    """
+    Splits a distribution of balances to consecutive chunks, which are views of the given arrays (so a distribution
+    that is memory-mapped from disk is read chunk by chunk and is never fully loaded to memory)
+    :param entries: numpy array of balances sorted in descending order
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :param chunk_size: int, the maximum number of balances of each chunk
+    :param boundaries: list of numbers of entities at which a chunk should end (e.g. top limits, see
+    compute_prefix_metrics); a run of equal balances that spans a boundary is split at it
+    :returns: generator of tuples (entries, counts), where counts is None if the distribution is not in run-length form
+    """
+    if len(entries) == 0:
+        return
+    cuts = set(range(chunk_size, len(entries), chunk_size))
+    run_splits = {}  # Maps each run that is split to the number of its entries that precede each boundary
+    if counts is None:
+        cuts.update(boundary for boundary in boundaries if 0 < boundary < len(entries))
+    else:
+        cumulative_counts = np.cumsum(counts)
+        for boundary in boundaries:
+            if 0 < boundary < cumulative_counts[-1]:
+                run = int(np.searchsorted(cumulative_counts, boundary, side='left'))
+                preceding_entries = int(boundary - (cumulative_counts[run] - counts[run]))
+                if preceding_entries < counts[run]:
+                    run_splits.setdefault(run, set()).add(preceding_entries)
+                    cuts.add(run)
+                cuts.add(run + 1)
+    cuts = sorted(cut for cut in cuts if 0 < cut < len(entries))
+
+    for start, end in zip([0] + cuts, cuts + [len(entries)]):
+        if counts is None:
+            yield entries[start:end], None
+        elif start in run_splits:
+            split_points = sorted(run_splits[start])
+            for piece_start, piece_end in zip([0] + split_points, split_points + [int(counts[start])]):
+                yield entries[start:end], np.array([piece_end - piece_start], dtype=np.int64)
+        else:
+            yield entries[start:end], counts[start:end]
+
+
+def compute_metrics(entries, counts, tau_thresholds, chunk_size=METRIC_CHUNK_SIZE):
+    """
+    Calculates the circulation, the total entities, HHI, Shannon entropy, Gini coefficient, Theil index, maximum
+    power ratio and the tau index for multiple thresholds of a distribution of balances in a single pass over it
+    :param entries: numpy array of balances sorted in descending order (see compute_prefix_metrics)
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :param tau_thresholds: list of floats, the parameters of the tau index
+    :param chunk_size: int, the maximum number of balances of each chunk of the pass (see get_chunks)
+    :returns: dictionary of the metrics, keyed by the names of the metrics in the config file and 'circulation', with
+    the tau indices under 'tau' in the order of the thresholds
+    """
+    return compute_prefix_metrics(entries, counts, tau_thresholds, [None], chunk_size)[0]
+
+
+def compute_prefix_metrics(entries, counts, tau_thresholds, prefix_sizes, chunk_size=METRIC_CHUNK_SIZE):
+    """
+    Calculates the metrics of compute_metrics for multiple prefixes of a distribution of balances (i.e. for the
+    distributions of its top entries) in a single pass over its chunks (see get_chunks).
+    Only the Gini coefficient and the tau index depend on the order of the balances, so the other metrics can also
+    be computed on a distribution in no particular order.
+    Each chunk contributes sums that do not depend on the (not yet known) circulation: the sum of the balances, of
+    their squares, of x * ln(x) and of the balances weighted by the number of richer entities, where balances are
+    scaled by the largest balance of the first chunk to keep the sums in range, and the exact (integer) sum of the
+    balances, i.e. the circulation. The running sums are recorded at the end of each chunk, so the metrics of each
+    prefix are derived from the sums at its end. The tau indices are resolved (on exact sums) after the pass, by
+    reading again only the chunks that reach their thresholds, so the distribution should be an array that can be
+    sliced again (e.g. memory-mapped from disk) and no chunk is kept in memory during the pass.
+    :param entries: numpy array of balances (sorted in descending order, unless neither the Gini coefficient nor the
+    tau index is needed, or if there are multiple prefixes)
+    :param counts: numpy array of the number of entries of each balance (run-length form) or None
+    :param tau_thresholds: list of floats, the parameters of the tau index
+    :param prefix_sizes: list of the numbers of entities of each prefix, where None stands for the whole distribution
+    :param chunk_size: int, the maximum number of balances of each chunk of the pass
+    :returns: list of dictionaries of the metrics of each prefix (see compute_metrics)
+    """
+    boundaries = [prefix_size for prefix_size in prefix_sizes if prefix_size is not None]
+    scale = None
+    total_entities = circulation = 0
+    balance_sum = squares_sum = log_sum = rank_sum = max_scaled = 0.0
+    running_sums = [(0, 0.0, 0.0, 0.0, 0.0, 0.0, 0)]  # The sums of the empty prefix and at the end of each chunk
+    for chunk_entries, chunk_counts in get_chunks(entries, counts, chunk_size, boundaries):
+        scaled = get_balance_array(chunk_entries)
+        if scale is None:
+            scale = float(np.max(scaled)) or 1.0
+        scaled = scaled / scale
+        max_scaled = max(max_scaled, float(np.max(scaled)))
+        positive = scaled > 0
+        log_terms = np.zeros_like(scaled)
+        np.log(scaled, out=log_terms, where=positive)
+        log_terms *= scaled
+        if chunk_counts is None:
+            weighted = scaled
+            richer = np.arange(total_entities, total_entities + len(chunk_entries), dtype=np.float64)
+            chunk_entities = len(chunk_entries)
+        else:
+            # The richer population of the entries of a run is an arithmetic sequence, so its average is used
+            chunk_counts = np.asarray(chunk_counts, dtype=np.int64)
+            weighted = scaled * chunk_counts
+            log_terms *= chunk_counts
+            richer = (get_richer_counts(chunk_counts) + total_entities) + (chunk_counts - 1) / 2
+            chunk_entities = int(np.sum(chunk_counts))
+        total_entities += chunk_entities
+        circulation += get_exact_sum(chunk_entries, chunk_counts)
+        balance_sum += float(np.sum(weighted))
+        squares_sum += float(np.dot(weighted, scaled))
+        log_sum += float(np.sum(log_terms))
+        rank_sum += float(np.dot(weighted, richer))
+        running_sums.append((total_entities, balance_sum, squares_sum, log_sum, rank_sum, max_scaled, circulation))
+
+    chunk_totals = [sums[0] for sums in running_sums]
+    chunk_ends = [sums[6] for sums in running_sums[1:]]
+    results = []
+    chunk_targets = {}  # Maps each chunk that reaches some threshold to the tau indices that are resolved in it
+    for prefix_size in prefix_sizes:
+        num_chunks = len(running_sums) - 1 if prefix_size is None \
+            else bisect_left(chunk_totals, min(prefix_size, total_entities))
+        prefix_results = get_metrics_from_sums(running_sums[num_chunks], tau_thresholds)
+        results.append(prefix_results)
+        if prefix_results['total_entities'] == 0:
+            continue
+        # Each threshold is resolved in the first chunk whose circulation reaches it, on the amount that is missing
+        # at the start of the chunk
+        for idx, threshold in enumerate(tau_thresholds):
+            if threshold > 0:
+                target = get_tau_target(threshold, running_sums[num_chunks][6])
+                chunk_idx = bisect_left(chunk_ends, target, 0, num_chunks)
+                if chunk_idx == num_chunks:  # The threshold is never reached
+                    prefix_results['tau'][idx] = prefix_results['total_entities']
+                else:
+                    chunk_targets.setdefault(chunk_idx, []).append((prefix_results['tau'], idx, target))
+
+    # The chunks of the distribution are views of its arrays, so skipping to the chunks that reach the thresholds
+    # does not read the chunks in between
+    for chunk_idx, (chunk_entries, chunk_counts) in enumerate(get_chunks(entries, counts, chunk_size, boundaries)):
+        if not chunk_targets:
+            break
+        if chunk_idx not in chunk_targets:
+            continue
+        targets = chunk_targets.pop(chunk_idx)
+        previous_sum = chunk_ends[chunk_idx - 1] if chunk_idx > 0 else 0
+        chunk_tau_indices = resolve_tau_targets(chunk_entries, [target - previous_sum for _, _, target in targets],
+                                                chunk_counts)
+        for (tau_indices, idx, _), tau_index in zip(targets, chunk_tau_indices):
+            tau_indices[idx] = chunk_totals[chunk_idx] + tau_index
+    return results
+
+
+def get_metrics_from_sums(sums, tau_thresholds):
+    """
+    Derives the metrics of a distribution (or of a prefix of it) from the running sums of compute_prefix_metrics,
+    except for the tau indices, which are resolved on the chunks of the distribution
+    :param sums: tuple (total entities, balance sum, squares sum, x * ln(x) sum, rank-weighted sum, maximum balance,
+    circulation) at the end of the distribution, where all sums but the (exact) circulation are of scaled balances
+    :param tau_thresholds: list of floats, the parameters of the tau index
+    :returns: dictionary of the metrics (see compute_metrics), with all tau indices set to 0
+    """
+    total_entities, balance_sum, squares_sum, log_sum, rank_sum, max_scaled, circulation = sums
+    if total_entities == 0:
+        return {'circulation': 0, 'total_entities': 0, 'hhi': 0.0, 'shannon_entropy': 0.0, 'gini': 1, 'theil': 0,
+                'mpr': 0, 'tau': [0] * len(tau_thresholds)}
+    balance_sum = np.float64(balance_sum)  # Division by a zero circulation gives nan, like the individual metrics
+    return {
+        'circulation': float(circulation),
+        'total_entities': total_entities,
+        'hhi': float(10000 * squares_sum / balance_sum ** 2),
+        'shannon_entropy': float(np.log2(balance_sum) - log_sum / (balance_sum * np.log(2))),
+        'gini': float(1 - (balance_sum + 2 * rank_sum) / (balance_sum * total_entities)),
+        'theil': float(log_sum / balance_sum + np.log(total_entities / balance_sum)),
+        'mpr': float(max_scaled / balance_sum),
+        'tau': [0] * len(tau_thresholds)
+    }
@@ -0,0 +1,578 @@
+"""
+Module with helper functions for reading the raw snapshot data
+"""
+import bz2
+import csv
+import gzip
+import json
+import lzma
+import os
+import pathlib
+import logging
+import mmap
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy as np
+import tokenomics_decentralization.helper as hlp
+try:
+    import zstandard  # Optional, for reading zstd-compressed snapshots
+except ImportError:
+    zstandard = None
+
+INT64_MAX = np.iinfo(np.int64).max
+MIN_PART_SIZE = 64 * 10**6  # Files are only split into parts that are parsed in parallel if each part is larger than this
+READ_BLOCK_SIZE = 2**22  # Number of bytes that are read (and parsed) at once from a raw snapshot file
+MAX_INT64_DIGITS = 18  # All balances of up to this many digits fit in int64
+READ_AHEAD_BLOCKS = 8  # Number of blocks that the reader thread of a snapshot file reads ahead of the parser
+PREFETCH_SIZE = 2**28  # Number of bytes of the input of the next job that are prefetched to the page cache
+
+
+def get_snapshot_files(filename):
+    """
+    Retrieves the files that store the raw data of a snapshot. A sharded snapshot (e.g. a BigQuery export of the
+    form <ledger>_<date>_raw_data_<shard>.csv) is given as a filename with a "*" wildcard in place of the shard
+    (see helper.get_sharded_input_info). If a shard exists both uncompressed and compressed, the uncompressed file
+    is used.
+    :param filename: the path of the raw snapshot csv file or of its shards
+    :returns: a sorted list of paths
+    """
+    filename = pathlib.Path(filename)
+    if '*' not in filename.name:
+        return [filename]
+    shard_files = {}
+    for shard_file in sorted(filename.parent.glob(filename.name)):
+        if hlp.INPUT_FILENAME_PATTERN.match(shard_file.name):
+            shard_files.setdefault(shard_file.name[:shard_file.name.rindex('.csv')], shard_file)
+    return list(shard_files.values())
+
+
+def is_compressed(filename):
+    """
+    Determines whether a raw snapshot file is compressed, based on its suffix
+    :param filename: the path of a raw snapshot file
+    :returns: boolean
+    """
+    return pathlib.Path(filename).suffix in hlp.COMPRESSED_INPUT_SUFFIXES
+
+
+@contextmanager
+def open_snapshot_file(filename):
+    """
+    Opens a raw snapshot file for reading, decompressing it as a stream (without temporary files) if it is
+    compressed (.gz, .bz2, .xz or, if the zstandard package is installed, .zst). The decompression is done in C and
+    releases the GIL, so it runs in parallel with the parsing of the lines (see read_csv_arrays).
+    :param filename: the path of a raw snapshot file
+    :returns: a context manager of a binary file object
+    :raises ValueError: if the file is zstd-compressed and zstandard is not installed
+    """
+    suffix = pathlib.Path(filename).suffix
+    if suffix == '.zst' and zstandard is None:
+        raise ValueError(f'Reading the compressed snapshot {filename} requires the "zstandard" package')
+    with open(filename, 'rb') as f:
+        advise_sequential_read(f, 0, os.path.getsize(filename))
+        decompressors = {
+            '.gz': lambda: gzip.GzipFile(fileobj=f),
+            '.bz2': lambda: bz2.BZ2File(f),
+            '.xz': lambda: lzma.LZMAFile(f),
+            '.zst': lambda: zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=False)
+        }
+        if suffix not in decompressors:
+            yield f
+            return
+        with decompressors[suffix]() as decompressed_file:
+            yield decompressed_file
+
+
+def get_snapshot_size(filename):
+    """
+    Estimates the size of the raw data of a snapshot (see helper.get_input_data_size)
+    :param filename: the path of the raw snapshot csv file or of its shards (see get_snapshot_files)
+    :returns: the total (estimated) size of the raw data of the snapshot's files in bytes
+    """
+    return sum(hlp.get_input_data_size(snapshot_file, os.path.getsize(snapshot_file))
+               for snapshot_file in get_snapshot_files(filename))
+
+
+def get_snapshot_parts(filename, max_parts):
+    """
+    Splits a snapshot into parts that can be parsed independently. Each file of the snapshot is a part, unless more
+    parts are allowed, in which case the uncompressed files are split (in proportion to their size) into byte ranges
+    of at least MIN_PART_SIZE. Compressed files cannot be split, since they can only be read sequentially.
+    :param filename: the path of the raw snapshot csv file or of its shards (see get_snapshot_files)
+    :param max_parts: the max number of parts that the snapshot is split into (unless it has more shards)
+    :returns: a list of tuples (file, part), where part is a tuple (part index, number of parts of the file) or None
+    if the whole file is a single part
+    """
+    snapshot_files = get_snapshot_files(filename)
+    file_sizes = [os.path.getsize(snapshot_file) for snapshot_file in snapshot_files]
+    total_size = sum(file_sizes)
+    parts = []
+    for snapshot_file, file_size in zip(snapshot_files, file_sizes):
+        num_parts = min(max_parts * file_size // total_size, file_size // MIN_PART_SIZE) \
+            if total_size and not is_compressed(snapshot_file) else 1
+        if num_parts > 1:
+            parts.extend((snapshot_file, (part_idx, num_parts)) for part_idx in range(num_parts))
+        else:
+            parts.append((snapshot_file, None))
+    return parts
+
+
+def get_byte_range(file_size, part):
+    """
+    Computes the byte range of a part of a file
+    :param file_size: the size of the file in bytes
+    :param part: a tuple (part index, number of parts) or None for the whole file
+    :returns: a tuple (start, end) of byte offsets
+    """
+    if part is None:
+        return 0, file_size
+    part_idx, num_parts = part
+    return file_size * part_idx // num_parts, file_size * (part_idx + 1) // num_parts
+
+
+def read_ahead(iterable, queue_size):
+    """
+    Iterates over an iterable in a background thread, which stays up to queue_size items ahead of the consumer, so
+    that the blocking work of the iterable (e.g. disk reads, which release the GIL) overlaps with the processing of
+    its items. Exceptions of the iterable are raised to the consumer.
+    :param iterable: the iterable (e.g. a generator) that produces the items
+    :param queue_size: the max number of items that are produced but not yet consumed
+    :returns: a generator of the items of the iterable
+    """
+    items = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            has_item, item = items.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()  # The producer stops if the consumer stops early
+        thread.join()
+
+
+def advise_sequential_read(f, start, end):
+    """
+    Hints the OS that a byte range of a file will be read sequentially, so that it reads ahead more aggressively.
+    The hint is only given on platforms that support posix_fadvise.
+    :param f: a file object
+    :param start: the first byte of the range
+    :param end: the end of the range (exclusive)
+    """
+    if hasattr(os, 'posix_fadvise') and end > start:
+        os.posix_fadvise(f.fileno(), start, end - start, os.POSIX_FADV_SEQUENTIAL)
+
+
+def prefetch_snapshot(filename):
+    """
+    Hints the OS to load (the beginning of) the files of a snapshot to the page cache in the background, so that a
+    job that is about to start finds its input in memory. If the columnar cache of a file is fresh, the cache is
+    prefetched instead of the raw file. This is a no-op on platforms that do not support posix_fadvise.
+    :param filename: the path of the raw snapshot csv file or of its shards (see get_snapshot_files)
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for snapshot_file in get_snapshot_files(filename):
+        addresses_filename, balances_filename, _ = get_cache_filenames(snapshot_file)
+        cache_files = [addresses_filename, balances_filename] if is_snapshot_cache_fresh(snapshot_file) else []
+        for prefetched_file in cache_files or [snapshot_file]:
+            try:
+                with open(prefetched_file, 'rb') as f:
+                    os.posix_fadvise(f.fileno(), 0, PREFETCH_SIZE, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass  # Prefetching is only an optimization
+
+
+def read_blocks(filename, part=None):
+    """
+    Reads a part of a file in blocks of whole lines, i.e. of the lines that start within the part's byte range, so
+    that the parts of a file are newline-aligned and each line is read by exactly one part. Uncompressed files are
+    memory-mapped, so the blocks are views of the file's pages (without copying them); the pages of each block are
+    requested from the OS (madvise) before the block is handed to the parser.
+    :param filename: the path of the file, which is decompressed if it is compressed (see open_snapshot_file)
+    :param part: a tuple (part index, number of parts) or None for the whole file; compressed files can only be read
+    as a whole
+    :returns: a generator of uint8 numpy arrays, each of which consists of complete lines
+    """
+    if is_compressed(filename):
+        if part is not None:
+            raise ValueError(f'The compressed snapshot {filename} cannot be read in parts')
+        yield from read_compressed_blocks(filename)
+        return
+
+    file_size = os.path.getsize(filename)
+    if file_size == 0:
+        return
+    start, end = get_byte_range(file_size, part)
+    with open(filename, 'rb') as f:
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapped_file, 'madvise'):
+            mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+        content = np.frombuffer(mapped_file, dtype=np.uint8)
+        if start > 0:
+            # The line that contains the byte before the range belongs to the previous part
+            start = mapped_file.find(b'\n', start - 1) + 1 or file_size
+        while start < end:
+            # Each block ends with the line that contains its last byte, so the last block ends with the line
+            # that contains the last byte of the range
+            block_end = mapped_file.find(b'\n', min(start + READ_BLOCK_SIZE, end) - 1) + 1 or file_size
+            if hasattr(mapped_file, 'madvise'):
+                page_start = start - start % mmap.PAGESIZE
+                mapped_file.madvise(mmap.MADV_WILLNEED, page_start, block_end - page_start)
+            yield content[start:block_end]
+            start = block_end
+        del content
+    finally:
+        try:
+            mapped_file.close()
+        except BufferError:
+            pass  # Blocks that are still referenced keep the file mapped until they are released
+
+
+def read_compressed_blocks(filename):
+    """
+    Reads a compressed file (see open_snapshot_file) in blocks of whole lines
+    :param filename: the path of the file
+    :returns: a generator of uint8 numpy arrays, each of which consists of complete lines
+    """
+    with open_snapshot_file(filename) as f:
+        remainder = b''
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            last_newline = block.rfind(b'\n')
+            if last_newline < 0:
+                remainder += block
+                continue
+            yield np.frombuffer(remainder + block[:last_newline + 1], dtype=np.uint8)
+            remainder = block[last_newline + 1:]
+        if remainder:
+            yield np.frombuffer(remainder, dtype=np.uint8)
+
+
+def parse_csv_block(block):
+    """
+    Parses a block of csv lines of the form address,...,balance in bulk, i.e. the delimiters of all lines are
+    located with vectorized scans of the block and the addresses and balances are gathered into arrays, without
+    creating Python objects per line. Blocks that the bulk parser does not handle (quoted fields, non-ASCII
+    characters, empty lines or balances that are not plain digits) are parsed with the csv module instead, with the
+    same semantics.
+    :param block: uint8 numpy array of complete lines
+    :returns: a tuple (addresses, balances) of numpy arrays, where addresses is an array of (utf-8) bytes and
+    balances is an int64 array, or an object array of Python ints if some balance exceeds the int64 range
+    """
+    if len(block) == 0:
+        return np.array([], dtype='S1'), np.array([], dtype=np.int64)
+    line_ends = np.flatnonzero(block == ord('\n'))
+    if block[-1] != ord('\n'):
+        line_ends = np.append(line_ends, len(block))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    line_ends = line_ends - (block[line_ends - 1] == ord('\r'))  # The line terminator can be \r\n
+    commas = np.flatnonzero(block == ord(','))
+    if len(commas) == 0 or (block == ord('"')).any() or (block >= 128).any() or (line_ends <= line_starts).any():
+        return parse_csv_block_with_csv_module(block)
+    first_commas = commas[np.minimum(np.searchsorted(commas, line_starts), len(commas) - 1)]
+    last_commas = commas[np.searchsorted(commas, line_ends) - 1]
+    if (first_commas < line_starts).any() or (first_commas >= line_ends).any():
+        return parse_csv_block_with_csv_module(block)  # Some line has a single column
+
+    address_lengths = first_commas - line_starts
+    width = max(int(address_lengths.max()), 1)
+    # The block is padded, so that the rows of bytes that are gathered never run past its end
+    padded_block = np.concatenate((block, np.zeros(width, dtype=np.uint8)))
+    index_type = np.int32 if len(padded_block) < 2 ** 31 else np.int64
+    offsets = np.arange(width, dtype=index_type)
+    address_bytes = padded_block[line_starts.astype(index_type)[:, None] + offsets]
+    if address_lengths.min() < width:
+        address_bytes[offsets >= address_lengths[:, None]] = 0
+    addresses = address_bytes.view(f'S{width}').ravel()
+
+    balance_lengths = line_ends - last_commas - 1
+    if (balance_lengths == 0).any():
+        return parse_csv_block_with_csv_module(block)
+    # Balances of up to 18 digits fit in int64; the digits of each balance are right-aligned in a matrix
+    # (the bytes are kept as uint8, where any non-digit byte wraps around to a value above 9 when '0' is subtracted)
+    offsets = np.arange(-MAX_INT64_DIGITS, 0, dtype=index_type)
+    digits = padded_block[np.maximum(line_ends.astype(index_type)[:, None] + offsets, 0)] - np.uint8(ord('0'))
+    digits[offsets < -balance_lengths[:, None]] = 0
+    if (digits > 9).any():
+        return parse_csv_block_with_csv_module(block)
+    balances = np.zeros(len(digits), dtype=np.int64)
+    for column in range(MAX_INT64_DIGITS):
+        balances *= 10
+        balances += digits[:, column]
+    long_balances = np.flatnonzero(balance_lengths > MAX_INT64_DIGITS)
+    if len(long_balances) > 0:
+        long_values = [block[last_commas[idx] + 1:line_ends[idx]].tobytes() for idx in long_balances]
+        if not all(value.isdigit() for value in long_values):
+            return parse_csv_block_with_csv_module(block)
+        long_values = [int(value) for value in long_values]
+        if max(long_values) > INT64_MAX:
+            balances = balances.astype(object)
+        balances[long_balances] = long_values
+    return addresses, balances
+
+
+def parse_csv_block_with_csv_module(block):
+    """
+    Parses a block of csv lines with the csv module, taking the first column of each line as the address and the
+    last one as the balance
+    :param block: uint8 numpy array of complete lines
+    :returns: a tuple (addresses, balances) of numpy arrays, as returned by parse_csv_block
+    """
+    lines = block.tobytes().decode().split('\n')
+    if lines[-1] == '':
+        lines.pop()  # The block ends with a line terminator
+    lines = [(line[0], int(line[-1])) for line in csv.reader(lines)]
+    addresses = np.array([address.encode() for address, _ in lines], dtype=bytes) if lines \
+        else np.array([], dtype='S1')
+    balances = [balance for _, balance in lines]
+    try:
+        return addresses, np.array(balances, dtype=np.int64)
+    except OverflowError:
+        return addresses, np.array(balances, dtype=object)
+
+
+def read_csv_arrays(filename, part=None):
+    """
+    Parses a raw snapshot csv file (or a part of it) in blocks (see read_blocks and parse_csv_block). The first line
+    of the file is a header. The blocks of the file are read by a background thread (see read_ahead), so the disk
+    reads overlap with the parsing.
+    :param filename: the path of the raw snapshot csv file
+    :param part: a tuple (part index, number of parts) or None for the whole file
+    :returns: a generator of tuples (addresses, balances) of numpy arrays, as returned by parse_csv_block
+    """
+    skip_header = part is None or part[0] == 0
+    for block in read_ahead(read_blocks(filename, part), READ_AHEAD_BLOCKS):
+        if skip_header:
+            skip_header = False
+            header_end = np.flatnonzero(block == ord('\n'))
+            block = block[header_end[0] + 1:] if len(header_end) > 0 else block[:0]
+        yield parse_csv_block(block)
+
+
+def decode_addresses(addresses):
+    """
+    Converts an array of (utf-8) address bytes to a list of strings
+    :param addresses: numpy array of bytes
+    :returns: a list of strings
+    """
+    try:
+        return addresses.astype(str).tolist()  # Fast path for ASCII addresses
+    except UnicodeDecodeError:
+        return [address.decode() for address in addresses.tolist()]
+
+
+def get_cache_filenames(filename):
+    """
+    Determines the files that store the columnar cache of a raw snapshot file. The cache is stored in a "cache"
+    directory next to the raw file and consists of a .npy file of addresses, a .npy file of balances
+    and a json file with the metadata of the raw file the cache was created from.
+    :param filename: the path of the raw snapshot csv file
+    :returns: a tuple of three paths (addresses file, balances file, metadata file)
+    """
+    filename = pathlib.Path(filename)
+    cache_dir = filename.parent / hlp.SNAPSHOT_CACHE_DIR_NAME
+    stem = filename.name.split('.')[0]
+    return cache_dir / f'{stem}_addresses.npy', cache_dir / f'{stem}_balances.npy', cache_dir / f'{stem}_meta.json'
+
+
+def get_file_signature(filename):
+    """
+    Retrieves the properties of a file that determine whether a cache created from it is still fresh
+    :param filename: the path of a file
+    :returns: a dictionary with the size and modification time (in ns) of the file
+    """
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_csv_batches(filename, batch_size, part=None):
+    """
+    Parses a raw snapshot csv file (or a part of it) in batches. The first line of the file is a header and the
+    address and balance are the first and last columns of each line respectively.
+    :param filename: the path of the raw snapshot csv file
+    :param batch_size: the max number of lines per batch
+    :param part: a tuple (part index, number of parts) or None for the whole file (see read_blocks)
+    :returns: a generator of tuples (addresses, balances) of numpy arrays (see parse_csv_block)
+    """
+    yield from get_array_batches(read_csv_arrays(filename, part), batch_size)
+
+
+def get_array_batches(arrays, batch_size):
+    """
+    Regroups a stream of (addresses, balances) arrays to batches of a given size
+    :param arrays: an iterable of tuples (addresses, balances) of numpy arrays
+    :param batch_size: the max number of entries per batch
+    :returns: a generator of tuples (addresses, balances) of numpy arrays with batch_size entries (except the last)
+    """
+    pending_addresses, pending_balances, pending_count = [], [], 0
+    for addresses, balances in arrays:
+        pending_addresses.append(addresses)
+        pending_balances.append(balances)
+        pending_count += len(balances)
+        if pending_count < batch_size:
+            continue
+        addresses, balances = np.concatenate(pending_addresses), np.concatenate(pending_balances)
+        full_batches_end = len(balances) - len(balances) % batch_size
+        for idx in range(0, full_batches_end, batch_size):
+            yield addresses[idx:idx + batch_size], balances[idx:idx + batch_size]
+        pending_addresses, pending_balances = [addresses[full_batches_end:]], [balances[full_batches_end:]]
+        pending_count = len(balances) - full_batches_end
+    if pending_count > 0:
+        yield np.concatenate(pending_addresses), np.concatenate(pending_balances)
+
+
+def convert_snapshot_to_cache(filename, batch_size=1000000):
+    """
+    Converts a raw snapshot csv file to its columnar cache, i.e. a fixed-width bytes array of addresses and an
+    int64 array of balances, stored as .npy files. The batches are streamed to disk as they are parsed, so the
+    memory of the conversion is bounded by the batch size: the balances are appended to their file directly, while
+    each batch of addresses is appended with its own width and padded to the width of the longest address in a
+    second (sequential) pass over the file. The files are first written under temporary names, so an interrupted
+    conversion never leaves a partial cache behind.
+    :param filename: the path of the raw snapshot csv file
+    :param batch_size: the number of lines that are parsed before being written to the cache
+    :returns: True if the cache was created, False if the snapshot cannot be cached (e.g. a balance exceeds int64
+    or the cache directory is not writable)
+    """
+    signature = get_file_signature(filename)
+    addresses_filename, balances_filename, meta_filename = get_cache_filenames(filename)
+    unpadded_addresses_filename = f'{addresses_filename}.unpadded.tmp'
+    raw_balances_filename = f'{balances_filename}.raw.tmp'
+    tmp_filenames = [unpadded_addresses_filename, raw_balances_filename, f'{addresses_filename}.tmp',
+                     f'{balances_filename}.tmp']
+    try:
+        addresses_filename.parent.mkdir(exist_ok=True)
+        batch_shapes = []  # The (number of entries, address width) of each batch that is written
+        with open(unpadded_addresses_filename, 'wb') as addresses_file, \
+                open(raw_balances_filename, 'wb') as balances_file:
+            for addresses, balances in get_array_batches(read_csv_arrays(filename), batch_size):
+                if balances.dtype != np.int64:
+                    logging.warning(f'Snapshot {filename} contains balances that exceed int64, so it will not be '
+                                    f'cached')
+                    return False
+                addresses.tofile(addresses_file)
+                balances.tofile(balances_file)
+                batch_shapes.append((len(balances), addresses.dtype.itemsize))
+        num_entries = sum(count for count, _ in batch_shapes)
+        width = max([batch_width for _, batch_width in batch_shapes], default=1)
+
+        cached_addresses = np.lib.format.open_memmap(f'{addresses_filename}.tmp', mode='w+', dtype=f'S{width}',
+                                                     shape=(num_entries,))
+        with open(unpadded_addresses_filename, 'rb') as f:
+            idx = 0
+            for count, batch_width in batch_shapes:
+                cached_addresses[idx:idx + count] = np.fromfile(f, dtype=f'S{batch_width}', count=count)
+                idx += count
+        cached_addresses.flush()
+        del cached_addresses
+
+        with open(f'{balances_filename}.tmp', 'wb') as f, open(raw_balances_filename, 'rb') as raw_file:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.int64)),
+                                                     'fortran_order': False, 'shape': (num_entries,)})
+            shutil.copyfileobj(raw_file, f)
+
+        for cache_filename in [addresses_filename, balances_filename]:
+            os.replace(f'{cache_filename}.tmp', cache_filename)
+        with open(meta_filename, 'w') as f:
+            json.dump(signature, f)
+    except OSError as e:
+        logging.warning(f'Could not write the cache of snapshot {filename}: {e}')
+        return False
+    finally:
+        for tmp_filename in tmp_filenames:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+    return True
+
+
+def load_snapshot_cache(filename):
+    """
+    Loads the columnar cache of a raw snapshot file as memory-mapped arrays, if the cache exists and is fresh,
+    i.e. the raw file has the same size and modification time as when the cache was created
+    :param filename: the path of the raw snapshot csv file
+    :returns: a tuple (addresses, balances) of read-only memory-mapped numpy arrays or None if no fresh cache exists
+    """
+    if not is_snapshot_cache_fresh(filename):
+        return None
+    addresses_filename, balances_filename, _ = get_cache_filenames(filename)
+    try:
+        return np.load(addresses_filename, mmap_mode='r'), np.load(balances_filename, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+
+def is_snapshot_cache_fresh(filename):
+    """
+    Determines whether the columnar cache of a raw snapshot file exists and is fresh, i.e. the raw file has the same
+    size and modification time as when the cache was created
+    :param filename: the path of the raw snapshot csv file
+    :returns: boolean
+    """
+    _, _, meta_filename = get_cache_filenames(filename)
+    try:
+        with open(meta_filename) as f:
+            return json.load(f) == get_file_signature(filename)
+    except (OSError, ValueError):
+        return False
+
+
+def get_snapshot_batches(filename, batch_size, use_cache=True, part=None):
+    """
+    Retrieves the (address, balance) entries of a raw snapshot file in batches. If caching is enabled, the entries
+    are read from the snapshot's columnar cache, which is created on the first read of the (whole) snapshot file.
+    The parts of a file that are read in parallel are served from the cache only if it already exists, since they
+    cannot create it independently of each other.
+    :param filename: the path of the raw snapshot csv file
+    :param batch_size: the max number of entries per batch
+    :param use_cache: boolean that determines whether to use (and create if needed) the columnar cache
+    :param part: a tuple (part index, number of parts) or None for the whole file
+    :returns: a generator of tuples (addresses, balances) of numpy arrays, where addresses is an array of (utf-8)
+    bytes and balances is an int64 array, or an object array of Python ints if some balance exceeds the int64 range
+    """
+    cache = None
+    if use_cache:
+        cache = load_snapshot_cache(filename)
+        if cache is None and part is None and convert_snapshot_to_cache(filename):
+            cache = load_snapshot_cache(filename)
+
+    if cache is None:
+        yield from read_csv_batches(filename, batch_size, part)
+        return
+
+    addresses, balances = cache
+    start, end = get_byte_range(len(balances), part)  # The parts of the cache are ranges of rows
+    for idx in range(start, end, batch_size):
+        batch_end = min(idx + batch_size, end)
+        yield np.asarray(addresses[idx:batch_end]), np.asarray(balances[idx:batch_end])
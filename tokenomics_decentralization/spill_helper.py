@@ -0,0 +1,198 @@
+"""
+Module with helper functions for aggregating snapshots that do not fit in memory, by spilling them to disk
+"""
+import csv
+import math
+import os
+import shutil
+import tempfile
+from itertools import islice
+import numpy as np
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+MERGE_MEMORY_FACTOR = 4  # Bytes per merged byte in a step of the merge: the blocks of the runs, their concatenation and its sorted copy
+BUCKET_BATCH_SIZE = 100000  # Number of entries that are read from a bucket file per batch of its aggregation
+MAX_OPEN_PARTITIONS = 512  # Max number of bucket files (or sorted runs) that are open at once
+RESERVED_OPEN_FILES = 64  # Number of open files that are left to the rest of the process (e.g. the input and the mapping)
+
+
+def get_max_open_partitions():
+    """
+    Determines the max number of bucket files (or sorted runs) that are open at once, s.t. the process stays within
+    its limit of open files
+    :returns: int
+    """
+    if resource is None:
+        return MAX_OPEN_PARTITIONS
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return MAX_OPEN_PARTITIONS
+    return max(2, min(MAX_OPEN_PARTITIONS, soft_limit - RESERVED_OPEN_FILES))
+
+
+def partition_entity_balances(entity_balances, num_partitions, bucket_prefix, level=0):
+    """
+    Hash-partitions a stream of entity balances into csv bucket files, s.t. all balances of an entity
+    end up in the same bucket
+    :param entity_balances: an iterable of batches, where each batch is a tuple (entities, balances) of a list of entity
+    strings and their balances (a list or a numpy array)
+    :param num_partitions: the number of buckets
+    :param bucket_prefix: the path prefix of the bucket files
+    :param level: the number of times that the entities have already been partitioned; the hash of each level is
+    different, s.t. the entities of a bucket are spread over all buckets when the bucket is partitioned again
+    :returns: a list of the paths of the bucket files
+    """
+    bucket_filenames = [f'{bucket_prefix}_{idx}.csv' for idx in range(num_partitions)]
+    bucket_files = [open(filename, 'w', newline='') for filename in bucket_filenames]
+    try:
+        bucket_writers = [csv.writer(f) for f in bucket_files]
+        for entities, balances in entity_balances:
+            for entity, balance in zip(entities, balances):
+                bucket_hash = hash(entity) if level == 0 else hash((level, entity))
+                bucket_writers[bucket_hash % num_partitions].writerow((entity, balance))
+    finally:
+        for f in bucket_files:
+            f.close()
+    return bucket_filenames
+
+
+def read_bucket_batches(bucket_filename):
+    """
+    Reads the entries of a bucket file in batches
+    :param bucket_filename: the path of a bucket file created by partition_entity_balances
+    :returns: a generator of batches, where each batch is a tuple (entities, balances) of two lists
+    """
+    with open(bucket_filename, newline='') as f:
+        rows = csv.reader(f)
+        while True:
+            batch = list(islice(rows, BUCKET_BATCH_SIZE))
+            if not batch:
+                return
+            yield [entity for entity, _ in batch], [int(balance) for _, balance in batch]
+
+
+def aggregate_bucket(bucket_filename, balance_threshold, aggregate_entity_balances):
+    """
+    Aggregates the balances of each entity in a bucket file, with the same aggregation as the in-memory path, so
+    that a bucket needs as much memory (relative to its size) as the memory estimate of a snapshot assumes (see
+    helper.get_in_memory_size)
+    :param bucket_filename: the path of a bucket file created by partition_entity_balances
+    :param balance_threshold: entities with aggregate balance not larger than this threshold are excluded
+    :param aggregate_entity_balances: a function that aggregates an iterable of batches (entities, balances) to an
+    array of the entities' aggregate balances above a threshold (see analyze.aggregate_entity_balances)
+    :returns: a numpy array of the entities' aggregate balances in descending order
+    """
+    entries = aggregate_entity_balances(read_bucket_batches(bucket_filename), balance_threshold)
+    return np.sort(entries)[::-1]
+
+
+def merge_sorted_runs(run_filenames, output_filename, memory_budget):
+    """
+    Merges sorted runs of balances into a single sorted array on disk. The merge proceeds in steps: a block is
+    loaded from each run whose previous block has been merged and all loaded entries that are not smaller than the
+    last loaded entry of every non-exhausted run are final, so they are sorted and written out together. The run
+    whose last loaded entry is the largest is thus fully written out in each step, so at most one block per run is
+    loaded at any time and the size of the blocks is chosen s.t. a step fits in the memory budget.
+    :param run_filenames: a list of paths of .npy files, each with an array of balances in descending order
+    :param output_filename: the path of the .npy file where the merged array is stored
+    :param memory_budget: the number of bytes that a step of the merge can use
+    :returns: the merged array of balances in descending order, memory-mapped from the output file
+    """
+    runs = [np.load(filename, mmap_mode='r') for filename in run_filenames]
+    dtype = np.float64 if any(run.dtype == np.float64 for run in runs) else np.int64
+    merged = np.lib.format.open_memmap(output_filename, mode='w+', dtype=dtype, shape=(sum(len(run) for run in runs), ))
+    block_size = max(1, memory_budget // (max(len(runs), 1) * np.dtype(dtype).itemsize * MERGE_MEMORY_FACTOR))
+
+    positions = [0] * len(runs)
+    blocks = [np.array([], dtype=dtype) for _ in runs]
+    merged_count = 0
+    while True:
+        cutoff = None
+        for idx, run in enumerate(runs):
+            if len(blocks[idx]) == 0 and positions[idx] < len(run):
+                blocks[idx] = run[positions[idx]:positions[idx] + block_size].astype(dtype)
+                positions[idx] += len(blocks[idx])
+            if positions[idx] < len(run):
+                cutoff = blocks[idx][-1] if cutoff is None else max(cutoff, blocks[idx][-1])
+        if not any(len(block) > 0 for block in blocks):
+            break
+        final_counts = [len(block) if cutoff is None else int(np.searchsorted(-block, -cutoff, side='right'))
+                        for block in blocks]
+        final_entries = np.sort(np.concatenate([block[:count] for block, count in zip(blocks, final_counts)]))[::-1]
+        merged[merged_count:merged_count + len(final_entries)] = final_entries
+        merged_count += len(final_entries)
+        blocks = [block[count:] for block, count in zip(blocks, final_counts)]
+    merged.flush()
+    del merged, runs
+
+    return np.load(output_filename, mmap_mode='r')
+
+
+def spill_entity_balances(entity_balances, balance_threshold, data_size, memory_budget, aggregate_entity_balances,
+                          bucket_prefix, level=0):
+    """
+    Aggregates the balances per entity to a sorted run on disk. The (entity, balance) stream is hash-partitioned
+    into buckets, s.t. each bucket can be aggregated within the memory budget, and the sorted runs of the buckets are
+    merged. If more buckets are needed than files can be open at once (see get_max_open_partitions), the stream is
+    partitioned to as many buckets as can be open and each bucket is aggregated in the same way, i.e. it is
+    partitioned again and the runs of its own buckets are merged to a single run.
+    :param entity_balances: an iterable of batches, where each batch is a tuple (entities, balances) of a list of entity
+    strings and their balances (a list or a numpy array)
+    :param balance_threshold: entities with aggregate balance not larger than this threshold are excluded
+    :param data_size: the (estimated) size of the data in memory, which determines the number of buckets
+    :param memory_budget: the number of bytes that the aggregation of a single bucket can use
+    :param aggregate_entity_balances: the function that aggregates the entities of each bucket (see aggregate_bucket)
+    :param bucket_prefix: the path prefix of the bucket files and of the run (the .npy file with this prefix)
+    :param level: the number of times that the entities have already been partitioned (see partition_entity_balances)
+    :returns: the path of the .npy file of the aggregate balances in descending order
+    """
+    num_partitions = max(1, math.ceil(2 * data_size / memory_budget))
+    max_open_partitions = get_max_open_partitions()
+    bucket_filenames = partition_entity_balances(entity_balances, min(num_partitions, max_open_partitions),
+                                                 bucket_prefix, level)
+    run_filenames = []
+    for bucket_filename in bucket_filenames:
+        if num_partitions > max_open_partitions:
+            run_filename = spill_entity_balances(read_bucket_batches(bucket_filename), balance_threshold,
+                                                 data_size / len(bucket_filenames), memory_budget,
+                                                 aggregate_entity_balances, bucket_filename[:-len('.csv')], level + 1)
+        else:
+            run_filename = f'{bucket_filename[:-len(".csv")]}.npy'
+            np.save(run_filename, aggregate_bucket(bucket_filename, balance_threshold, aggregate_entity_balances))
+        os.remove(bucket_filename)
+        run_filenames.append(run_filename)
+
+    output_filename = f'{bucket_prefix}.npy'
+    merge_sorted_runs(run_filenames, output_filename, memory_budget)
+    for run_filename in run_filenames:
+        os.remove(run_filename)
+    return output_filename
+
+
+def aggregate_out_of_core(entity_balances, balance_threshold, data_size, memory_budget, aggregate_entity_balances,
+                          spill_parent_dir=None):
+    """
+    Aggregates the balances per entity without holding all entities in memory. The (entity, balance) stream is
+    hash-partitioned into buckets on disk, s.t. each bucket can be aggregated within the memory budget, and the
+    sorted per-bucket totals are then merged with an external sort (see spill_entity_balances).
+    :param entity_balances: an iterable of batches, where each batch is a tuple (entities, balances) of a list of entity
+    strings and their balances (a list or a numpy array)
+    :param balance_threshold: entities with aggregate balance not larger than this threshold are excluded
+    :param data_size: the (estimated) size of the data in memory, which determines the number of buckets
+    :param memory_budget: the number of bytes that the aggregation of a single bucket can use
+    :param aggregate_entity_balances: the function that aggregates the entities of each bucket (see aggregate_bucket)
+    :param spill_parent_dir: the directory under which the temporary spill directory is created (if None, the
+    system's default temporary directory is used)
+    :returns: a numpy array (memory-mapped from a file on disk) of the aggregate balances in descending order
+    """
+    spill_dir = tempfile.mkdtemp(prefix='spill-', dir=spill_parent_dir)
+    try:
+        entries_filename = spill_entity_balances(entity_balances, balance_threshold, data_size, memory_budget,
+                                                 aggregate_entity_balances, os.path.join(spill_dir, 'bucket'))
+        # The merged file remains available through the memory map after the spill directory is removed
+        return np.load(entries_filename, mmap_mode='r')
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)